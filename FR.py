@@ -58,8 +58,23 @@ import random
 import os
 import sys
 import shutil
-import unicodedata
 import playIntro
+import numpy
+
+import clocksync
+import listbank
+import logsink
+import recordings
+import textcache
+import tonecache
+import vad
+from controlevents import ControlEventQueue
+from messagetemplates import MessageTemplateCache
+from presentationtiming import PresentationTimer, timestamp_time
+import sessionplan
+import stimforms
+from statejournal import StateManager
+from wordpool import WordPoolIndex
 
 from ramcontrol.extendedPyepl import *
 from ramcontrol.RAMControl import RAMControl
@@ -67,6 +82,13 @@ from ramcontrol.messages import WordMessage
 
 ram_control = RAMControl.instance()
 
+# Events to the control PC are sent from a separate thread so that network
+# stalls cannot delay presentation
+control_events = ControlEventQueue(ram_control)
+
+# Background estimate of the control PC clock, if it can be probed
+clock_sync = None
+
 # Set the current version
 # TODO: Update the version for System 2.0 pyepl changes
 MIN_PYEPL_VERSION = '1.0.0'
@@ -77,21 +99,6 @@ class Utils:
     def __init__(self):
         pass
 
-    @staticmethod
-    def shuffle_together(*lists):
-        zipped_lists = zip(*lists)
-        random.shuffle(zipped_lists)
-        return zip(*zipped_lists)
-
-    @staticmethod
-    def shuffle_inner_lists(lists):
-        """
-        Shuffles items within each list in place
-        :param lists: 2D list of size nLists x wordsPerList
-        """
-        for l in lists:
-            random.shuffle(l)
-
     @staticmethod
     def seed_rng(seed):
         """
@@ -100,20 +107,32 @@ class Utils:
         """
         random.seed(seed)
 
-    @staticmethod
-    def remove_accents(input_str):
-        nkfd_form = unicodedata.normalize('NFKD', input_str)
-        return u"".join([c for c in nkfd_form if not unicodedata.combining(c)])
+
+class CallbackClip(AudioClip):
+    """
+    AudioClip whose present() takes the onCallback of CustomBeep.present()
+    """
+
+    def present(self, clk=None, onCallback=None, **kwargs):
+        """
+        :param onCallback: (optional) function called with the timestamp of the clip's onset
+        :return: timestamp of the clip's onset
+        """
+        timestamp = AudioClip.present(self, clk, **kwargs)
+        if onCallback:
+            onCallback(timestamp)
+        return timestamp
 
 
 class FRExperiment:
-    def __init__(self, exp, config, video, clock):
+    def __init__(self, exp, config, video, clock, state_manager=None):
         """
         Initialize the data for the experiment.
         Runs the prepare function, sets up the experiment state
         :param exp: Experiment object
         :param config: Config object
         :param video: VideoTrack object
+        :param state_manager: (optional) StateManager holding the experiment state
         """
         self.exp, self.config = \
             exp, config
@@ -122,6 +141,10 @@ class FRExperiment:
         self.video = video
         self.clock = clock
         self.wp = CustomTextPool(self.config.wp)
+        self.wp_index = WordPoolIndex(self.wp)
+        self._list_bank = None
+        self._pool_checksum = listbank.pool_checksum(self.wp_index.names())
+        self.state_manager = state_manager or StateManager(exp)
 
     def _show_prepare_message(self):
         """
@@ -150,8 +173,7 @@ then delete the subject folder in:
         # With accents
         shutil.copy(self.config.wp, os.path.join(sess_path, '..'))
         # Without accents
-        no_accents_wp = [Utils.remove_accents(line.strip())
-                         for line in codecs.open(self.config.wp, 'r', 'utf-8').readlines()]
+        no_accents_wp = [self.wp_index.forms(name).no_accents for name in self.wp_index.names()]
         open(os.path.join(sess_path,'..', self.config.noAcc_wp), 'w').write('\n'.join(no_accents_wp))
 
     def _assert_good_list_params(self):
@@ -185,60 +207,28 @@ then delete the subject folder in:
                 print "\nERROR:\nPath/File does not exist: %s\n\nPlease verify the config.\n" % f
                 sys.exit(1)
 
-    def _get_stim_session_sources(self):
-        """
-        will return the filenames to be read for all sessions
-        that are counterbalanced for stim positions
-        :return: the filenames for each session
-        """
-        sess_numbers = [[i, i+1] for i in range(1, self.config.numSessions+1, 2)]
-        print(sess_numbers)
-        random.shuffle(sess_numbers)
-        session_sources = []
-        for sess_pair in sess_numbers:
-            random.shuffle(sess_pair)
-            session_sources.extend(
-                [os.path.join(self.config.wordList_dir % self.config.LANGUAGE,
-                              '%d.txt' % sess_num)
-                    for sess_num in sess_pair])
-        return session_sources
-
-    def _get_nonstim_session_sources(self):
-        """
-        Gets the filenames to be read for all sessions to be
-        used for the non-stim experiment
-        :return: the filename for each session
-        """
-        session_sources = range(1, self.config.numSessions+1)
-        random.shuffle(session_sources)
-        return [os.path.join(self.config.wordList_dir % self.config.LANGUAGE,
-                             '%d.txt' % sess_num)
-                for sess_num in session_sources]
+        # The compiled list bank was validated when it was built, so it only has to
+        # match the current pool and the sizes and modification times of the list files
+        self._list_bank = listbank.load_list_bank(config.wordList_dir % config.LANGUAGE,
+                                                  self.wp_index.names())
 
-    def _get_session_sources(self):
+    def _read_session_words(self):
         """
-        Gets the filenames to be read for all sessions to be
-        used for any type of experiment
-        :return: the filename for each session
+        Reads the lists of every session as word pool indices
+        Lists in each session are in the order [*<stim_lists>, *<nonstim_lists>]
+        :return: 3D array of size numSessions x nLists x listLen
         """
-        if self.is_stim_experiment():
-            return self._get_stim_session_sources()
+        list_dir = self.config.wordList_dir % self.config.LANGUAGE
+        if self._list_bank:
+            session_words = self._list_bank.words[:self.config.numSessions]
         else:
-            return self._get_nonstim_session_sources()
+            session_words = numpy.array([listbank.read_list_file(os.path.join(list_dir, '%d.txt' % session_num),
+                                                                 self.wp_index.index_by_name)
+                                         for session_num in range(1, self.config.numSessions + 1)])
 
-    def _read_session_source(self, session_source_file):
-        """
-        Reads the words from a session source file into a 2D array
-        :param session_source_file: the filename to be read
-        :return: 2D array of words
-        """
-        session_lists = [x.strip().split() for x in codecs.open(session_source_file, encoding='utf-8').readlines()]
-
-        # Check to make sure they're all the right length
-        assert all([len(this_list) == self.config.listLen for this_list in session_lists])
-
-        # Convert into TextPool items
-        return [[self.wp.findBy(name=word) for word in trial] for trial in session_lists]
+        # Check to make sure they're all the right size
+        assert session_words.shape == (self.config.numSessions, self.config.numTrials, self.config.listLen)
+        return session_words
 
     def is_stim_experiment(self):
         """
@@ -252,77 +242,6 @@ then delete the subject folder in:
         else:
             raise Exception('STIM TYPE:%s not recognized' % stim_type)
 
-    def _prepare_single_session_lists(self, session_source_file):
-        """
-        Creates the lists for a single session
-        :param session_source_file: File containing the lists that will be used in this session
-                                    Lists should have stim lists first (if any) then nonstim
-        :return:(session_lists, session_lists_is_stim)
-        """
-        session_source_lists = self._read_session_source(session_source_file)
-
-        # Shuffle within the lists
-        Utils.shuffle_inner_lists(session_source_lists)
-
-        # Split the lists by type
-        (stim_lists, nonstim_lists, ) = self._split_session_lists_by_stim_type(session_source_lists)
-
-        # Shuffle within the list types so we can just pop later
-        random.shuffle(stim_lists)
-        random.shuffle(nonstim_lists)
-
-        # Put the baseline trials at the front
-        ordered_session_lists = []
-        ordered_list_is_stim = []
-        for _ in range(self.config.nBaselineTrials):
-            ordered_session_lists.append(nonstim_lists.pop())
-            ordered_list_is_stim.append(False)
-
-        remaining_lists, remaining_is_stim = \
-            self._shuffle_stimulation(stim_lists, nonstim_lists)
-
-        # Put the rest of the lists shuffled at the back
-        ordered_session_lists.extend(remaining_lists)
-        ordered_list_is_stim.extend(remaining_is_stim)
-
-        return ordered_session_lists, ordered_list_is_stim
-
-    @staticmethod
-    def _shuffle_stimulation(stim_lists, nonstim_lists):
-        """
-        pseudo-randomly assigns stim to trials such that each half of trials have an
-        equal number of stim and non-stim lists
-        :return: (shuffled_lists, shuffled_is_stim)
-        """
-        stim_halves = (0, len(stim_lists)/2, len(stim_lists))
-        nonstim_halves = (0, len(nonstim_lists)/2, len(nonstim_lists))
-
-        all_lists = []
-        all_stims = []
-
-        for i in range(2):
-            half_lists = stim_lists[stim_halves[i]:stim_halves[i+1]] + \
-                         nonstim_lists[nonstim_halves[i]:nonstim_halves[i+1]]
-            half_stims = [True]*(stim_halves[i+1]-stim_halves[i]) + \
-                         [False]*(nonstim_halves[i+1]-nonstim_halves[i])
-            half_lists, half_stims = \
-                Utils.shuffle_together(half_lists, half_stims)
-            all_lists += half_lists
-            all_stims += half_stims
-        return all_lists, all_stims
-
-    def _split_session_lists_by_stim_type(self, session_lists):
-        """
-        Splits lists into stim lists and nonstim lists
-        NOTE: Assumes that the lists in the input are in the order:
-            [*<stim_lists>, *<nonstim_lists>]
-        :param session_lists: 2D matrix of size nLists x wordsPerList of all possible lists
-        :return: (stim_lists, nonstim_lists)
-        """
-        stim_lists = session_lists[:self.config.nStimTrials]
-        nonstim_lists = session_lists[self.config.nStimTrials:]
-        return stim_lists, nonstim_lists
-
     def _prepare_practice_lists(self):
         """
         Prepares the words for the practice list
@@ -340,23 +259,60 @@ then delete the subject folder in:
     def _prepare_all_sessions_lists(self):
         """
         Prepares word lists for all sessions
-        :return: (words_by_session, stim_lists_by_session)
+        :return: (words_by_session, stim_lists_by_session) as arrays of word pool indices
+                 of size numSessions x nLists x listLen and stim flags of size numSessions x nLists
         """
         self._assert_good_list_params()
         self._verify_files()
 
-        words_by_session = []
-        stim_lists_by_session = []
+        # Shuffles for all sessions are drawn at once from the subject code
+        return sessionplan.plan_sessions(self._read_session_words(),
+                                         self.config.nStimTrials,
+                                         self.config.nBaselineTrials,
+                                         sessionplan.subject_rng(self.subject),
+                                         paired=self.is_stim_experiment())
 
-        session_sources = self._get_session_sources()
+    @staticmethod
+    def _has_item_lists(state):
+        """
+        :return: True if the state was saved before lists were stored as word pool indices
+        """
+        return getattr(state, 'sessionWords', None) is None
+
+    def get_num_sessions(self, state):
+        """
+        :return: number of sessions planned in the state
+        """
+        if self._has_item_lists(state):
+            return len(state.sessionLists)
+        return state.sessionWords.shape[0]
+
+    def get_num_lists(self, state, session_i):
+        """
+        :return: number of lists in the given session
+        """
+        if self._has_item_lists(state):
+            return len(state.sessionLists[session_i])
+        return state.sessionWords.shape[1]
 
-        for session_source in session_sources:
-            (this_session_words, this_session_list_stim,) = \
-                self._prepare_single_session_lists(session_source)
-            words_by_session.append(this_session_words)
-            stim_lists_by_session.append(this_session_list_stim)
+    def get_list_words(self, state, session_i, list_i):
+        """
+        Looks up the words of a single list through the word pool index
+        :return: list of words, in presentation order
+        """
+        if self._has_item_lists(state):
+            return [word.name for word in state.sessionLists[session_i][list_i]]
+        if state.wordPoolChecksum != self._pool_checksum:
+            raise Exception('Word pool %s has changed since the lists were made' % self.config.wp)
+        return [self.wp_index.items[word_i].name for word_i in state.sessionWords[session_i, list_i]]
 
-        return words_by_session, stim_lists_by_session
+    def get_list_is_stim(self, state, session_i, list_i):
+        """
+        :return: True if the given list is a stim list
+        """
+        if self._has_item_lists(state):
+            return state.sessionStim[session_i][list_i]
+        return bool(numpy.unpackbits(state.sessionStimBits[session_i])[list_i])
 
     def _make_latex_preamble(self):
         """
@@ -366,6 +322,7 @@ then delete the subject folder in:
         preamble = [
             '\\documentclass{article}',
             '\\usepackage[margin=1in]{geometry}',
+            '\\usepackage[utf8]{inputenc}',
             '\\usepackage{multirow}',
             '\\usepackage{tabularx}',
             '\\begin{document}',
@@ -382,11 +339,14 @@ then delete the subject folder in:
         Generate and compile LaTeX code containing a table with each
         trial's words spread between two rows. The header of each table
         states the type of stimulation to be used in that trial.
+        The PDFs are built concurrently by stimforms, and a session's PDF is only
+        rebuilt when its LaTeX code changed.
         """
         exp = self.exp
         config = self.config
-        state = exp.restoreState()
+        state = self.state_manager.get()
         subj = self.subject
+        jobs = []
 
         # Loop through sessions
         for session_i in range(config.numSessions):
@@ -402,10 +362,9 @@ then delete the subject folder in:
 
             document = []
 
-            trial_stim = state.sessionStim[session_i]
-            trial_words = state.sessionLists[session_i]
-
-            for (trial_i, (this_words, this_stim)) in enumerate(zip(trial_words, trial_stim)):
+            for trial_i in range(self.get_num_lists(state, session_i)):
+                this_words = self.get_list_words(state, session_i, trial_i)
+                this_stim = self.get_list_is_stim(state, session_i, trial_i)
 
                 # insert vertical space
                 document.append('\\vspace{.1in}')
@@ -416,16 +375,16 @@ then delete the subject folder in:
                 rowline1 = '\\multirow{2}{*}{List %d%s} & ' % (trial_i + 1, '' if trial_i + 1 >= 10 else '~~')
                 # Word list must be an even number for this to work predictably
                 for i in range(len(this_words) / 2):
-                    word = this_words[i]
-                    bold_word = ('\\textbf{%s}' % word.name) if this_stim else word.name
-                    rowline1 += (' & ' if i != 0 else '') + bold_word.encode('utf-8')
+                    word = self.wp_index.forms(this_words[i]).latex
+                    bold_word = ('\\textbf{%s}' % word) if this_stim else word
+                    rowline1 += (' & ' if i != 0 else '') + bold_word
                 rowline1 += '\\\\'
                 document.append(rowline1)
                 rowline2 = '\\cline{2-7}\t\t\t& '
                 for i in range(len(this_words) / 2, len(this_words)):
-                    word = this_words[i]
-                    bold_word = ('\\textbf{%s}' % word.name) if this_stim else word.name
-                    rowline2 += (' & ' if i != len(this_words) / 2 else '') + bold_word.encode('utf-8')
+                    word = self.wp_index.forms(this_words[i]).latex
+                    bold_word = ('\\textbf{%s}' % word) if this_stim else word
+                    rowline2 += (' & ' if i != len(this_words) / 2 else '') + bold_word
                 rowline2 += '\\\\'
                 document.append(rowline2)
                 document.append('\\end{tabular}')
@@ -433,21 +392,19 @@ then delete the subject folder in:
 
             postamble = ['\\end{document}']
 
-            stim_form.write('\n'.join(preamble) + '\n' + '\n'.join(document) + '\n' + '\n'.join(postamble))
-
+            source = '\n'.join(preamble) + '\n' + '\n'.join(document) + '\n' + '\n'.join(postamble)
+            stim_form.write(source)
             stim_form.close()
-
-            # Make the dvi document
-            os.system('cd %s; latex %s >> latexLog.txt' % (os.path.dirname(stim_form.name), stim_form.name))
-
-            # Convert the dvi to pdf
-            dvi_form = exp.session.createFile(form_name + '.dvi')
-            dvi_form.close()
-            os.system('cd %s; dvipdf %s >> latexLog.txt' % (os.path.dirname(dvi_form.name), dvi_form.name))
-
-            # Clean up unneccesary files
-            os.system('cd %s; rm %s.dvi; rm %s.log; rm %s.aux' % (os.path.dirname(dvi_form.name),
-                      form_name, form_name, form_name))
+            jobs.append((os.path.dirname(stim_form.name), form_name, source))
+
+        # Compile the forms concurrently, skipping those already built from the same source
+        for (form_name, status, seconds, error) in stimforms.build_forms(jobs):
+            if status == stimforms.FAILED:
+                print 'WARNING: could not make %s.pdf: %s' % (form_name, error)
+            elif status == stimforms.BUILT:
+                print '%s.pdf built in %.1f s' % (form_name, seconds)
+            else:
+                print '%s.pdf unchanged' % form_name
 
     def _show_making_stim_forms(self):
         self.video.clear('black')
@@ -458,14 +415,14 @@ then delete the subject folder in:
         """
         :return: True if this session has previously been started
         """
-        state = self.exp.restoreState()
+        state = self.state_manager.get()
         return state.session_started
 
     def is_experiment_started(self):
         """
         :return: True if experiment has previously been started
         """
-        state = self.exp.restoreState()
+        state = self.state_manager.get()
         if state:
             return True
         else:
@@ -474,14 +431,15 @@ then delete the subject folder in:
     def _write_lst_files(self, session_lists, practice_lists):
         """
         Writes .lst files to the session folders
-        :param session_lists: word lists for each list for each session
+        :param session_lists: word pool indices for each list for each session
         """
         for session_i, (lists, practice_list) in enumerate(zip(session_lists, practice_lists)):
             # Set the session so it writes the files in the correct place
             self.exp.setSession(session_i)
             self._write_single_lst_file(practice_list, 'p.lst')
             for list_i, words in enumerate(lists):
-                self._write_single_lst_file([word.name for word in words], '%d.lst' % list_i)
+                self._write_single_lst_file([self.wp_index.items[word_i].name for word_i in words],
+                                            '%d.lst' % list_i)
 
     def _write_single_lst_file(self, words, label):
         """
@@ -490,7 +448,7 @@ then delete the subject folder in:
         :param label: name of the file to be written in the session folder
         """
         list_file = self.exp.session.createFile(label)
-        list_file.write('\n'.join([Utils.remove_accents(word) for word in words]))
+        list_file.write('\n'.join([self.wp_index.forms(word).no_accents for word in words]))
         list_file.close()
 
     def init_experiment(self):
@@ -518,24 +476,24 @@ then delete the subject folder in:
         self._write_lst_files(session_lists, practice_lists)
 
         # Save out the state
-        state = self.exp.restoreState()
-        self.exp.saveState(state,
-                           session_started=False,
-                           trialNum=0,
-                           practiceDone=False,
-                           sessionLists=session_lists,
-                           practiceLists=practice_lists,
-                           sessionStim=session_stim,
-                           lastStimTime=0,
-                           sessionNum=0,
-                           language='spanish' if self.config.LANGUAGE == 'SP' else 'english',
-                           LANG=self.config.LANGUAGE)
-
-        #self._show_making_stim_forms()
-        #self.make_stim_forms()
+        self.state_manager.save(session_started=False,
+                                trialNum=0,
+                                practiceDone=False,
+                                sessionWords=session_lists.astype(numpy.int16),
+                                wordPoolChecksum=self._pool_checksum,
+                                practiceLists=practice_lists,
+                                sessionStimBits=numpy.packbits(session_stim, axis=-1),
+                                lastStimTime=0,
+                                sessionNum=0,
+                                language='spanish' if self.config.LANGUAGE == 'SP' else 'english',
+                                LANG=self.config.LANGUAGE)
+
+        if self.config.makeStimForm:
+            self._show_making_stim_forms()
+            self.make_stim_forms()
 
         self.exp.setSession(0)
-        return self.exp.restoreState()
+        return self.state_manager.get()
 
     def get_stim_type(self):
         """
@@ -559,13 +517,53 @@ class FRExperimentRunner:
         self.mathlog = mathlog
         self.video = video
         self.audio = audio
-        self.start_beep = CustomBeep(self.config.startBeepFreq,
-                               self.config.startBeepDur,
-                               self.config.startBeepRiseFall)
-        self.stop_beep = CustomBeep(self.config.stopBeepFreq,
-                              self.config.stopBeepDur,
-                              self.config.stopBeepRiseFall)
         self._on_screen = True
+        self._message_templates = MessageTemplateCache(ram_control, WordMessage)
+        self.timer = PresentationTimer()
+        self._trial = -1
+        self._sync_checks = []
+        self._texts = textcache.TextCache(self.config.defaultFont)
+        self._tones = tonecache.ToneCache(self.config.toneCacheDir)
+        self.start_beep = self._make_beep(self.config.startBeepFreq,
+                                          self.config.startBeepDur,
+                                          self.config.startBeepRiseFall)
+        self.stop_beep = self._make_beep(self.config.stopBeepFreq,
+                                         self.config.stopBeepDur,
+                                         self.config.stopBeepRiseFall)
+        self._math_beeps = self._make_math_beeps()
+        self._recordings = None
+        if self.config.compressRecordings or self.config.detectVocalizations:
+            self._recordings = recordings.RecordingWorker(compress=self.config.compressRecordings)
+            if self.config.detectVocalizations:
+                self._recordings.stages.append(self._detect_vocalizations)
+        if self.config.control_pc:
+            control_events.start(self.config.controlQueueSize)
+
+    def _make_beep(self, freq, duration, rise_fall):
+        """
+        Makes a recall beep from the tone cache
+        :return: CallbackClip of the tone
+        """
+        clip = self._tones.clip(CallbackClip, freq, duration, rise_fall)
+        if clip is None:
+            raise Exception('Could not make the %d Hz recall beep' % freq)
+        return clip
+
+    def _make_math_beeps(self):
+        """
+        Makes the math distractor's feedback beeps from the tone cache
+        :return: {'correctSndFile': clip, 'incorrectSndFile': clip} for the beeps that could be made
+        """
+        config = self.config
+        beeps = {}
+        for (name, freq, duration, rise_fall) in (
+                ('correctSndFile', config.MATH_correctBeepFreq, config.MATH_correctBeepDur, config.MATH_correctBeepRF),
+                ('incorrectSndFile', config.MATH_incorrectBeepFreq, config.MATH_incorrectBeepDur,
+                 config.MATH_incorrectBeepRF)):
+            clip = self._tones.clip(AudioClip, freq, duration, rise_fall)
+            if clip:
+                beeps[name] = clip
+        return beeps
 
     def log_message(self, message, time=None):
         """
@@ -577,6 +575,18 @@ class FRExperimentRunner:
             time = self.clock
         self.log.logMessage(message, time)
 
+    def _flush_logs(self, close=False):
+        """
+        Has buffered logs write out their queued entries
+        :param close: also close them (end of session)
+        """
+        for log in (self.log, self.mathlog):
+            if isinstance(log, logsink.BufferedLog):
+                if close:
+                    log.close()
+                else:
+                    log.flush()
+
     @staticmethod
     def choose_yes_or_no(message):
         """
@@ -623,6 +633,11 @@ class FRExperimentRunner:
         """
         if state not in self.config.state_list:
             raise Exception('Improper state %s not in list of states' % state)
+        if self.config.control_pc and meta is None:
+            message = self._message_templates.state_message(state, value, timing.now())
+            if message:
+                control_events.put_message(message)
+                return
         self._send_event('STATE', state=state, value=value, meta=meta)
 
     def _send_trial_message(self, trial_num):
@@ -634,14 +649,25 @@ class FRExperimentRunner:
 
     def _send_event(self, type, *args, **kwargs):
         """
-        Sends an arbitrary event
-        :param args: Inputs to RAMControl.sendEvent()
+        Queues an arbitrary event to be sent, timestamped now
+        :param args: Inputs to RAMControl.build_message()
         """
         if 'timestamp' not in kwargs:
             kwargs['timestamp'] = timing.now()
 
         if self.config.control_pc:
-            ram_control.send(ram_control.build_message(type, *args, **kwargs))
+            control_events.put(type, *args, **kwargs)
+            if type == 'EXIT':
+                control_events.flush()
+
+    def _send_math_message(self, *args, **kwargs):
+        """
+        Queues a math distractor message, in order with the other events.
+        The message is built and timestamped now, not when the queue reaches it
+        :param args: Inputs to RAMControl.build_message() for a MATH message
+        """
+        if self.config.control_pc:
+            control_events.put_message(ram_control.build_message('MATH', *args, timestamp=timing.now(), **kwargs))
 
     def _show_message_from_file(self, filename):
         """
@@ -668,35 +694,51 @@ class FRExperimentRunner:
         self._send_state_message('PRACTICE', False)
 
         # Log in state that list has been run
-        state.practiceDone = True
-        self.fr_experiment.exp.saveState(state)
+        self.fr_experiment.state_manager.record_progress(practiceDone=True)
 
         # Show a message afterwards
         self._show_message_from_file(self.config.post_practiceList % state.LANG)
 
-    def play_whole_movie(self, movie_file):
+    def play_whole_movie(self, movie_file, while_playing=None):
         """
         Plays any movie file, centered on the screen.
+        :param while_playing: (optional) function to run once the movie has started
         """
         movie_object = Movie(movie_file)
         movie_shown = self.video.showCentered(movie_object)
         self.video.playMovie(movie_object)
+        if while_playing:
+            while_playing()
         self.clock.delay(movie_object.getTotalTime())
         self.clock.wait()
         self.video.stopMovie(movie_object)
         self.video.unshow(movie_shown)
 
-    def _countdown(self):
+    def _countdown(self, upcoming_words=()):
         """
         Shows the 'countdown' video, centered.
+        :param upcoming_words: (optional) words of the next list, rendered while the video plays
         """
         self.video.clear('black')
         self._send_state_message('COUNTDOWN', True)
         self.log_message('COUNTDOWN_START')
-        self.play_whole_movie(self.config.countdownMovie)
+        self.play_whole_movie(self.config.countdownMovie,
+                              while_playing=lambda: self._render_ahead(upcoming_words))
         self._send_state_message('COUNTDOWN', False)
         self.log_message('COUNTDOWN_END')
 
+    def _render_ahead(self, words):
+        """
+        Renders the words, orient and recall texts of the next list
+        """
+        size = self.config.wordHeight
+        # Practice words aren't in the pool; make their forms now rather than while presenting
+        for word in words:
+            self.fr_experiment.wp_index.forms(word)
+        self._texts.prepare([(CustomText, word, size) for word in words] +
+                            [(Text, self.config.orientText, size),
+                             (Text, self.config.recallStartText, size)])
+
     def _on_orient_update(self, *args):
         if self._on_screen:
             self._send_state_message('ORIENT', True)
@@ -719,8 +761,10 @@ class FRExperimentRunner:
 
         if is_practice:
             list_type = 'PRACTICE_'
+            self._trial = -1
         else:
             list_type = ''
+            self._trial = state.trialNum + 1
 
         if not self.config.fastConfig:
             if not is_practice:
@@ -748,21 +792,29 @@ class FRExperimentRunner:
 
         # Countdown to start...
 
-        self._countdown()
+        self._countdown(word_list)
 
         # Display the "cross-hairs" and log
 
         self._state_name = 'STIM ENCODING' if is_stim else 'NON-STIM ENCODING'
 
+        # Recordings are processed between encoding periods
+        if self._recordings:
+            self._recordings.hold()
+
         self._on_screen = True
         on_update = self._on_orient_update
         self.video.addUpdateCallback(on_update)
         cbref = self.video.update_callbacks[-1]
-        timestamp_on, timestamp_off = flashStimulusWithOffscreenTimestamp(Text(self.config.orientText,
-                                                                               size=self.config.wordHeight),
+        scheduled_on = self.clock.get()
+        timestamp_on, timestamp_off = flashStimulusWithOffscreenTimestamp(self._texts.get(Text,
+                                                                                          self.config.orientText,
+                                                                                          self.config.wordHeight),
                                                                           clk=self.clock,
                                                                           duration=self.config.wordDuration
                                                                           )
+        self.timer.record('ORIENT', scheduled_on, timestamp_on, self.config.wordDuration, timestamp_off,
+                          trial=self._trial)
         self.log_message('%sORIENT' % list_type, timestamp_on)
         self.log_message('%sORIENT_OFF' % list_type, timestamp_off)
         # Delay before words
@@ -779,6 +831,12 @@ class FRExperimentRunner:
         self._present_word(word_list[-1], len(word_list)-1, is_stim, is_practice,
                            offscreen_callback=lambda *args: self._send_state_message(self._state_name, False))
 
+        if self._recordings:
+            self._recordings.release()
+
+        # Write out the list's log entries now that no word is on the screen
+        self._flush_logs()
+
         if self.config.doMathDistract and \
                 not self.config.continuousDistract and \
                 not self.config.fastConfig:
@@ -807,18 +865,22 @@ class FRExperimentRunner:
         # Delay before recall
         self.clock.delay(self.config.PauseBeforeRecall,
                          jitter=self.config.JitterBeforeRecall)
+        scheduled_on = self.clock.get()
         # Show the recall start indicator
-        start_text = self.video.showCentered(Text(self.config.recallStartText,
-                                                  size=self.config.wordHeight))
+        start_text = self.video.showCentered(self._texts.get(Text, self.config.recallStartText,
+                                                             self.config.wordHeight))
 
         timestamp = self.video.updateScreen(self.clock)
+        self.timer.record('RETRIEVAL_ORIENT', scheduled_on, timestamp, trial=self._trial)
 
         # Remove the callback now that the word has been shown
         self.video.removeUpdateCallback(cbref)
         self.log_message('RETRIEVAL_ORIENT', timestamp)
 
         # Present beep
-        self.start_beep.present(self.clock)
+        scheduled_on = self.clock.get()
+        beep_timestamp = self.start_beep.present(self.clock)
+        self.timer.record('START_BEEP', scheduled_on, beep_timestamp, trial=self._trial)
 
         # Hide rec start text
         self.video.unshow(start_text)
@@ -836,20 +898,41 @@ class FRExperimentRunner:
         prefix = 'PRACTICE_' if is_practice else ''
         label = str(state.trialNum) if not is_practice else 'p'
 
+        # Log entries are written while recording
+        self._flush_logs()
+
         # Record responses
+        scheduled_on = self.clock.get()
         (rec, timestamp) = self.audio.record(self.config.recallDuration,
                                              label,
                                              t=self.clock,
                                              startCallback=lambda *args: self._send_state_message('RETRIEVAL', True))
 
+        self.timer.record('REC_START', scheduled_on, timestamp, trial=self._trial)
+        if self._recordings:
+            self._recordings.submit(os.path.join(self.fr_experiment.exp.session.fullPath(), label + '.wav'),
+                                    timestamp_time(timestamp), self._trial)
+
         # Ending beep
+        scheduled_on = self.clock.get()
         end_timestamp = self.stop_beep.present(self.clock,
                                                onCallback=lambda *args: self._send_state_message('RETRIEVAL', False))
+        self.timer.record('STOP_BEEP', scheduled_on, end_timestamp, trial=self._trial)
 
         # Log start and end of recall
         self.log_message('%sREC_START' % prefix, timestamp)
         self.log_message('%sREC_END' % prefix, end_timestamp)
 
+    def _detect_vocalizations(self, path, rec_start, trial):
+        """
+        Finds candidate vocalization onsets in a finished recording (runs on the recording worker)
+        :param path: path of the recording
+        :param rec_start: time of REC_START
+        :param trial: list number, -1 for practice
+        """
+        onsets = vad.detect_file(path)
+        vad.write_onsets(path, onsets, rec_start)
+
     def _on_word_update(self, *args):
         self._send_state_message('WORD', self._on_screen)
         if self._offscreen_callback and not self._on_screen:
@@ -866,8 +949,8 @@ class FRExperimentRunner:
         """
         self._offscreen_callback = offscreen_callback
 
-        # Get the text to present
-        word_text = CustomText(word, size=self.config.wordHeight)
+        # Get the text to present, rendered during the countdown
+        word_text = self._texts.get(CustomText, word, self.config.wordHeight)
 
         # Delay for a moment
         self.clock.delay(self.config.ISI, self.config.Jitter)
@@ -877,18 +960,24 @@ class FRExperimentRunner:
 
         # Send that we're about to display the word
         # Present the word
+        scheduled_on = self.clock.get()
         timestamp_on, timestamp_off = word_text.presentWithCallback(clk=self.clock,
                                                                     duration=self.config.wordDuration,
                                                                     updateCallback=self._on_word_update)
+        self.timer.record('WORD', scheduled_on, timestamp_on, self.config.wordDuration, timestamp_off,
+                          trial=self._trial, index=word_i)
         # Log that we showed the word
-        ram_control.send(WordMessage(word))
+        if self.config.control_pc:
+            control_events.put_message(self._message_templates.word_message(word, timing.now()) or
+                                       WordMessage(word))
+        forms = self.fr_experiment.wp_index.forms(word)
         if not is_practice:
             self.log_message(u'WORD\t%s\t%s\t%d\t%s' %
-                             ('text', Utils.remove_accents(word), word_i, 'STIM' if is_stim else 'NO_STIM'),
+                             ('text', forms.no_accents, word_i, 'STIM' if is_stim else 'NO_STIM'),
                              timestamp_on)
             self.log_message(u'WORD_OFF', timestamp_off)
         else:
-            self.log_message((u'PRACTICE_WORD\t%s' % word).encode('utf-8'), timestamp_on)
+            self.log_message('PRACTICE_WORD\t%s' % forms.utf8, timestamp_on)
             self.log_message(u'PRACTICE_WORD_OFF', timestamp_off)
 
         if self.config.continuousDistract:
@@ -909,7 +998,8 @@ class FRExperimentRunner:
                            plusAndMinus=self.config.MATH_plusAndMinus,
                            minDuration=self.config.MATH_minDuration,
                            textSize=self.config.MATH_textSize,
-                           callback=ram_control.send_math_message)
+                           callback=self._send_math_message,
+                           **self._math_beeps)
 
         self._send_state_message('DISTRACT', False)
         self.log_message('DISTRACT_END')
@@ -929,11 +1019,10 @@ class FRExperimentRunner:
                 ).present(self.clock, bc=bc)
             if 'AND' in button.name:
                 self.log_message('SESSION_SKIPPED', timestamp)
-                state.sessionNum += 1
-                state.trialNum = 0
-                state.practiceDone = False
-                state.session_started = False
-                self.fr_experiment.exp.saveState(state)
+                self.fr_experiment.state_manager.save(sessionNum=state.sessionNum + 1,
+                                                      trialNum=0,
+                                                      practiceDone=False,
+                                                      session_started=False)
                 waitForAnyKey(self.clock, Text('Session skipped\nRestart RAM_%s to run next session' %
                                                self.config.experiment))
                 return True
@@ -942,30 +1031,44 @@ class FRExperimentRunner:
     def resync_callback(self):
         flashStimulus(Text("Syncing..."), 500)
 
+    def _align_clocks(self, show_syncing):
+        # Don't let queued events interleave with the sync messages
+        control_events.flush()
+        if show_syncing:
+            ram_control.align_clocks(callback=self.resync_callback)
+        else:
+            ram_control.align_clocks()
+
     def _resynchronize(self, show_syncing):
         """
         Performs a resynchronization (christian's algorithm)
-        (to be run before each list)
+        Skipped if the background clock estimate is recent and good enough
+        Skipped if the background clock estimate is good enough
         """
-        if self.config.control_pc:
-            if show_syncing:
-                ram_control.align_clocks(callback=self.resync_callback)
-            else:
-                ram_control.align_clocks()
+        if not self.config.control_pc:
+            return
+        if clock_sync is None:
+            self._align_clocks(show_syncing)
+            self._sync_checks.append((self._trial, True, None))
+        elif clock_sync.is_aligned(self.config.maxSyncResidual):
+            self._sync_checks.append((self._trial, False, clock_sync.model))
+        else:
+            with clock_sync.lock:
+                self._align_clocks(show_syncing)
+            self._sync_checks.append((self._trial, True, clock_sync.model))
 
     def _run_all_lists(self, state):
         """
         Runs all of the lists in the given session, read from state
         :param state: State object
         """
-        lists = state.sessionLists[state.sessionNum]
-        is_stims = state.sessionStim[state.sessionNum]
-        while state.trialNum < len(lists):
-            this_list = lists[state.trialNum]
-            is_stim = is_stims[state.trialNum]
-            self._run_list([word.name for word in this_list], state, is_stim)
+        fr_experiment = self.fr_experiment
+        while state.trialNum < fr_experiment.get_num_lists(state, state.sessionNum):
+            this_list = fr_experiment.get_list_words(state, state.sessionNum, state.trialNum)
+            is_stim = fr_experiment.get_list_is_stim(state, state.sessionNum, state.trialNum)
+            self._run_list(this_list, state, is_stim)
             state.trialNum += 1
-            self.fr_experiment.exp.saveState(state)
+            self.fr_experiment.state_manager.record_progress()
             self._resynchronize(True)
 
     def run_session(self, keyboard):
@@ -974,6 +1077,9 @@ class FRExperimentRunner:
         """
         config = self.config
 
+        # Serialize this session's state messages up front
+        self._message_templates.prepare(config.state_list)
+
         self._send_state_message('INSTRUCT', True)
         self.log_message('INSTRUCT_VIDEO\tON')
         playIntro.playIntro(self.fr_experiment.exp, self.video, keyboard, True, config.LANGUAGE)
@@ -986,7 +1092,7 @@ class FRExperimentRunner:
             setRealtime(config.rtPeriod, config.rtComputation, config.rtConstraint)
 
         # Get the state object
-        state = self.fr_experiment.exp.restoreState()
+        state = self.fr_experiment.state_manager.get()
 
         # Return if out of sessions
         if self.is_out_of_sessions(state):
@@ -1027,31 +1133,37 @@ class FRExperimentRunner:
             self._resynchronize(False)
             self._run_practice_list(state)
             self._resynchronize(True)
-            state = self.fr_experiment.exp.restoreState()
-        
-        self.fr_experiment.exp.saveState(state, session_started=True)
-        state = self.fr_experiment.exp.restoreState()
+
+        self.fr_experiment.state_manager.record_progress(session_started=True)
 
         self._run_all_lists(state)
 
-        self.fr_experiment.exp.saveState(state,
-                                         trialNum=0,
-                                         session_started=False,
-                                         sessionNum=state.sessionNum+1,
-                                         practiceDone=False)
+        if self._recordings:
+            self._recordings.stop()
+
+        # Scheduled vs. actual presentation times for the session
+        self.timer.write(self.fr_experiment.exp.session)
+        if self._sync_checks:
+            clocksync.write_checks(self.fr_experiment.exp.session, self._sync_checks)
+
+        # Fold the session's progress back into the snapshot
+        self.fr_experiment.state_manager.save(trialNum=0,
+                                              session_started=False,
+                                              sessionNum=state.sessionNum+1,
+                                              practiceDone=False)
 
         timestamp = waitForAnyKey(self.clock, Text('Thank you!\nYou have completed the session.'))
         self.log_message('SESS_END', timestamp)
+        self._flush_logs(close=True)
         self._send_event('EXIT')
 
         self.clock.wait()
 
-    @staticmethod
-    def is_out_of_sessions(state):
+    def is_out_of_sessions(self, state):
         """
         :return: true if all sessions have been run, False otherwise
         """
-        return state.sessionNum >= len(state.sessionLists)
+        return state.sessionNum >= self.fr_experiment.get_num_sessions(state)
 
 
 def cleanupRAMControl():
@@ -1059,6 +1171,11 @@ def cleanupRAMControl():
     Cleanup anything related to the Control PC
     Close connections, terminate threads.
     """
+    if clock_sync:
+        clock_sync.stop()
+    if control_events.stop():
+        print 'Control PC events: %(sent)d sent, %(dropped)d dropped, max queue depth %(max_depth)d' % \
+            control_events.stats()
 
 
 def exit(num):
@@ -1075,6 +1192,7 @@ def connect_to_control_pc(subject, session, config):
     """
     establish connection to control PC
     """
+    global clock_sync
     if not config.control_pc:
         return
     video = VideoTrack.lastInstance()
@@ -1091,6 +1209,11 @@ def connect_to_control_pc(subject, session, config):
     cb = lambda: flashStimulus(Text("Waiting for start from control PC..."))
     ram_control.wait_for_start_message(poll_callback=cb)
 
+    # Sample the control PC clock through the session so lists don't have to wait for a resync
+    probe = clocksync.sync_probe(ram_control)
+    if config.backgroundSync and probe and clock_sync is None:
+        clock_sync = clocksync.ClockDriftEstimator(probe, config.syncProbeInterval).start()
+
 
 def run():
     """
@@ -1111,8 +1234,10 @@ def run():
     # Get config
     config = exp.getConfig()
 
-    if exp.restoreState():
-        session = exp.restoreState().sessionNum
+    # The state is read from disk once here and served from memory afterwards
+    state_manager = StateManager(exp)
+    if state_manager.get():
+        session = state_manager.get().sessionNum
     else:
         session = 0
 
@@ -1125,15 +1250,20 @@ def run():
     clock = PresentationClock()
 
 
-    fr_experiment = FRExperiment(exp, config, video, clock)
+    fr_experiment = FRExperiment(exp, config, video, clock, state_manager)
 
     if not fr_experiment.is_experiment_started():
         state = fr_experiment.init_experiment()
     else:
-        state = exp.restoreState()
+        state = state_manager.get()
 
     log = LogTrack('session')
     mathlog = LogTrack('math')
+    if config.bufferedLogs:
+        log = logsink.BufferedLog(log, os.path.join(exp.session.fullPath(), 'session.jsonl'),
+                                  config.logFsync, timing.now)
+        mathlog = logsink.BufferedLog(mathlog, os.path.join(exp.session.fullPath(), 'math.jsonl'),
+                                      config.logFsync, timing.now)
     audio = CustomAudioTrack('audio')
     keyboard = KeyTrack('keyboard')
 
@@ -1154,4 +1284,7 @@ def run():
 
 
 if __name__ == "__main__":
-    run()
+    try:
+        run()
+    finally:
+        cleanupRAMControl()
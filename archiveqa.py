@@ -0,0 +1,259 @@
+"""
+Quality checks over every session of an experiment archive.
+
+Summarizes each session folder FR.py writes (<archive>/<subject>/session_<n>/):
+whether it was started, completed or skipped (SESSION_SKIPPED), how many of
+its planned lists (.lst files) were run and how many were stim or nonstim,
+recordings and math problems, and word presentation timing by serial
+position (duration on screen and onset-to-onset interval).
+
+Subjects are split across a process pool. Session summaries are kept in
+<archive>/.qa_cache.json keyed by a hash of the session's logs and of the
+names and sizes of its list and recording files, so sessions where none of
+those changed are not parsed again. Timing is kept as sums so subject and
+cohort summaries are exact totals of the session summaries.
+
+    python archiveqa.py <archive> [--processes N] [--output <folder>]
+
+Writes qa_sessions.tsv, qa_subjects.tsv and qa_serialpos.tsv to the output
+folder (default: the archive).
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+import eventindex
+
+CACHE_FILE = '.qa_cache.json'
+CACHE_VERSION = 1
+
+SESSION_FIELDS = ('started', 'completed', 'skipped', 'lists_planned', 'lists_run', 'stim_lists',
+                  'nonstim_lists', 'words', 'recordings', 'math_problems', 'math_correct')
+
+# Per serial position: words, duration sum, duration sum of squares, intervals, interval sum
+_TIMING_FIELDS = ('n', 'duration', 'duration_sq', 'n_soa', 'soa')
+
+_LIST_FILE = re.compile(r'^\d+\.lst$')
+_RECORDING_FILE = re.compile(r'^\d+\.wav(\.gz)?$')
+
+
+def session_hash(session_dir):
+    """
+    :return: hash of the contents of the session's logs and of the names and sizes of its list and recording files
+    """
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(session_dir)):
+        if _LIST_FILE.match(name) or _RECORDING_FILE.match(name):
+            digest.update('%s\t%d\n' % (name, os.path.getsize(os.path.join(session_dir, name))))
+    for log_name in eventindex.LOGS:
+        path = os.path.join(session_dir, log_name)
+        if not os.path.exists(path):
+            continue
+        digest.update(log_name)
+        with open(path, 'rb') as log:
+            for chunk in iter(lambda: log.read(1 << 20), ''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def summarize_session(session_dir, session_num):
+    """
+    :return: {field: count for SESSION_FIELDS, 'timing': {field: [value per serial position]}}
+    """
+    types = eventindex._Vocabulary()
+    events = eventindex.parse_session(session_dir, session_num, 0, types, eventindex._Vocabulary())
+    in_session = events['log'] == 0
+
+    def where(event_type):
+        return np.flatnonzero(in_session & (events['type'] == types.codes.get(event_type, -1)))
+
+    files = os.listdir(session_dir)
+    trials = where('TRIAL')
+    summary = {'started': int(len(where('SESS_START')) > 0),
+               'completed': int(len(where('SESS_END')) > 0),
+               'skipped': int(len(where('SESSION_SKIPPED')) > 0),
+               'lists_planned': len([name for name in files if _LIST_FILE.match(name)]),
+               'lists_run': len(trials),
+               'stim_lists': int(np.sum(events['stim'][trials] == 1)),
+               'nonstim_lists': int(np.sum(events['stim'][trials] == 0)),
+               'words': len(where('WORD')),
+               'recordings': len([name for name in files if _RECORDING_FILE.match(name)]),
+               'math_problems': int(np.sum(events['type'][~in_session] == types.codes.get('PROB', -1))),
+               'math_correct': int(np.sum(events['correct'][~in_session] == 1))}
+
+    # Duration: from each word to the next WORD_OFF. Interval: from the previous word of the same list
+    words = where('WORD')
+    offs = where('WORD_OFF')
+    n_positions = int(events['serialpos'][words].max()) + 1 if len(words) else 0
+    timing = dict((field, np.zeros(n_positions)) for field in _TIMING_FIELDS)
+    if len(words):
+        positions = events['serialpos'][words]
+        onsets = events['mstime'][words].astype(np.float64)
+        off_i = np.searchsorted(offs, words)
+        has_off = off_i < len(offs)
+        durations = events['mstime'][offs[off_i[has_off]]] - onsets[has_off]
+        np.add.at(timing['n'], positions[has_off], 1)
+        np.add.at(timing['duration'], positions[has_off], durations)
+        np.add.at(timing['duration_sq'], positions[has_off], durations ** 2)
+        follows = (positions[1:] == positions[:-1] + 1) & \
+                  (events['trial'][words][1:] == events['trial'][words][:-1])
+        np.add.at(timing['n_soa'], positions[1:][follows], 1)
+        np.add.at(timing['soa'], positions[1:][follows], np.diff(onsets)[follows])
+    summary['timing'] = dict((field, values.tolist()) for (field, values) in timing.items())
+    return summary
+
+
+def _add_timing(total, timing):
+    for field in _TIMING_FIELDS:
+        values = total.setdefault(field, [])
+        values.extend([0.] * (len(timing[field]) - len(values)))
+        for (i, value) in enumerate(timing[field]):
+            values[i] += value
+
+
+def combine(summaries):
+    """
+    Adds up session (or subject) summaries
+    :return: summary of the same form, with 'sessions' counted
+    """
+    total = dict((field, 0) for field in SESSION_FIELDS)
+    total['sessions'] = 0
+    total['timing'] = {}
+    for summary in summaries:
+        for field in SESSION_FIELDS:
+            total[field] += summary[field]
+        total['sessions'] += summary.get('sessions', 1)
+        _add_timing(total['timing'], summary['timing'])
+    return total
+
+
+def _summarize_subject(args):
+    """
+    Pool worker: summarizes the sessions of one subject, reusing cached summaries
+    :param args: (subject, [(session number, session folder)], {session key: cache entry})
+    :return: (subject, {session key: cache entry}, number of sessions parsed)
+    """
+    (subject, sessions, cached) = args
+    entries = {}
+    n_parsed = 0
+    for (session_num, session_dir) in sessions:
+        key = '%s/%d' % (subject, session_num)
+        content_hash = session_hash(session_dir)
+        if key in cached and cached[key]['hash'] == content_hash:
+            entries[key] = cached[key]
+            continue
+        try:
+            entries[key] = {'hash': content_hash, 'summary': summarize_session(session_dir, session_num)}
+            n_parsed += 1
+        except Exception as e:
+            print 'WARNING: could not summarize %s: %s' % (session_dir, e)
+    return subject, entries, n_parsed
+
+
+def _load_cache(path):
+    if os.path.exists(path):
+        try:
+            cache = json.load(open(path))
+            if cache.get('version') == CACHE_VERSION:
+                return cache['sessions']
+        except ValueError:
+            print 'WARNING: ignoring unreadable QA cache %s' % path
+    return {}
+
+
+def _save_cache(path, sessions):
+    tmp_path = path + '.tmp'
+    json.dump({'version': CACHE_VERSION, 'sessions': sessions}, open(tmp_path, 'w'))
+    os.rename(tmp_path, path)
+
+
+def run_qa(archive, processes=None):
+    """
+    Summarizes every session of an archive
+    :param archive: folder with a subfolder per subject
+    :param processes: (optional) size of the process pool, default one per CPU
+    :return: ({session key: session summary}, {subject: subject summary}, cohort summary, sessions parsed)
+    """
+    cache_path = os.path.join(archive, CACHE_FILE)
+    cache = _load_cache(cache_path)
+    by_subject = {}
+    for (subject, session_num, session_dir) in eventindex.find_sessions(archive):
+        by_subject.setdefault(subject, []).append((session_num, session_dir))
+    tasks = [(subject, sessions,
+              dict((key, entry) for (key, entry) in cache.items() if key.rsplit('/', 1)[0] == subject))
+             for (subject, sessions) in sorted(by_subject.items(), key=lambda (_, sessions): -len(sessions))]
+
+    entries = {}
+    n_parsed = 0
+    if processes == 1 or len(tasks) < 2:
+        results = map(_summarize_subject, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_summarize_subject, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for (_, subject_entries, subject_parsed) in results:
+        entries.update(subject_entries)
+        n_parsed += subject_parsed
+    _save_cache(cache_path, entries)
+
+    sessions = dict((key, entry['summary']) for (key, entry) in entries.items())
+    subjects = {}
+    for subject in by_subject:
+        subjects[subject] = combine([summary for (key, summary) in sessions.items()
+                                     if key.rsplit('/', 1)[0] == subject])
+    return sessions, subjects, combine(subjects.values()), n_parsed
+
+
+def _timing_stats(timing, i):
+    n = timing['n'][i]
+    mean = timing['duration'][i] / n if n else float('nan')
+    sd = np.sqrt(max(timing['duration_sq'][i] / n - mean ** 2, 0)) if n else float('nan')
+    soa = timing['soa'][i] / timing['n_soa'][i] if timing['n_soa'][i] else float('nan')
+    return int(n), mean, sd, soa
+
+
+def write_reports(output_dir, sessions, subjects, cohort):
+    """
+    Writes qa_sessions.tsv, qa_subjects.tsv and qa_serialpos.tsv
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'qa_sessions.tsv'), 'w') as out:
+        out.write('subject\tsession\t%s\n' % '\t'.join(SESSION_FIELDS))
+        for key in sorted(sessions, key=lambda key: (key.rsplit('/', 1)[0], int(key.rsplit('/', 1)[1]))):
+            out.write('%s\t%s\t%s\n' % (tuple(key.rsplit('/', 1)) +
+                                        ('\t'.join(str(sessions[key][field]) for field in SESSION_FIELDS), )))
+    with open(os.path.join(output_dir, 'qa_subjects.tsv'), 'w') as out:
+        out.write('subject\tsessions\t%s\n' % '\t'.join(SESSION_FIELDS))
+        for (subject, summary) in sorted(subjects.items()) + [('ALL', cohort)]:
+            out.write('%s\t%d\t%s\n' % (subject, summary['sessions'],
+                                        '\t'.join(str(summary[field]) for field in SESSION_FIELDS)))
+    with open(os.path.join(output_dir, 'qa_serialpos.tsv'), 'w') as out:
+        out.write('subject\tserialpos\tn\tduration_mean\tduration_sd\tsoa_mean\n')
+        for (subject, summary) in sorted(subjects.items()) + [('ALL', cohort)]:
+            for i in range(len(summary['timing'].get('n', []))):
+                out.write('%s\t%d\t%d\t%.1f\t%.1f\t%.1f\n' % ((subject, i) + _timing_stats(summary['timing'], i)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize every session of an experiment archive')
+    parser.add_argument('archive', help='e.g. ./data/FR1')
+    parser.add_argument('--processes', type=int, help='size of the process pool (default: one per CPU)')
+    parser.add_argument('--output', help='folder for the reports (default: the archive)')
+    args = parser.parse_args()
+    (sessions, subjects, cohort, n_parsed) = run_qa(args.archive, args.processes)
+    write_reports(args.output or args.archive, sessions, subjects, cohort)
+    print '%d sessions of %d subjects (%d parsed, %d from cache)' % (
+        len(sessions), len(subjects), n_parsed, len(sessions) - n_parsed)
+    print 'Completed %d, skipped %d; %d of %d planned lists run (%d stim, %d nonstim)' % (
+        cohort['completed'], cohort['skipped'], cohort['lists_run'], cohort['lists_planned'],
+        cohort['stim_lists'], cohort['nonstim_lists'])
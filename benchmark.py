@@ -0,0 +1,206 @@
+"""
+Runs complete FR sessions on the headless backend and reports where the time goes.
+
+No display, audio or Control PC is needed: headless.py stands in for PyEPL and
+RAMControl, and its clock is virtual, so waits return immediately and the
+times reported are the cost of the experiment code itself.
+
+    python benchmark.py [--experiment FR1|FR3] [--sessions N] [--fast] [--control-pc] [--compress] [--vad] [--keep]
+
+With --control-pc, Control PC messages go over loopback to a simulated
+Control PC (controlpcsim.py) instead of being collected in memory, and the
+clock is aligned by the background estimator (backgroundSync), which needs the
+simulator's sync probe.
+
+Phases are timed around the methods that run them. Phases can nest
+(init includes its state save), and CPU time is for the whole process,
+including the Control PC sender thread.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import headless
+
+# (phase, class name, method name)
+PHASES = (('init', 'FRExperiment', 'init_experiment'),
+          ('countdown', 'FRExperimentRunner', '_countdown'),
+          ('encoding', 'FRExperimentRunner', '_present_word'),
+          ('distractor', 'FRExperimentRunner', '_do_distractor'),
+          ('recall', 'FRExperimentRunner', '_run_recall'),
+          ('state saves', 'StateManager', 'save'),
+          ('state saves', 'StateManager', 'record_progress'))
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class PhaseTimer:
+
+    def __init__(self):
+        # {phase: [calls, wall seconds, cpu seconds]}
+        self.totals = {}
+
+    def wrap(self, cls, method_name, phase):
+        """
+        Replaces a method of a class with one that adds its run time to the phase
+        """
+        method = getattr(cls, method_name)
+        totals = self.totals.setdefault(phase, [0, 0., 0.])
+
+        def timed(*args, **kwargs):
+            wall, cpu = time.time(), _cpu_time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                totals[0] += 1
+                totals[1] += time.time() - wall
+                totals[2] += _cpu_time() - cpu
+        setattr(cls, method_name, timed)
+
+    def report(self):
+        lines = ['%-12s %8s %10s %10s' % ('phase', 'calls', 'wall ms', 'cpu ms')]
+        for phase in [phase for (i, (phase, _, _)) in enumerate(PHASES)
+                      if phase not in [p for (p, _, _) in PHASES[:i]]]:
+            (calls, wall, cpu) = self.totals[phase]
+            lines.append('%-12s %8d %10.1f %10.1f' % (phase, calls, wall * 1000, cpu * 1000))
+        return '\n'.join(lines)
+
+
+def _room_noise(duration):
+    """
+    :return: a recording of quiet noise, as 16 bit samples at 44.1 kHz
+    """
+    import numpy as np
+    return (np.random.randn(int(duration * 44.1)) * 200).astype('<i2').tostring()
+
+
+def _track_instances(cls):
+    """
+    :return: list that every instance of the class created from now on is added to
+    """
+    instances = []
+    init = cls.__init__
+
+    def tracking_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        instances.append(self)
+    cls.__init__ = tracking_init
+    return instances
+
+
+def _total_stats(objects):
+    totals = {}
+    for obj in objects:
+        for (name, value) in obj.stats().items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def run_benchmark(experiment='FR1', n_sessions=1, fast=False, archive=None, subject='BENCH001',
+                  control_pc=False, compress=False, detect_vocalizations=False):
+    """
+    Runs sessions of an experiment back to back on the headless backend
+    :param experiment: 'FR1', 'FR3', ... (selects <experiment>_config.py)
+    :param n_sessions: number of sessions to run
+    :param fast: run with fastConfig, which skips the key waits and the distractor
+    :param archive: folder to write the data to
+    :param control_pc: send Control PC messages to a loopback simulator
+    :param compress: compress recordings in the background
+    :param detect_vocalizations: detect vocalization onsets in the recordings
+    :return: text of the report
+    """
+    simulator = None
+    if control_pc:
+        from controlpcsim import ControlPCSimulator
+        simulator = ControlPCSimulator().start()
+    headless.install(subject=subject,
+                     config='config.py',
+                     sconfig='%s_config.py' % experiment,
+                     archive=archive,
+                     overrides=dict([('fastConfig', True)] if fast else [],
+                                    backgroundSync=control_pc,
+                                    compressRecordings=compress,
+                                    detectVocalizations=detect_vocalizations),
+                     recording=_room_noise if compress or detect_vocalizations else None,
+                     control_pc_address=simulator and simulator.address)
+    import FR
+    import statejournal
+
+    classes = {'FRExperiment': FR.FRExperiment,
+               'FRExperimentRunner': FR.FRExperimentRunner,
+               'StateManager': statejournal.StateManager}
+    timer = PhaseTimer()
+    for (phase, class_name, method_name) in PHASES:
+        timer.wrap(classes[class_name], method_name, phase)
+
+    state_managers = _track_instances(statejournal.StateManager)
+    runners = _track_instances(FR.FRExperimentRunner)
+
+    wall, cpu, virtual = time.time(), _cpu_time(), headless.now()
+    for _ in range(n_sessions):
+        FR.run()
+    if FR.clock_sync:
+        FR.clock_sync.stop()
+    FR.control_events.stop()
+    wall, cpu, virtual = time.time() - wall, _cpu_time() - cpu, headless.now() - virtual
+
+    lines = ['%s, %d session(s)%s' % (experiment, n_sessions, ', fastConfig' if fast else ''),
+             '',
+             timer.report(),
+             '%-12s %8s %10.1f %10.1f' % ('total', '', wall * 1000, cpu * 1000),
+             '',
+             'Virtual session time: %.1f min' % (virtual / 60000.)]
+    for (i, state_manager) in enumerate(state_managers):
+        lines.append('State (run %d): ' % (i + 1) +
+                     '%(loads)d loads, %(saves)d saves, %(journal_appends)d journal appends' % state_manager.stats())
+    lines.append('Control PC events: %(sent)d sent, %(dropped)d dropped, max queue depth %(max_depth)d'
+                 % FR.control_events.stats())
+    lines.append('Texts: %(rendered)d rendered, %(hits)d presented pre-rendered, %(misses)d rendered late'
+                 % _total_stats([runner._texts for runner in runners]))
+    lines.append('Tones: %(synthesized)d synthesized, %(loaded)d loaded from cache'
+                 % _total_stats([runner._tones for runner in runners]))
+    if compress or detect_vocalizations:
+        lines.append('Recordings: %(processed)d processed, %(bytes_in)d -> %(bytes_out)d bytes, %(errors)d errors'
+                     % _total_stats([runner._recordings for runner in runners]))
+    if simulator:
+        types = sorted(set(message['type'] for (_, message) in simulator.messages()))
+        lines.append('Received by the Control PC: ' +
+                     ', '.join('%d %s' % (len(simulator.messages(msg_type)), msg_type) for msg_type in types))
+        simulator.write_log(os.path.join(archive, 'control_pc.log'))
+        simulator.stop()
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark FR sessions without display or audio')
+    parser.add_argument('--experiment', default='FR1', help='FR1, FR3, ...')
+    parser.add_argument('--sessions', type=int, default=1, help='number of sessions to run')
+    parser.add_argument('--fast', action='store_true', help='run with fastConfig')
+    parser.add_argument('--control-pc', action='store_true', help='send messages to a simulated Control PC')
+    parser.add_argument('--compress', action='store_true', help='compress recordings in the background')
+    parser.add_argument('--vad', action='store_true', help='detect vocalization onsets in the recordings')
+    parser.add_argument('--archive', help='data folder (default: a temporary folder)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary data folder')
+    args = parser.parse_args()
+
+    # Config paths are relative to the experiment folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    archive = args.archive or tempfile.mkdtemp(prefix='fr_benchmark_')
+    try:
+        print run_benchmark(args.experiment, args.sessions, args.fast, archive,
+                            control_pc=args.control_pc, compress=args.compress,
+                            detect_vocalizations=args.vad)
+    finally:
+        if args.archive is None:
+            if args.keep:
+                print 'Data kept in %s' % archive
+            else:
+                shutil.rmtree(archive)
+    sys.exit(0)
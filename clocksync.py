@@ -0,0 +1,211 @@
+"""
+Continuous estimate of the Control PC clock.
+
+Instead of a blocking align_clocks() before every list, a background thread
+sends a SYNC every few hundred ms and fits the Control PC clock as
+    remote = local + offset + drift * (local - t0)
+by robust regression: only the fastest round trips (least queueing) are used,
+and the line is a Theil-Sen fit (median of pairwise slopes, over pairs half
+the window apart once there are too many samples to pair them all), so a few
+delayed replies do not pull it. Reading the fit is a single attribute read, so the
+experiment can check alignment before a list without waiting. A fit only counts
+while it is recent (a few probe intervals old at most) and the latest probe
+succeeded; otherwise the list waits for align_clocks() as before. The probes
+are SYNC exchanges like those of align_clocks(), so the Control PC keeps
+receiving them while the blocking alignments are skipped.
+
+The probe is any function returning (local send time, remote time, local
+receive time) in ms for one round trip. sync_probe() gets one from a
+RAMControl object that provides it. Only controlpcsim.LoopbackRAMControl does
+so far: ramcontrol's RAMControl doesn't expose the remote time of its SYNC
+exchange, so with the real Control PC there is no estimator and every list
+waits for align_clocks(). The fit is only used to skip those waits and is
+written to clock_sync.tsv; event timestamps are still local times.
+"""
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+# Fraction of samples, by round trip time, used for the fit
+_FASTEST_FRACTION = .5
+# Scale from median absolute deviation to standard deviation
+_MAD_SCALE = 1.4826
+# Most pairwise slopes in a fit; past this, only pairs half the samples apart are used
+_MAX_PAIRS = 1000
+
+SYNC_FILE = 'clock_sync.tsv'
+
+ClockModel = collections.namedtuple('ClockModel', ('t0', 'offset', 'drift', 'residual', 'n_samples', 'fit_time'))
+
+
+def sync_probe(ram_control):
+    """
+    :param ram_control: RAMControl object
+    :return: its round trip probe, or None if it can't report the remote time
+    """
+    return getattr(ram_control, 'sync_probe', None)
+
+
+def fit_clock(samples):
+    """
+    Fits the remote clock to round trip samples
+    :param samples: array of (local send time, remote time, local receive time)
+    :return: (t0, offset, drift, residual) with residual the robust spread of the fit in ms
+    """
+    samples = np.asarray(samples, dtype=float)
+    round_trips = samples[:, 2] - samples[:, 0]
+    fastest = round_trips <= np.percentile(round_trips, _FASTEST_FRACTION * 100)
+    local = (samples[fastest, 0] + samples[fastest, 2]) / 2
+    offsets = samples[fastest, 1] - local
+    t0 = local[0]
+
+    if len(local) > 1:
+        n = len(local)
+        if n * (n - 1) // 2 <= _MAX_PAIRS:
+            (i, j) = np.triu_indices(n, 1)
+        else:
+            # Linear in the samples, and the long baselines give the most precise slopes
+            i = np.arange(n - n // 2)
+            j = i + n // 2
+        dt = local[j] - local[i]
+        valid = dt > 0
+        drift = np.median((offsets[j] - offsets[i])[valid] / dt[valid]) if valid.any() else 0.
+    else:
+        drift = 0.
+    offset = np.median(offsets - drift * (local - t0))
+    residuals = offsets - offset - drift * (local - t0)
+    residual = _MAD_SCALE * np.median(np.abs(residuals - np.median(residuals)))
+    # Each sample is only known to within half its round trip
+    residual = max(residual, np.median(round_trips[fastest]) / 2)
+    return t0, offset, drift, residual
+
+
+class ClockDriftEstimator:
+
+    def __init__(self, probe, interval=500, window=240, min_samples=10, max_age=None):
+        """
+        :param probe: function returning (local send, remote, local receive) times in ms
+        :param interval: time between probes, in ms
+        :param window: number of most recent samples to fit
+        :param min_samples: samples needed before a model is published
+        :param max_age: (optional) age in ms past which the model no longer counts as aligned,
+                        default 4 probe intervals
+        """
+        self.probe = probe
+        self.interval = interval
+        self.max_age = max_age or 4 * interval
+        self.min_samples = min_samples
+        self.samples = collections.deque(maxlen=window)
+        # Held while probing, so a blocking alignment can't interleave its SYNCs with ours
+        self.lock = threading.Lock()
+        self.model = None
+        # time.time() of the last fit, and probes failed since the last success
+        self.fitted_at = None
+        self.failures = 0
+        self.errors = 0
+        self._running = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='ClockDriftEstimator')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        self._running = False
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def sample(self):
+        """
+        Takes one round trip sample and refits
+        """
+        with self.lock:
+            try:
+                sample = self.probe()
+            except Exception:
+                self.failures += 1
+                raise
+        self.failures = 0
+        self.samples.append(sample)
+        if len(self.samples) >= self.min_samples:
+            (t0, offset, drift, residual) = fit_clock(list(self.samples))
+            self.model = ClockModel(t0, offset, drift, residual, len(self.samples), sample[2])
+            self.fitted_at = time.time()
+
+    def _run(self):
+        while self._running:
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                print 'WARNING: clock sync probe failed: %s' % e
+            self._stopped.wait(self.interval / 1000.)
+
+    def is_aligned(self, max_residual):
+        """
+        Non-blocking check of the current fit
+        :param max_residual: largest acceptable residual error, in ms
+        :return: True if there is a recent fit with residual error within max_residual and the latest probe
+                 succeeded
+        """
+        model = self.model
+        return model is not None and model.residual <= max_residual and not self.failures and \
+            (time.time() - self.fitted_at) * 1000 <= self.max_age
+
+    def remote_time(self, local_time):
+        """
+        :return: Control PC time for a local time, according to the current fit
+        """
+        model = self.model
+        if model is None:
+            return None
+        return local_time + model.offset + model.drift * (local_time - model.t0)
+
+
+def write_checks(session, checks):
+    """
+    Writes the alignment checks made before each list
+    :param session: PyEPL session to create the file in (exp.session)
+    :param checks: [(trial, blocking, ClockModel or None), ...]
+    """
+    sync_file = session.createFile(SYNC_FILE)
+    sync_file.write('trial\tblocking\toffset\tdrift\tresidual\tn_samples\n')
+    for (trial, blocking, model) in checks:
+        if model is None:
+            sync_file.write('%d\t%d\t\t\t\t\n' % (trial, blocking))
+        else:
+            sync_file.write('%d\t%d\t%.3f\t%.9f\t%.3f\t%d\n' % (trial, blocking, model.offset, model.drift,
+                                                              model.residual, model.n_samples))
+    sync_file.close()
+
+
+if __name__ == '__main__':
+    # Simulated Control PC 3.2 ms ahead and drifting 20 ppm, with 5% delayed replies
+    rng = np.random.RandomState(0)
+
+    def simulated_probe(state={'t': 0.}):
+        state['t'] += 500
+        out, back = rng.exponential(.2, 2) + .1
+        if rng.rand() < .05:
+            back += rng.uniform(5, 50)
+        sent = state['t']
+        return sent, sent + out + 3.2 + 20e-6 * sent, sent + out + back
+
+    estimator = ClockDriftEstimator(simulated_probe)
+    start = time.time()
+    for _ in range(1000):
+        estimator.sample()
+    print 'offset at 0: %.3f ms, drift %.1f ppm, residual %.3f ms (%.2f ms per fit)' % (
+        estimator.model.offset - estimator.model.drift * estimator.model.t0, estimator.model.drift * 1e6,
+        estimator.model.residual, (time.time() - start))
@@ -13,9 +13,28 @@ require_labjack = True
 # Overridden in sconfig files
 do_stim = False
 
+# Session and math log entries are queued and written by a background thread
+# between encoding periods, with a typed JSON-lines copy (session.jsonl, math.jsonl).
+# A hard crash (power loss, kill -9) loses the entries queued since the last
+# list or recall period, which unbuffered logs write immediately.
+# logFsync: when to sync the copy to disk, 'never', 'phase' or 'close'
+bufferedLogs = False
+logFsync = 'phase'
+
 # Control PC
 control_pc = True
 
+# Maximum number of events waiting to be sent to the control PC
+controlQueueSize = 1024
+
+# Clock alignment with the control PC: round trips are sampled in the
+# background every syncProbeInterval ms, and a list only waits for a full
+# resync if the fitted clock's error is above maxSyncResidual ms.
+# Needs a RAMControl with a sync_probe (so far only controlpcsim's)
+backgroundSync = False
+syncProbeInterval = 500
+maxSyncResidual = 1.0
+
 # Number of sessions per subject
 numSessions = 5
 
@@ -45,6 +64,17 @@ Jitter = 250
 # Duration of recall in ms
 recallDuration = 30000
 
+# Compress each recall recording (gzip, lossless) in the background,
+# replacing <list>.wav with <list>.wav.gz. Annotation tools that look for
+# <list>.wav won't find the recordings until they are gunzipped. Only the
+# finished files are compressed: PyEPL still holds each recording in memory
+# while it is captured
+compressRecordings = False
+
+# Detect candidate vocalization onsets in each recall recording, written
+# to <list>.onsets.tsv (not sent to the control PC)
+detectVocalizations = False
+
 # Beep at start and end of recording (freq,dur,rise/fall)
 startBeepFreq = 800
 startBeepDur = 500
@@ -81,6 +111,9 @@ MATH_incorrectBeepFreq = 200
 MATH_incorrectBeepRF = 50
 MATH_incorrectSndFile = None
 
+# Beeps are synthesized once and kept in this folder
+toneCacheDir = '~/.RAM_FR/tones'
+
 # Word pool to use
 wp = 'pools_%s/RAM_wordpool.txt' % LANGUAGE
 noAcc_wp = 'RAM_wordpool_noAcc.txt'
@@ -108,7 +141,11 @@ rtComputation = 9600
 rtConstraint = 1200
 
 # Used to find the file for constructing word lists with similar words
+# (converted once to a memory-mapped store next to it, see simstore.py)
 similarityFile = 'wordpool_generation/RAM_FR_LSA.csv'
+# New sessions may share at most this many words between one of their lists
+# and a list of another session (see listoverlap.py)
+maxListOverlap = 6
 
 fastConfig = False
 
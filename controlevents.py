@@ -0,0 +1,143 @@
+"""
+Asynchronous delivery of events to the Control PC.
+
+Events are put on a bounded queue by the presentation thread, with their
+timestamp already taken, and built and sent by a dedicated sender thread, so a
+stalled socket never holds up the next frame. The queue is a deque, whose
+append and popleft are atomic, so the presentation thread never waits on a lock
+to enqueue; when the queue is full the event is dropped and counted instead.
+"""
+
+import collections
+import threading
+import time
+
+# Kinds of queued items
+_BUILD, _MESSAGE = range(2)
+
+
+class ControlEventQueue:
+
+    def __init__(self, ram_control, max_size=1024):
+        """
+        :param ram_control: RAMControl instance used to build and send messages
+        :param max_size: maximum number of events waiting to be sent
+        """
+        self.ram_control = ram_control
+        self.max_size = max_size
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+        self._sending = False
+
+        # Counters
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def start(self, max_size=None):
+        """
+        Starts the sender thread (done automatically on the first event)
+        :param max_size: (optional) new maximum queue size
+        """
+        if max_size is not None:
+            self.max_size = max_size
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='ControlEventSender')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def depth(self):
+        """
+        :return: number of events waiting to be sent
+        """
+        return len(self._queue)
+
+    def _put(self, item):
+        if self._thread is None:
+            self.start()
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            return False
+        self._queue.append(item)
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._wakeup.set()
+        return True
+
+    def put(self, msg_type, *args, **kwargs):
+        """
+        Queues an event to be built with ram_control.build_message and sent
+        :return: False if the event was dropped because the queue is full
+        """
+        return self._put((_BUILD, msg_type, args, kwargs))
+
+    def put_message(self, message):
+        """
+        Queues an already built message
+        :return: False if the message was dropped because the queue is full
+        """
+        return self._put((_MESSAGE, message, None, None))
+
+    def _send(self, item):
+        (kind, target, args, kwargs) = item
+        if kind == _BUILD:
+            self.ram_control.send(self.ram_control.build_message(target, *args, **kwargs))
+        else:
+            self.ram_control.send(target)
+
+    def _run(self):
+        while self._running or self._queue:
+            self._wakeup.wait(0.1)
+            self._wakeup.clear()
+            while self._queue:
+                self._sending = True
+                item = self._queue.popleft()
+                try:
+                    self._send(item)
+                    self.sent += 1
+                except Exception as e:
+                    self.errors += 1
+                    print 'WARNING: could not send event to control PC: %s' % e
+                finally:
+                    self._sending = False
+
+    def flush(self, timeout=5.0):
+        """
+        Waits until every queued event has been sent
+        :param timeout: maximum time to wait, in seconds
+        :return: True if the queue was drained
+        """
+        deadline = time.time() + timeout
+        self._wakeup.set()
+        while (self._queue or self._sending) and time.time() < deadline:
+            time.sleep(.001)
+        return not (self._queue or self._sending)
+
+    def stop(self, timeout=5.0):
+        """
+        Sends the remaining events and stops the sender thread
+        :param timeout: maximum time to wait, in seconds
+        :return: False if the sender thread was not running
+        """
+        if self._thread is None:
+            return False
+        self.flush(timeout)
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+        return True
+
+    def stats(self):
+        """
+        :return: dict of queue counters
+        """
+        return {'depth': self.depth(),
+                'max_depth': self.max_depth,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'errors': self.errors}
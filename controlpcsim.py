@@ -0,0 +1,423 @@
+"""
+Loopback stand-in for the Control PC.
+
+ControlPCSimulator is a local TCP server that speaks the task side of the
+Control PC protocol: newline-delimited JSON messages of the form
+{"type": ..., "data": {...}, "time": ...}. It answers CONNECTED and SYNC
+messages (the SYNC reply after a configurable delay and jitter), sends START
+once the task is connected, logs every message it receives with its receive
+time, and can inject EXIT or stop reading for a while to apply back-pressure.
+
+LoopbackRAMControl is a client with the RAMControl interface used by FR.py,
+so the experiment (see headless.py, settings['control_pc_address']) or the
+ControlEventQueue can be run against the simulator.
+
+To measure sync round trips, message throughput and latency, and the sender's
+behaviour during a stall:
+    python controlpcsim.py [--delay MS] [--jitter MS] [--messages N] [--stall S]
+"""
+
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+
+import numpy as np
+
+
+def _now_ms():
+    return time.time() * 1000
+
+
+class LoopbackMessage:
+
+    def __init__(self, msg_type, timestamp=None, **data):
+        self.type = msg_type
+        self.time = _now_ms() if timestamp is None else timestamp
+        self.data = data
+
+    def jsonize(self):
+        return json.dumps({'type': self.type, 'data': self.data, 'time': self.time}, sort_keys=True)
+
+
+class _LineSocket:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = ''
+        self._send_lock = threading.Lock()
+
+    def send(self, text):
+        with self._send_lock:
+            self.sock.sendall(text + '\n')
+
+    def receive(self):
+        """
+        :return: next line received, or None once the connection is closed
+        """
+        while '\n' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self._buffer += data
+        (line, self._buffer) = self._buffer.split('\n', 1)
+        return line
+
+
+class ControlPCSimulator:
+
+    def __init__(self, host='127.0.0.1', port=0, sync_delay=0., sync_jitter=0., buffer_size=None,
+                 clock_offset=0., clock_drift=0.):
+        """
+        :param host: address to listen on
+        :param port: port to listen on (0 picks a free port, see self.address)
+        :param sync_delay: delay before answering a SYNC, in ms
+        :param sync_jitter: maximum extra random delay before answering a SYNC, in ms
+        :param buffer_size: (optional) receive buffer size, small values make stalls felt sooner
+        :param clock_offset: offset of the simulated Control PC clock from this machine's, in ms
+        :param clock_drift: drift of the simulated Control PC clock (e.g. 20e-6 for 20 ppm fast)
+        """
+        self.sync_delay = sync_delay
+        self.sync_jitter = sync_jitter
+        self.clock_offset = clock_offset
+        self.clock_drift = clock_drift
+        self._start_time = _now_ms()
+        self.buffer_size = buffer_size
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if buffer_size:
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        self._server.bind((host, port))
+        self._server.listen(1)
+        self.address = self._server.getsockname()
+        self._connection = None
+        self._lock = threading.Lock()
+        self._stalled_until = 0
+        self._running = False
+
+        # [(receive time in ms, message dict), ...]
+        self.received = []
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._accept, name='ControlPCSimulator')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        for sock in (self._connection and self._connection.sock, self._server):
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                sock.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                (sock, _) = self._server.accept()
+            except socket.error:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connection = _LineSocket(sock)
+            self._serve(self._connection)
+
+    def _serve(self, connection):
+        while self._running:
+            stall = self._stalled_until - time.time()
+            if stall > 0:
+                time.sleep(stall)
+            try:
+                line = connection.receive()
+            except socket.error:
+                return
+            if line is None:
+                return
+            received = _now_ms()
+            message = json.loads(line)
+            with self._lock:
+                self.received.append((received, message))
+            self._respond(connection, message)
+
+    def _respond(self, connection, message):
+        if message['type'] == 'CONNECTED':
+            self.send('CONNECTED')
+            self.send('START')
+        elif message['type'] == 'SYNC':
+            delay = self.sync_delay + random.uniform(0, self.sync_jitter)
+            if delay:
+                time.sleep(delay / 1000.)
+            self.send('SYNC', **message['data'])
+
+    def send(self, msg_type, **data):
+        """
+        Sends a message to the connected task
+        """
+        if self._connection:
+            self._connection.send(LoopbackMessage(msg_type, self.remote_time(), **data).jsonize())
+
+    def remote_time(self):
+        """
+        :return: current time on the simulated Control PC clock, in ms
+        """
+        now = _now_ms()
+        return now + self.clock_offset + self.clock_drift * (now - self._start_time)
+
+    def inject_exit(self):
+        """
+        Tells the task to quit, as the Control PC does when it is stopped
+        """
+        self.send('EXIT')
+
+    def stall(self, seconds):
+        """
+        Stops reading from the task for a while
+        """
+        self._stalled_until = time.time() + seconds
+
+    def messages(self, msg_type=None):
+        """
+        :return: [(receive time in ms, message dict), ...], optionally only of the given type
+        """
+        with self._lock:
+            return [(received, message) for (received, message) in self.received
+                    if msg_type is None or message['type'] == msg_type]
+
+    def latencies(self, msg_type=None):
+        """
+        Only meaningful if the task timestamps messages with the same clock (time.time())
+        :return: array of receive time - message time, in ms
+        """
+        return np.array([received - message['time'] for (received, message) in self.messages(msg_type)
+                         if message['type'] not in ('CONNECTED', 'SYNC')])
+
+    def write_log(self, filename):
+        """
+        Writes every received message with its receive time
+        """
+        log = open(filename, 'w')
+        for (received, message) in self.messages():
+            log.write('%.3f\t%s\t%s\n' % (received, message['type'], json.dumps(message, sort_keys=True)))
+        log.close()
+
+
+class _Socket:
+    log_path = None
+
+
+class LoopbackRAMControl:
+
+    def __init__(self, address, sync_count=5, timeout=5.0, buffer_size=None):
+        """
+        :param address: (host, port) of the ControlPCSimulator
+        :param sync_count: number of SYNC round trips in align_clocks
+        :param timeout: seconds to wait for any reply
+        :param buffer_size: (optional) send buffer size, small values make stalls felt sooner
+        """
+        self.address = tuple(address)
+        self.sync_count = sync_count
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.socket = _Socket()
+        self.handlers = {}
+        self._connection = None
+        self._replies = {}
+        self._reply_event = threading.Condition()
+        self._sync_num = 0
+
+        # Round trip times of every SYNC, in ms
+        self.sync_round_trips = []
+
+    def configure(self, *args, **kwargs):
+        pass
+
+    def register_handler(self, name, handler):
+        self.handlers[name] = handler
+
+    def initiate_connection(self):
+        if self._connection:
+            # The simulator serves one connection at a time, e.g. across sessions of a benchmark
+            try:
+                self._connection.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._connection.sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.buffer_size)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except socket.error:
+            return False
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connection = _LineSocket(sock)
+        thread = threading.Thread(target=self._receive, name='LoopbackRAMControl')
+        thread.daemon = True
+        thread.start()
+        self.send(self.build_message('CONNECTED'))
+        return self._wait_for('CONNECTED') is not None
+
+    def _receive(self):
+        while True:
+            try:
+                line = self._connection.receive()
+            except socket.error:
+                return
+            if line is None:
+                return
+            message = json.loads(line)
+            with self._reply_event:
+                self._replies.setdefault(message['type'], []).append(message)
+                self._reply_event.notify_all()
+            if message['type'] in self.handlers:
+                self.handlers[message['type']]()
+
+    def _wait_for(self, msg_type, match=None):
+        """
+        :param match: (optional) function of a reply, False for replies to discard
+        :return: the next reply of the type, or None after the timeout
+        """
+        deadline = time.time() + self.timeout
+        with self._reply_event:
+            while True:
+                replies = self._replies.get(msg_type, [])
+                while replies and match and not match(replies[0]):
+                    replies.pop(0)
+                if replies:
+                    return replies.pop(0)
+                if time.time() >= deadline:
+                    return None
+                self._reply_event.wait(deadline - time.time())
+
+    def wait_for_start_message(self, poll_callback=None):
+        while self._wait_for('START') is None:
+            if poll_callback:
+                poll_callback()
+
+    def align_clocks(self, callback=None):
+        for _ in range(self.sync_count):
+            (sent, _, received) = self.sync_probe()
+            self.sync_round_trips.append(received - sent)
+            if callback:
+                callback()
+
+    def sync_probe(self):
+        """
+        One SYNC round trip, also used by clocksync.ClockDriftEstimator. Each SYNC is numbered, and a late
+        reply to an earlier SYNC that timed out is discarded rather than taken as the reply to this one
+        :return: (local send time, Control PC time, local receive time) in ms
+        """
+        with self._reply_event:
+            self._sync_num += 1
+            num = self._sync_num
+        sent = _now_ms()
+        self.send(self.build_message('SYNC', num=num))
+        reply = self._wait_for('SYNC', lambda message: message['data'].get('num') == num)
+        if reply is None:
+            raise Exception('No SYNC reply from the Control PC')
+        return sent, reply['time'], _now_ms()
+
+    def build_message(self, msg_type, *args, **kwargs):
+        timestamp = kwargs.pop('timestamp', None)
+        return LoopbackMessage(msg_type, timestamp, **kwargs)
+
+    def send(self, message):
+        self._connection.send(message.jsonize())
+
+    def send_math_message(self, *args, **kwargs):
+        self.send(self.build_message('MATH', **kwargs))
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return 'n/a'
+    return 'mean %.2f, p50 %.2f, p95 %.2f, max %.2f ms' % (np.mean(values), np.percentile(values, 50),
+                                                           np.percentile(values, 95), np.max(values))
+
+
+def measure(sync_delay=0., sync_jitter=0., n_messages=10000, stall=3.0, n_syncs=50):
+    """
+    Runs the simulator and a client in this process and measures the link
+    :return: text of the report
+    """
+    from controlevents import ControlEventQueue
+
+    simulator = ControlPCSimulator(sync_delay=sync_delay, sync_jitter=sync_jitter, buffer_size=4096).start()
+    client = LoopbackRAMControl(simulator.address, sync_count=n_syncs, buffer_size=4096)
+    if not client.initiate_connection():
+        raise Exception('Could not connect to the simulator')
+    client.wait_for_start_message()
+    lines = []
+
+    client.align_clocks()
+    lines.append('SYNC round trip (%d): %s' % (n_syncs, _percentiles(client.sync_round_trips)))
+
+    # Throughput: as fast as the sender thread can go
+    queue = ControlEventQueue(client, max_size=n_messages)
+    start = time.time()
+    for i in range(n_messages):
+        queue.put('STATE', state='WORD', value=bool(i % 2), timestamp=_now_ms())
+    queue.flush(timeout=60)
+    while len(simulator.messages('STATE')) < n_messages and time.time() - start < 60:
+        time.sleep(.001)
+    elapsed = time.time() - start
+    lines.append('Throughput: %d messages in %.3f s (%.0f messages/s)' % (n_messages, elapsed,
+                                                                          n_messages / elapsed))
+    lines.append('Latency: %s' % _percentiles(simulator.latencies('STATE')))
+    queue.stop()
+
+    # Back-pressure: the Control PC stops reading while events keep coming at word rate. The smallest
+    # socket buffers on both ends keep the kernel from absorbing the stall, so the queue fills and drops
+    stalled = ControlPCSimulator(buffer_size=1).start()
+    stalled_client = LoopbackRAMControl(stalled.address, buffer_size=1)
+    if not stalled_client.initiate_connection():
+        raise Exception('Could not connect to the simulator')
+    stalled_client.wait_for_start_message()
+    queue = ControlEventQueue(stalled_client, max_size=64)
+    stalled.stall(stall)
+    start = time.time()
+    n_sent = 0
+    while time.time() - start < stall * .8:
+        put = time.time()
+        queue.put('TRIAL', trial=n_sent, timestamp=_now_ms())
+        n_sent += 1
+        time.sleep(.005)
+        if time.time() - put > .05:
+            lines.append('WARNING: put blocked for %.0f ms' % ((time.time() - put) * 1000))
+    # As on EXIT: wait for the queue to drain, which can only happen once the stall is over
+    flush_start = time.time()
+    drained = queue.flush(timeout=stall * 5)
+    flush_time = time.time() - flush_start
+    stats = queue.stats()
+    n_expected = n_sent - stats['dropped']
+    while len(stalled.messages('TRIAL')) < n_expected and time.time() - flush_start < stall * 5:
+        time.sleep(.001)
+    n_delivered = len(stalled.messages('TRIAL'))
+    lines.append('Stall of %.1f s: %d events, %d delivered, %d dropped, max queue depth %d of %d' %
+                 (stall, n_sent, n_delivered, stats['dropped'], stats['max_depth'], queue.max_size))
+    lines.append('Flush during stall: %s after %.2f s' % ('drained' if drained else 'NOT drained', flush_time))
+    lines.append('Latency during stall: %s' % _percentiles(stalled.latencies('TRIAL')))
+    queue.stop()
+    stalled.stop()
+    if stats['max_depth'] < queue.max_size or not stats['dropped'] or not drained or n_delivered != n_expected:
+        raise Exception('The stall did not fill the queue, or the queue did not drain after it:\n' + '\n'.join(lines))
+
+    simulator.stop()
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the link to a simulated Control PC')
+    parser.add_argument('--delay', type=float, default=0., help='SYNC reply delay, ms')
+    parser.add_argument('--jitter', type=float, default=0., help='maximum extra SYNC reply delay, ms')
+    parser.add_argument('--messages', type=int, default=10000, help='messages for the throughput test')
+    parser.add_argument('--stall', type=float, default=3.0, help='length of the stall, s')
+    args = parser.parse_args()
+    print measure(args.delay, args.jitter, args.messages, args.stall)
@@ -0,0 +1,321 @@
+"""
+Columnar index of the events in an experiment archive.
+
+Parses session.log and math.log of every session under an archive
+(<archive>/<subject>/session_<n>/) into one binary file per column, so that
+loading the events of a subject or of every subject is a memory-mapped read.
+Text fields (event type, word, math problem, subject) are stored as codes
+into vocabularies kept in the manifest.
+
+manifest.json records, for every session, the range of rows it occupies and
+the size and modification time of its log files. Updating the index only
+parses sessions that are new or whose logs have changed; rows of changed
+sessions are replaced, sessions whose folder is gone are dropped, and the
+columns are rewritten in subject order once enough rows are out of place.
+
+    python eventindex.py <archive> [--index <folder>]
+
+The default index folder is <archive>/.event_index.
+"""
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+import logsink
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+LOGS = ('session.log', 'math.log')
+
+# Column name, dtype, value when not applicable
+COLUMNS = (('subject', np.int32, -1),
+           ('session', np.int16, -1),
+           ('log', np.int8, -1),
+           ('type', np.int16, -1),
+           ('mstime', np.int64, 0),
+           ('latency', np.int32, 0),
+           ('trial', np.int16, -1),
+           ('serialpos', np.int16, -1),
+           ('stim', np.int8, -1),
+           ('item', np.int32, -1),
+           ('correct', np.int8, -1),
+           ('rt', np.int32, -1))
+
+# Rewrite the columns in order once this fraction of rows is dead or out of order
+_COMPACT_FRACTION = .25
+
+_SESSION_DIR = re.compile(r'^session_(\d+)$')
+
+
+class _Vocabulary:
+
+    def __init__(self, words=()):
+        self.words = list(words)
+        self.codes = dict((word, i) for (i, word) in enumerate(self.words))
+
+    def code(self, word):
+        if word not in self.codes:
+            self.codes[word] = len(self.words)
+            self.words.append(word)
+        return self.codes[word]
+
+
+def parse_session(session_dir, session_num, subject_code, types, items):
+    """
+    Parses the logs of one session
+    :param session_dir: folder of the session
+    :param session_num: session number
+    :param subject_code: code of the subject
+    :param types: _Vocabulary of event types
+    :param items: _Vocabulary of words and math problems
+    :return: {column: array} of the session's events
+    """
+    rows = []
+    for (log_i, log_name) in enumerate(LOGS):
+        path = os.path.join(session_dir, log_name)
+        if not os.path.exists(path):
+            continue
+        trial = -1
+        for line in open(path):
+            parts = line.rstrip('\r\n').split('\t', 2)
+            if len(parts) < 3:
+                continue
+            try:
+                entry = logsink.parse_entry(parts[2], (int(parts[0]), int(parts[1])))
+            except ValueError:
+                continue
+            if entry['type'] == 'TRIAL':
+                trial = entry.get('trial', -1)
+            row = dict((name, default) for (name, _, default) in COLUMNS)
+            row.update(subject=subject_code, session=session_num, log=log_i, type=types.code(entry['type']),
+                       mstime=entry['mstime'], latency=entry['latency'], trial=trial)
+            if 'item' in entry:
+                row['item'] = items.code(unicode(entry['item']))
+            elif 'problem' in entry:
+                row['item'] = items.code(unicode(entry['problem']))
+            if 'stim' in entry or 'list_type' in entry:
+                row['stim'] = int(entry.get('stim', entry.get('list_type')) == 'STIM')
+            for name in ('serialpos', 'correct', 'rt'):
+                if isinstance(entry.get(name), int):
+                    row[name] = entry[name]
+            rows.append(row)
+    events = dict((name, np.array([row[name] for row in rows], dtype=dtype)) for (name, dtype, _) in COLUMNS)
+
+    # math.log has no TRIAL entries; math events belong to the last trial started before them
+    is_trial = (events['log'] == 0) & (events['type'] == types.codes.get('TRIAL', -1))
+    is_math = events['log'] == 1
+    if is_trial.any() and is_math.any():
+        order = np.argsort(events['mstime'][is_trial], kind='mergesort')
+        trial_times = events['mstime'][is_trial][order]
+        trial_i = np.searchsorted(trial_times, events['mstime'][is_math], side='right') - 1
+        events['trial'][is_math] = np.where(trial_i >= 0, events['trial'][is_trial][order][trial_i], -1)
+    return events
+
+
+def _log_stats(session_dir):
+    stats = {}
+    for log_name in LOGS:
+        path = os.path.join(session_dir, log_name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[log_name] = [stat.st_size, int(stat.st_mtime)]
+    return stats
+
+
+def find_sessions(archive):
+    """
+    :return: [(subject, session number, session folder), ...] for every session with logs
+    """
+    sessions = []
+    for subject in sorted(os.listdir(archive)):
+        subject_dir = os.path.join(archive, subject)
+        if subject.startswith('.') or not os.path.isdir(subject_dir):
+            continue
+        for name in sorted(os.listdir(subject_dir)):
+            match = _SESSION_DIR.match(name)
+            if match and any(os.path.exists(os.path.join(subject_dir, name, log)) for log in LOGS):
+                sessions.append((subject, int(match.group(1)), os.path.join(subject_dir, name)))
+    return sessions
+
+
+class EventIndex:
+
+    def __init__(self, index_dir):
+        """
+        :param index_dir: folder of the index, created on the first update
+        """
+        self.index_dir = index_dir
+        manifest_path = os.path.join(index_dir, MANIFEST)
+        if os.path.exists(manifest_path):
+            manifest = json.load(open(manifest_path))
+            if manifest['version'] != VERSION:
+                raise Exception('Event index %s was made by another version' % index_dir)
+        else:
+            manifest = {'version': VERSION, 'n_rows': 0, 'sessions': {}, 'types': [], 'items': [], 'subjects': []}
+        self.n_rows = manifest['n_rows']
+        # {'<subject>/<session>': {'start':, 'stop':, 'logs': {log: [size, mtime]}}}
+        self.sessions = manifest['sessions']
+        self.types = _Vocabulary(manifest['types'])
+        self.items = _Vocabulary(manifest['items'])
+        self.subjects = _Vocabulary(manifest['subjects'])
+
+    def _column_path(self, name):
+        return os.path.join(self.index_dir, name + '.bin')
+
+    def _save_manifest(self):
+        manifest = {'version': VERSION, 'n_rows': self.n_rows, 'sessions': self.sessions,
+                    'types': self.types.words, 'items': self.items.words, 'subjects': self.subjects.words,
+                    'columns': dict((name, np.dtype(dtype).str) for (name, dtype, _) in COLUMNS)}
+        tmp_path = os.path.join(self.index_dir, MANIFEST + '.tmp')
+        json.dump(manifest, open(tmp_path, 'w'))
+        os.rename(tmp_path, os.path.join(self.index_dir, MANIFEST))
+
+    def _truncate_columns(self):
+        """
+        Drops rows written after the last saved manifest (an interrupted update)
+        """
+        for (name, dtype, _) in COLUMNS:
+            path = self._column_path(name)
+            size = self.n_rows * np.dtype(dtype).itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as column:
+                    column.truncate(size)
+
+    def update(self, archive, verbose=False):
+        """
+        Adds new and changed sessions of an archive to the index, and drops sessions no longer in it
+        :param archive: folder with a subfolder per subject
+        :return: number of sessions parsed
+        """
+        if not os.path.exists(self.index_dir):
+            os.makedirs(self.index_dir)
+        self._truncate_columns()
+        n_parsed = 0
+        found = set()
+        for (subject, session_num, session_dir) in find_sessions(archive):
+            key = '%s/%d' % (subject, session_num)
+            found.add(key)
+            logs = _log_stats(session_dir)
+            if key in self.sessions and self.sessions[key]['logs'] == logs:
+                continue
+            events = parse_session(session_dir, session_num, self.subjects.code(subject), self.types, self.items)
+            n_events = len(events['mstime'])
+            for (name, dtype, _) in COLUMNS:
+                with open(self._column_path(name), 'ab') as column:
+                    column.write(events[name].astype(dtype).tostring())
+            self.sessions[key] = {'start': self.n_rows, 'stop': self.n_rows + n_events, 'logs': logs}
+            self.n_rows += n_events
+            n_parsed += 1
+            if verbose:
+                print '%s session %d: %d events' % (subject, session_num, n_events)
+        # Sessions whose folder is gone leave dead rows, dropped by the next compaction
+        for key in set(self.sessions) - found:
+            del self.sessions[key]
+        # Create empty columns for an empty index
+        for (name, _, _) in COLUMNS:
+            open(self._column_path(name), 'ab').close()
+        self._save_manifest()
+        if self._misplaced_rows() > _COMPACT_FRACTION * self.n_rows:
+            self.compact()
+        return n_parsed
+
+    def _ordered_sessions(self):
+        return sorted(self.sessions.items(),
+                      key=lambda (key, _): (key.rsplit('/', 1)[0], int(key.rsplit('/', 1)[1])))
+
+    def _misplaced_rows(self):
+        """
+        :return: number of rows that are dead or not in subject/session order
+        """
+        position = 0
+        for (_, session) in self._ordered_sessions():
+            if session['start'] != position:
+                break
+            position = session['stop']
+        return self.n_rows - position
+
+    def compact(self):
+        """
+        Rewrites the columns without dead rows, in subject and session order
+        """
+        ordered = self._ordered_sessions()
+        for (name, dtype, _) in COLUMNS:
+            column = self.column(name)
+            tmp_path = self._column_path(name) + '.tmp'
+            with open(tmp_path, 'wb') as out:
+                for (_, session) in ordered:
+                    out.write(np.asarray(column[session['start']:session['stop']]).tostring())
+            del column
+            os.rename(tmp_path, self._column_path(name))
+        position = 0
+        for (_, session) in ordered:
+            length = session['stop'] - session['start']
+            (session['start'], session['stop']) = (position, position + length)
+            position += length
+        self.n_rows = position
+        self._save_manifest()
+
+    def column(self, name):
+        """
+        :return: read-only memory map of a whole column
+        """
+        dtype = dict((column, dtype) for (column, dtype, _) in COLUMNS)[name]
+        if self.n_rows == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._column_path(name), dtype=dtype, mode='r', shape=(self.n_rows, ))
+
+    def _ranges(self, subject=None):
+        ranges = [(session['start'], session['stop']) for (key, session) in self._ordered_sessions()
+                  if subject is None or key.rsplit('/', 1)[0] == subject]
+        # Merge adjacent ranges so rows in order are a single slice
+        merged = []
+        for (start, stop) in ranges:
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], stop)
+            else:
+                merged.append((start, stop))
+        return merged
+
+    def _load(self, ranges):
+        events = {}
+        for (name, dtype, _) in COLUMNS:
+            column = self.column(name)
+            if len(ranges) == 1:
+                events[name] = column[ranges[0][0]:ranges[0][1]]
+            else:
+                events[name] = np.concatenate([column[start:stop] for (start, stop) in ranges] or
+                                              [np.zeros(0, dtype=dtype)])
+        return events
+
+    def load_subject(self, subject):
+        """
+        :return: {column: array} of a subject's events (memory-mapped views if its rows are contiguous)
+        """
+        return self._load(self._ranges(subject))
+
+    def load_all(self):
+        """
+        :return: {column: array} of every event in the index (memory-mapped views once compacted)
+        """
+        return self._load(self._ranges())
+
+    def type_code(self, event_type):
+        """
+        :return: code of an event type in the 'type' column, or -1 if it never occurs
+        """
+        return self.types.codes.get(event_type, -1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or update the event index of an experiment archive')
+    parser.add_argument('archive', help='e.g. ./data/FR1')
+    parser.add_argument('--index', help='index folder (default: <archive>/.event_index)')
+    args = parser.parse_args()
+    index = EventIndex(args.index or os.path.join(args.archive, '.event_index'))
+    n_parsed = index.update(args.archive, verbose=True)
+    print '%d sessions parsed, %d events in %d sessions of %d subjects' % (
+        n_parsed, index.n_rows, len(index.sessions), len(index.subjects.words))
@@ -0,0 +1,569 @@
+"""
+Headless stand-in for PyEPL and RAMControl.
+
+Implements the part of the pyepl / ramcontrol API that FR.py and playIntro.py
+use, with no display, audio or Control PC. Time is virtual: clocks advance
+instantly instead of sleeping, so a full session runs in the time the
+experiment code itself takes. Logs, .lst files, state and empty recordings
+are written to the archive directory the same way PyEPL lays them out.
+
+Call install() before importing FR so that its pyepl and ramcontrol imports
+resolve to this module:
+
+    import headless
+    headless.install(subject='TEST001', config='config.py', sconfig='FR1_config.py',
+                     archive='/tmp/data/FR1')
+    import FR
+    FR.run()
+
+Control PC messages are collected in memory, or sent to a loopback simulator
+if settings['control_pc_address'] is set (see controlpcsim.py).
+
+Every prompt is answered with its first button (Y, SPACE + RETURN...);
+set headless.settings['responses'] to map prompt text to other keys.
+"""
+
+import codecs
+import imp
+import os
+import pickle
+import random
+import sys
+import wave
+
+settings = {
+    'subject': 'HEADLESS',
+    'config': 'config.py',
+    'sconfig': None,
+    'archive': './data/headless',
+    'overrides': {},
+    # {substring of prompt text: key name}
+    'responses': {},
+    'movie_duration': 10000,
+    'math_problem_duration': 2000,
+    # (host, port) of a controlpcsim.ControlPCSimulator to send Control PC messages to
+    'control_pc_address': None,
+    # function(duration in ms) returning the samples of a recording (16 bit mono at 44.1 kHz) as a string;
+    # recordings are empty if None
+    'recording': None,
+}
+
+SOUTH = 'SOUTH'
+NORTH = 'NORTH'
+
+
+# ---------------------------------------------------------------------------
+# Virtual time
+
+class _VirtualTime:
+    now = 0.0
+
+
+def now():
+    """
+    :return: current virtual time in ms
+    """
+    return int(_VirtualTime.now)
+
+
+def _advance_to(t):
+    _VirtualTime.now = max(_VirtualTime.now, t)
+
+
+def _timestamp(t=None):
+    return (int(_VirtualTime.now if t is None else t), 0)
+
+
+class PresentationClock:
+
+    def __init__(self):
+        self.t = _VirtualTime.now
+
+    def get(self):
+        return self.t
+
+    def tare(self, t=None):
+        self.t = _VirtualTime.now if t is None else t
+
+    def delay(self, ms=0, jitter=0):
+        self.t += ms + (random.randint(0, int(jitter)) if jitter else 0)
+
+    def wait(self):
+        _advance_to(self.t)
+
+    def _present(self, duration=0):
+        """
+        Presents something at the clock's time
+        :return: (onset timestamp, offset timestamp)
+        """
+        self.tare(max(self.t, _VirtualTime.now))
+        onset = _timestamp(self.t)
+        self.delay(duration)
+        self.wait()
+        return onset, _timestamp(self.t)
+
+
+def _clock(clk):
+    return clk if isinstance(clk, PresentationClock) else PresentationClock()
+
+
+# ---------------------------------------------------------------------------
+# Experiment, config and state
+
+class State:
+    def __nonzero__(self):
+        return True
+
+
+class _Config:
+    pass
+
+
+# Session that new files and tracks are written to, set by Experiment.setSession
+_current = {'session': None}
+
+
+class Session:
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def fullPath(self):
+        return self.path
+
+    def createFile(self, name):
+        return open(os.path.join(self.path, name), 'w')
+
+
+class Experiment:
+
+    def __init__(self, **kwargs):
+        self.subject_path = os.path.join(settings['archive'], settings['subject'])
+        self._config = None
+        self.setSession(0)
+
+    def parseArgs(self):
+        pass
+
+    def setup(self):
+        pass
+
+    def setBreak(self):
+        pass
+
+    def getOptions(self):
+        return {'subject': settings['subject']}
+
+    def getConfig(self):
+        if self._config is None:
+            config = _Config()
+            for filename in (settings['config'], settings['sconfig']):
+                if filename:
+                    module = imp.load_source('_headless_%s' % os.path.splitext(os.path.basename(filename))[0],
+                                             filename)
+                    for (name, value) in vars(module).items():
+                        if not name.startswith('__'):
+                            setattr(config, name, value)
+            for (name, value) in settings['overrides'].items():
+                setattr(config, name, value)
+            self._config = config
+        return self._config
+
+    def setSession(self, session_num):
+        self.session = Session(os.path.join(self.subject_path, 'session_%d' % session_num))
+        _current['session'] = self.session
+
+    def _state_path(self):
+        return os.path.join(self.subject_path, 'state.pickle')
+
+    def restoreState(self):
+        if not os.path.exists(self._state_path()):
+            return None
+        return pickle.load(open(self._state_path(), 'rb'))
+
+    def saveState(self, state=None, **kwargs):
+        if state is None:
+            state = State()
+        for (name, value) in kwargs.items():
+            setattr(state, name, value)
+        with open(self._state_path(), 'wb') as state_file:
+            pickle.dump(state, state_file, pickle.HIGHEST_PROTOCOL)
+
+
+def checkVersion(version):
+    pass
+
+
+def setRealtime(*args):
+    pass
+
+
+class Font:
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def setDefaultFont(font):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# Tracks
+
+class _Track:
+    _last = {}
+
+    def __init__(self, name=None):
+        self.name = name
+        _Track._last[self.__class__.__name__] = self
+
+    @classmethod
+    def lastInstance(cls):
+        return _Track._last.get(cls.__name__) or cls()
+
+
+class VideoTrack(_Track):
+
+    def __init__(self, name=None):
+        _Track.__init__(self, name)
+        self.update_callbacks = []
+        self.shown = []
+
+    def clear(self, color=None):
+        self.shown = []
+
+    def showCentered(self, stimulus):
+        self.shown.append(stimulus)
+        return stimulus
+
+    def showAnchored(self, stimulus, anchor, position):
+        return self.showCentered(stimulus)
+
+    def unshow(self, shown):
+        if shown in self.shown:
+            self.shown.remove(shown)
+
+    def propToPixel(self, x, y):
+        return (x, y)
+
+    def addUpdateCallback(self, callback):
+        self.update_callbacks.append(callback)
+
+    def removeUpdateCallback(self, callback):
+        if callback in self.update_callbacks:
+            self.update_callbacks.remove(callback)
+
+    def updateScreen(self, clk=None):
+        timestamp = _timestamp(_clock(clk)._present()[0][0])
+        for callback in self.update_callbacks[:]:
+            callback(timestamp)
+        return timestamp
+
+    def playMovie(self, movie):
+        pass
+
+    def stopMovie(self, movie):
+        pass
+
+
+class KeyTrack(_Track):
+    pass
+
+
+class LogTrack(_Track):
+
+    def __init__(self, name):
+        _Track.__init__(self, name)
+        self._file = None
+
+    def logMessage(self, message, timestamp=None):
+        if self._file is None:
+            # Like PyEPL, the log stays in the session that was current when it was first written
+            self._file = open(os.path.join(_current['session'].fullPath(), '%s.log' % self.name), 'a')
+        if isinstance(timestamp, PresentationClock):
+            timestamp = _timestamp(timestamp.get())
+        elif timestamp is None:
+            timestamp = _timestamp()
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        self._file.write('%d\t%d\t%s\n' % (timestamp[0], timestamp[1], message))
+        self._file.flush()
+
+
+class AudioTrack(_Track):
+
+    def record(self, duration, basename, t=None, startCallback=None, **kwargs):
+        clk = _clock(t)
+        onset = clk._present()[0]
+        if startCallback:
+            startCallback(onset)
+        recording = wave.open(os.path.join(_current['session'].fullPath(), '%s.wav' % basename), 'wb')
+        recording.setnchannels(1)
+        recording.setsampwidth(2)
+        recording.setframerate(44100)
+        if settings['recording']:
+            recording.writeframes(settings['recording'](duration))
+        recording.close()
+        clk.delay(duration)
+        clk.wait()
+        return None, onset
+
+
+CustomAudioTrack = AudioTrack
+
+
+# ---------------------------------------------------------------------------
+# Stimuli
+
+class Key:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __and__(self, other):
+        return Key('%s AND %s' % (self.name, other.name))
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and other.name == self.name
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class ButtonChooser:
+
+    def __init__(self, *buttons):
+        self.buttons = buttons
+
+    def choose(self, prompt=''):
+        for (text, key_name) in settings['responses'].items():
+            if text in prompt:
+                return Key(key_name)
+        return self.buttons[0]
+
+    def wait(self):
+        return self.choose()
+
+
+class Text:
+
+    def __init__(self, text, size=None, **kwargs):
+        self.text = text
+        self.size = size
+        self.loaded = False
+
+    def load(self):
+        self.loaded = True
+
+    def unload(self):
+        self.loaded = False
+
+    def present(self, clk=None, duration=None, bc=None, **kwargs):
+        clk = _clock(clk)
+        (onset, offset) = clk._present(duration or 0)
+        button = bc.choose(self.text) if bc else None
+        return onset, button, offset
+
+    def presentWithCallback(self, clk=None, duration=0, updateCallback=None):
+        clk = _clock(clk)
+        (onset, offset) = clk._present(duration)
+        if updateCallback:
+            updateCallback(onset)
+            updateCallback(offset)
+        return onset, offset
+
+
+CustomText = Text
+
+
+class Movie:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        pass
+
+    def unload(self):
+        pass
+
+    def getTotalTime(self):
+        return settings['movie_duration']
+
+
+class CustomBeep:
+
+    def __init__(self, freq, duration, risefall=0):
+        self.duration = duration
+
+    def present(self, clk=None, onCallback=None, **kwargs):
+        (onset, _) = _clock(clk)._present(self.duration)
+        if onCallback:
+            onCallback(onset)
+        return onset
+
+
+class AudioClip:
+
+    def __init__(self, s=None, nchannels=2, samplerate=44100):
+        self.samples = s
+        self.nchannels = nchannels
+        self.samplerate = samplerate
+
+    def getDuration(self):
+        return len(self.samples or '') / 2 / self.nchannels * 1000. / self.samplerate
+
+    def present(self, clk=None, **kwargs):
+        return _clock(clk)._present(self.getDuration())[0]
+
+
+class _PoolItem:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class CustomTextPool(list):
+
+    def __init__(self, filename):
+        list.__init__(self, [_PoolItem(line.strip())
+                             for line in codecs.open(filename, encoding='utf-8').readlines() if line.strip()])
+
+    def findBy(self, **kwargs):
+        for item in self:
+            if all(getattr(item, name) == value for (name, value) in kwargs.items()):
+                return item
+
+
+def waitForAnyKey(clk=None, stimulus=None, **kwargs):
+    return _clock(clk)._present()[0]
+
+
+def waitForAnyKeyWithCallback(clk=None, stimulus=None, onscreenCallback=None, offscreenCallback=None):
+    clk = _clock(clk)
+    if onscreenCallback:
+        onscreenCallback()
+    timestamp = clk._present()[0]
+    if offscreenCallback:
+        offscreenCallback()
+    return timestamp
+
+
+def flashStimulus(stimulus, duration=1000, clk=None):
+    _clock(clk)._present(duration)
+
+
+def flashStimulusWithOffscreenTimestamp(stimulus, clk=None, duration=1000):
+    video = VideoTrack.lastInstance()
+    (onset, offset) = _clock(clk)._present(duration)
+    for timestamp in (onset, offset):
+        for callback in video.update_callbacks[:]:
+            callback(timestamp)
+    return onset, offset
+
+
+def customMathDistract(clk=None, mathlog=None, numVars=2, minDuration=20000, callback=None, **kwargs):
+    clk = _clock(clk)
+    start = clk.get()
+    while clk.get() - start < minDuration:
+        numbers = [random.randint(1, 9) for _ in range(numVars)]
+        (onset, offset) = clk._present(settings['math_problem_duration'])
+        if mathlog:
+            mathlog.logMessage('PROB\t%s\t%d\t1\t%d' % ('+'.join(str(n) for n in numbers) + '=',
+                                                       sum(numbers), offset[0] - onset[0]), onset)
+        if callback:
+            callback(problem='+'.join(str(n) for n in numbers), response=str(sum(numbers)),
+                     correct=True, rt=offset[0] - onset[0])
+
+
+def customMicTest(duration, threshold):
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Control PC
+
+class HeadlessMessage:
+
+    def __init__(self, msg_type, timestamp=None, **data):
+        self.type = msg_type
+        self.timestamp = now() if timestamp is None else timestamp
+        self.data = data
+
+    def jsonize(self):
+        import json
+        return json.dumps({'type': self.type, 'data': self.data, 'time': self.timestamp}, sort_keys=True)
+
+
+class WordMessage(HeadlessMessage):
+
+    def __init__(self, word, timestamp=None):
+        HeadlessMessage.__init__(self, 'WORD', timestamp, word=word)
+
+
+class _Socket:
+    log_path = None
+
+
+class RAMControl:
+    _instance = None
+
+    def __init__(self):
+        self.socket = _Socket()
+        self.handlers = {}
+        self.sent = []
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            if settings['control_pc_address']:
+                from controlpcsim import LoopbackRAMControl
+                cls._instance = LoopbackRAMControl(settings['control_pc_address'])
+            else:
+                cls._instance = cls()
+        return cls._instance
+
+    def configure(self, *args, **kwargs):
+        pass
+
+    def initiate_connection(self):
+        return True
+
+    def wait_for_start_message(self, poll_callback=None):
+        pass
+
+    def align_clocks(self, callback=None):
+        if callback:
+            callback()
+
+    def register_handler(self, name, handler):
+        self.handlers[name] = handler
+
+    def build_message(self, msg_type, *args, **kwargs):
+        return HeadlessMessage(msg_type, **kwargs)
+
+    def send(self, message):
+        self.sent.append(message.jsonize())
+
+    def send_math_message(self, *args, **kwargs):
+        self.send(HeadlessMessage('MATH', **kwargs))
+
+
+# ---------------------------------------------------------------------------
+
+def install(**kwargs):
+    """
+    Registers this module as pyepl and ramcontrol
+    :param kwargs: (optional) entries of settings to change
+    """
+    settings.update(kwargs)
+    this = sys.modules[__name__]
+    for name in ('pyepl', 'pyepl.locals', 'pyepl.timing',
+                 'ramcontrol', 'ramcontrol.extendedPyepl', 'ramcontrol.RAMControl', 'ramcontrol.messages'):
+        sys.modules[name] = this
+    this.timing = this
+    this.locals = this
+    this.extendedPyepl = this
+    this.messages = this
@@ -0,0 +1,247 @@
+"""
+Precompiled word list banks.
+
+Every list directory (e.g. pools_EN/nonstim_lists) holds one text file per
+session, one list per line. Compiling a directory produces a single binary
+bank next to it (pools_EN/nonstim_lists.bank) holding an int16 matrix of word
+pool indices, shaped sessions x lists x listLen, behind a small header that
+records the checksums of the pool and of the list files it was built from,
+and a stamp of the list files' names, sizes and modification times.
+
+The experiment memory-maps the bank at start-up. It is only checked against
+the stamp, which takes a stat of each list file rather than reading it; the
+text files are parsed instead when the bank is missing or stale. The contents
+of the list files are only hashed when a bank is built or verified.
+
+To rebuild all banks:
+    python listbank.py
+To check the banks against the contents of the list files, and restamp those
+that still match (e.g. after a checkout, which changes modification times):
+    python listbank.py --verify
+"""
+
+import codecs
+import hashlib
+import os
+import struct
+import sys
+
+import numpy as np
+
+from wordpool import read_pool_words
+
+BANK_MAGIC = 'FRLB'
+BANK_VERSION = 2
+BANK_EXTENSION = '.bank'
+
+# magic, version, nSessions, nLists, listLen, pool sha1, lists sha1, lists stamp sha1
+_HEADER = struct.Struct('<4sHHHH40s40s40s')
+_DTYPE = np.dtype('<i2')
+
+LANGUAGES = ('EN', 'SP')
+LIST_DIRS = ('nonstim_lists', 'stim_lists')
+
+
+def bank_path(list_dir):
+    """
+    :param list_dir: directory of session list text files
+    :return: path of the compiled bank for that directory
+    """
+    return os.path.normpath(list_dir) + BANK_EXTENSION
+
+
+def pool_checksum(pool_words):
+    """
+    :param pool_words: words of the pool in pool order
+    :return: sha1 hex digest of the pool
+    """
+    return hashlib.sha1(u'\n'.join(pool_words).encode('utf-8')).hexdigest()
+
+
+def session_files(list_dir):
+    """
+    :param list_dir: directory of session list text files
+    :return: [(session_number, filename), ...] sorted by session number
+    """
+    sessions = []
+    for filename in os.listdir(list_dir):
+        (name, ext) = os.path.splitext(filename)
+        if ext == '.txt' and name.isdigit():
+            sessions.append((int(name), os.path.join(list_dir, filename)))
+    return sorted(sessions)
+
+
+def lists_checksum(list_dir):
+    """
+    :param list_dir: directory of session list text files
+    :return: sha1 hex digest over the names and contents of all session files
+    """
+    digest = hashlib.sha1()
+    for (session_num, filename) in session_files(list_dir):
+        digest.update(('%d\n' % session_num).encode('ascii'))
+        digest.update(open(filename, 'rb').read())
+    return digest.hexdigest()
+
+
+def lists_stamp(list_dir):
+    """
+    :param list_dir: directory of session list text files
+    :return: sha1 hex digest over the names, sizes and modification times of all session files
+    """
+    digest = hashlib.sha1()
+    for (session_num, filename) in session_files(list_dir):
+        stat = os.stat(filename)
+        digest.update(('%d\t%d\t%.6f\n' % (session_num, stat.st_size, stat.st_mtime)).encode('ascii'))
+    return digest.hexdigest()
+
+
+def read_list_file(filename, index_by_word):
+    """
+    Parses a session list text file into word pool indices
+    :param filename: session list file, one list per line
+    :param index_by_word: dict of word -> pool index
+    :return: 2D array of size nLists x listLen
+    """
+    session_lists = [line.strip().split()
+                     for line in codecs.open(filename, encoding='utf-8').readlines()
+                     if line.strip()]
+    if len(set(len(words) for words in session_lists)) != 1:
+        raise Exception('Lists in %s are not all the same length' % filename)
+    try:
+        return np.array([[index_by_word[word] for word in words] for words in session_lists],
+                        dtype=_DTYPE)
+    except KeyError as e:
+        raise Exception('Word %s in %s not found in word pool' % (e.args[0], filename))
+
+
+def compile_list_bank(list_dir, pool_words, out_path=None):
+    """
+    Compiles all session files in a directory into a single bank
+    :param list_dir: directory of session list text files
+    :param pool_words: words of the pool in pool order
+    :param out_path: (optional) where to write the bank. Defaults to bank_path(list_dir)
+    :return: the path of the written bank
+    """
+    out_path = out_path or bank_path(list_dir)
+    index_by_word = {}
+    for (index, word) in enumerate(pool_words):
+        index_by_word.setdefault(word, index)
+
+    sessions = session_files(list_dir)
+    if not sessions:
+        raise Exception('No session list files found in %s' % list_dir)
+    expected = range(1, len(sessions) + 1)
+    if [session_num for (session_num, _) in sessions] != list(expected):
+        raise Exception('Session files in %s must be numbered 1..%d' % (list_dir, len(sessions)))
+
+    words = [read_list_file(filename, index_by_word) for (_, filename) in sessions]
+    if len(set(session.shape for session in words)) != 1:
+        raise Exception('Sessions in %s do not all have the same number and length of lists' % list_dir)
+    words = np.array(words, dtype=_DTYPE)
+
+    header = _HEADER.pack(BANK_MAGIC, BANK_VERSION,
+                          words.shape[0], words.shape[1], words.shape[2],
+                          pool_checksum(pool_words), lists_checksum(list_dir), lists_stamp(list_dir))
+    # Write to the side and move into place so a reader never sees a partial bank
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as bank_file:
+        bank_file.write(header)
+        bank_file.write(words.tostring())
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    os.rename(tmp_path, out_path)
+    return out_path
+
+
+class ListBank:
+
+    def __init__(self, path):
+        """
+        Memory-maps a compiled bank
+        :param path: path to the bank file
+        """
+        self.path = path
+        with open(path, 'rb') as bank_file:
+            header = bank_file.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise Exception('List bank %s is truncated' % path)
+        (magic, version, n_sessions, n_lists, list_len, self.pool_checksum, self.lists_checksum,
+         self.lists_stamp) = _HEADER.unpack(header)
+        if magic != BANK_MAGIC or version != BANK_VERSION:
+            raise Exception('%s is not a version %d list bank' % (path, BANK_VERSION))
+        self.words = np.memmap(path, dtype=_DTYPE, mode='r', offset=_HEADER.size,
+                               shape=(n_sessions, n_lists, list_len))
+
+    def is_fresh(self, pool_words, list_dir):
+        """
+        :param pool_words: words of the pool in pool order
+        :param list_dir: directory of session list text files the bank was built from
+        :return: True if the pool is the same and the list files have the sizes and modification times they had
+        """
+        return self.pool_checksum == pool_checksum(pool_words) and self.lists_stamp == lists_stamp(list_dir)
+
+    def verify(self, pool_words, list_dir):
+        """
+        :return: True if the pool and the contents of the list files are the ones the bank was built from
+        """
+        return self.pool_checksum == pool_checksum(pool_words) and self.lists_checksum == lists_checksum(list_dir)
+
+    def restamp(self, list_dir):
+        """
+        Records the current sizes and modification times of the list files in the header
+        """
+        self.lists_stamp = lists_stamp(list_dir)
+        with open(self.path, 'r+b') as bank_file:
+            bank_file.seek(_HEADER.size - 40)
+            bank_file.write(self.lists_stamp)
+
+def load_list_bank(list_dir, pool_words):
+    """
+    Opens the compiled bank for a list directory if it is up to date
+    :param list_dir: directory of session list text files
+    :param pool_words: words of the pool in pool order
+    :return: ListBank, or None if the bank is missing or stale
+    """
+    path = bank_path(list_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        bank = ListBank(path)
+    except Exception as e:
+        print 'WARNING: could not read list bank %s (%s)' % (path, e)
+        return None
+    if not bank.is_fresh(pool_words, list_dir):
+        print 'WARNING: list bank %s is stale; run listbank.py to rebuild it (or --verify to restamp it)' % path
+        return None
+    return bank
+
+
+def compile_all(root='.', verify=False):
+    """
+    Compiles the banks for every language and list type
+    :param root: directory containing the pools_* folders
+    :param verify: only check existing banks against the list file contents, restamping those that match
+                   and rebuilding the others
+    """
+    for language in LANGUAGES:
+        pool_dir = os.path.join(root, 'pools_%s' % language)
+        pool_words = read_pool_words(os.path.join(pool_dir, 'RAM_wordpool.txt'))
+        for list_dir in LIST_DIRS:
+            path = os.path.join(pool_dir, list_dir)
+            if not os.path.isdir(path):
+                continue
+            if verify and os.path.exists(bank_path(path)):
+                try:
+                    bank = ListBank(bank_path(path))
+                    if bank.verify(pool_words, path):
+                        bank.restamp(path)
+                        print 'Verified %s' % bank.path
+                        continue
+                except Exception as e:
+                    print 'WARNING: could not read list bank %s (%s)' % (bank_path(path), e)
+            print 'Compiled %s' % compile_list_bank(path, pool_words)
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--verify']
+    compile_all(args[0] if args else '.', verify='--verify' in sys.argv[1:])
@@ -0,0 +1,367 @@
+"""
+Construction of session word lists.
+
+Python port of the MATLAB scripts in wordpool_generation. A session is 25
+lists of 12 words covering the whole pool. Words are picked one at a time,
+each from the words whose mean semantic similarity (LSA, from the store in
+simstore.py) to the words already in the list is at or above a percentile of
+the candidates, and the last word of each list is one of the words that have
+no similarity values.
+
+Sessions are made in pairs. The second session of a pair is counterbalanced
+against the first: words are split into "on" and "off" words by where they
+fell in the first session (positions 1,2,5,6,9,10 of odd lists and
+3,4,7,8,11,12 of even lists are "on"), and every position of the second
+session takes a word of its own kind, so both sessions keep the same
+checkerboard of on and off words.
+
+The mean similarity of the words already picked to every other word is kept
+as running sums, updated with one vectorized row addition per pick, instead
+of being recomputed for every pick. Candidate session pairs are made in
+parallel across a process pool, and the pairs with the highest mean
+similarity are written out as new session files in the pools_* format. A
+pair is only used if none of its lists shares more than max-overlap words with
+a list of another session (see listoverlap.py); if there are not enough such
+pairs, nothing is written.
+
+    python listgen.py --language EN --stim 10 --nonstim 18 [--percentile 90] [--max-overlap 6]
+
+Existing session files are kept; new ones are numbered after them. The list
+banks of the pool (see listbank.py) are recompiled afterwards.
+"""
+
+import argparse
+import codecs
+import multiprocessing
+import os
+import time
+import warnings
+
+import numpy as np
+
+import config
+import listbank
+import listoverlap
+import simstore
+from wordpool import read_pool_words
+
+N_LISTS = 25
+LIST_LEN = 12
+
+# 0-based positions of the "on" words in odd (1st, 3rd, ...) lists
+ON_POSITIONS = np.array([0, 1, 4, 5, 8, 9])
+OFF_POSITIONS = np.array([2, 3, 6, 7, 10, 11])
+
+
+def _is_on(list_i, position):
+    """
+    :return: True if the position of the list (0-based) holds an "on" word
+    """
+    return (list_i % 2 == 0) == (position in ON_POSITIONS)
+
+
+class _RunningMeans:
+    """
+    Mean similarity of every word to the words picked so far, ignoring missing values
+    """
+
+    def __init__(self, n_words):
+        self.sums = np.zeros(n_words)
+        self.counts = np.zeros(n_words)
+
+    def add(self, row):
+        """
+        :param row: similarities of the picked word to every word
+        """
+        present = ~np.isnan(row)
+        self.sums[present] += row[present]
+        self.counts += present
+
+    def of(self, words):
+        counts = self.counts[words]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, self.sums[words] / counts, np.nan)
+
+
+def _pick(rng, candidates, means, percentile):
+    """
+    Picks a random word among the candidates whose mean similarity is at or above the percentile
+    """
+    candidates = np.asarray(candidates)
+    mean_sim = means.of(candidates)
+    known = ~np.isnan(mean_sim)
+    if not known.any():
+        raise Exception('No candidate word has a similarity to the list')
+    good = candidates[known & (mean_sim >= np.percentile(mean_sim[known], percentile))]
+    return good[rng.randint(len(good))]
+
+
+def list_similarity(similarity, lists):
+    """
+    :param lists: n_lists x list_len array of word indices
+    :return: mean pairwise similarity within each list, ignoring missing values
+    """
+    with warnings.catch_warnings():
+        # Words without values give empty means
+        warnings.simplefilter('ignore', RuntimeWarning)
+        pairs = np.array([similarity.submatrix(words, words) for words in lists])
+        return np.nanmean(np.nanmean(pairs, axis=2), axis=1)
+
+
+def make_lists(similarity, percentile, rng):
+    """
+    Makes one session of lists (port of makeLists.m)
+    :param similarity: SimilarityStore of the word pool
+    :param percentile: percentile of the candidates' mean similarity a word must reach
+    :param rng: RandomState
+    :return: N_LISTS x LIST_LEN array of word indices
+    """
+    no_values = similarity.no_values
+    words_left = np.flatnonzero(~no_values)
+    last_left = np.flatnonzero(no_values)
+    lists = np.zeros((N_LISTS, LIST_LEN), dtype=int)
+    for list_i in range(N_LISTS):
+        means = _RunningMeans(len(similarity))
+        for position in range(LIST_LEN - 1):
+            if position == 0:
+                word = words_left[rng.randint(len(words_left))]
+            else:
+                word = _pick(rng, words_left, means, percentile)
+            lists[list_i, position] = word
+            means.add(similarity.row(word))
+            words_left = words_left[words_left != word]
+        lists[list_i, -1] = last_left[rng.randint(len(last_left))]
+        last_left = last_left[last_left != lists[list_i, -1]]
+    return lists
+
+
+def on_words(lists):
+    """
+    :return: (on words, off words) of a session, by the checkerboard of list and position
+    """
+    on = np.zeros(lists.shape, dtype=bool)
+    on[0::2, ON_POSITIONS] = True
+    on[1::2, OFF_POSITIONS] = True
+    return lists[on], lists[~on]
+
+
+def make_counterbalanced_lists(similarity, percentile, first, rng):
+    """
+    Makes the session counterbalanced against another (port of make_counterbalanced_list.m):
+    "on" positions only take "on" words of the first session, "off" positions only "off" words
+    :param first: N_LISTS x LIST_LEN array of word indices of the first session
+    :return: N_LISTS x LIST_LEN array of word indices
+    """
+    no_values = similarity.no_values
+    (first_on, first_off) = on_words(first)
+    # Words left for the "on" and "off" positions of this session, split by whether they have values
+    left = {}
+    for (is_on, words) in ((True, first_on), (False, first_off)):
+        left[is_on] = (words[~no_values[words]], words[no_values[words]])
+    lists = np.zeros((N_LISTS, LIST_LEN), dtype=int)
+    for list_i in range(N_LISTS):
+        means = _RunningMeans(len(similarity))
+        for position in range(LIST_LEN):
+            is_on = _is_on(list_i, position)
+            (with_values, without_values) = left[is_on]
+            if position == LIST_LEN - 1:
+                word = without_values[rng.randint(len(without_values))]
+                without_values = without_values[without_values != word]
+            else:
+                if position == 0:
+                    word = with_values[rng.randint(len(with_values))]
+                else:
+                    word = _pick(rng, with_values, means, percentile)
+                means.add(similarity.row(word))
+                with_values = with_values[with_values != word]
+            left[is_on] = (with_values, without_values)
+            lists[list_i, position] = word
+    return lists
+
+
+def shuffle_words(lists, rng):
+    """
+    Shuffles the words of each list among positions of the same kind (port of shuffleWords.m)
+    """
+    lists = lists.copy()
+    for words in lists:
+        for positions in (ON_POSITIONS, OFF_POSITIONS):
+            words[positions] = words[positions][rng.permutation(len(positions))]
+    return lists
+
+
+def shuffle_lists(lists, rng):
+    """
+    Shuffles odd lists among themselves and even lists among themselves (port of shuffleLists.m)
+    """
+    lists = lists.copy()
+    for start in (0, 1):
+        lists[start::2] = lists[start::2][rng.permutation(len(lists[start::2]))]
+    return lists
+
+
+_similarity = None
+
+
+def _init_worker(store_path):
+    global _similarity
+    _similarity = simstore.SimilarityStore(store_path)
+
+
+def _make_pair(args):
+    """
+    Pool worker: makes one candidate pair of sessions
+    :param args: (seed, percentile)
+    :return: (mean similarity, first session, counterbalanced session), or None if it failed
+    """
+    (seed, percentile) = args
+    rng = np.random.RandomState(seed)
+    try:
+        first = make_lists(_similarity, percentile, rng)
+        second = make_counterbalanced_lists(_similarity, percentile, first, rng)
+    except Exception as e:
+        print 'WARNING: could not make lists with seed %d: %s' % (seed, e)
+        return None
+    score = np.mean([np.mean(list_similarity(_similarity, first)),
+                     np.mean(list_similarity(_similarity, second))])
+    return score, first, second
+
+
+def make_candidates(similarity, percentile, n_candidates, seed=None, processes=None):
+    """
+    Makes candidate session pairs across a process pool. Each process maps the similarity store itself
+    :return: [(mean similarity, first session, counterbalanced session)], best first
+    """
+    seed = np.random.randint(2 ** 31 - n_candidates) if seed is None else seed
+    tasks = [(seed + i, percentile) for i in range(n_candidates)]
+    if processes == 1:
+        _init_worker(similarity.path)
+        results = map(_make_pair, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (similarity.path, ))
+        try:
+            results = pool.map(_make_pair, tasks, chunksize=max(1, n_candidates // (4 * (processes or
+                                                                       multiprocessing.cpu_count()))))
+        finally:
+            pool.close()
+            pool.join()
+    return sorted([result for result in results if result is not None], key=lambda result: -result[0])
+
+
+def write_session(path, lists, pool_words):
+    """
+    Writes a session file: one list per line, each word followed by a space
+    """
+    with codecs.open(path, 'w', encoding='utf-8') as session_file:
+        session_file.write(u'\n'.join(u''.join(pool_words[word] + u' ' for word in words) for words in lists))
+
+
+def _n_sessions(list_dir):
+    return len(listbank.session_files(list_dir)) if os.path.isdir(list_dir) else 0
+
+
+def choose_sessions(list_dir, candidates, n_sessions, pool_words, rng, max_overlap):
+    """
+    Picks the new sessions of a directory from candidate pairs. A pair is skipped if one of its lists shares
+    more than max_overlap words with a list of an existing session or of another new session
+    :param candidates: iterator of (mean similarity, first session, counterbalanced session)
+    :param n_sessions: number of sessions the directory should end up with
+    :return: [N_LISTS x LIST_LEN array of word indices, ...] of the new sessions, in the order they are numbered
+    """
+    n_existing = _n_sessions(list_dir)
+    if n_existing % 2 or n_sessions % 2:
+        raise Exception('Sessions are made in pairs; %s has %d sessions and %d were requested' %
+                        (list_dir, n_existing, n_sessions))
+    sessions = list(listoverlap.load_sessions(list_dir, pool_words)) if n_existing else []
+    new = []
+    while n_existing + len(new) < n_sessions:
+        (_, first, second) = next(candidates)
+        pair = [shuffle_lists(shuffle_words(lists, rng), rng) for lists in (first, second)]
+        # Overlaps between existing sessions are not the new sessions' doing
+        if listoverlap.within_overlap(sessions + new + pair, len(pool_words), max_overlap, n_existing):
+            new += pair
+    return new
+
+
+def add_sessions(list_dir, sessions, pool_words):
+    """
+    Writes new sessions after the existing session files of a directory
+    :param sessions: [N_LISTS x LIST_LEN array of word indices, ...]
+    :return: paths of the files written
+    """
+    n_existing = _n_sessions(list_dir)
+    if sessions and not os.path.exists(list_dir):
+        os.makedirs(list_dir)
+    written = []
+    for lists in sessions:
+        path = os.path.join(list_dir, '%d.txt' % (n_existing + len(written) + 1))
+        write_session(path, lists, pool_words)
+        written.append(path)
+    return written
+
+
+def make_all_lists(pool_dir, similarity, percentile, n_stim, n_nonstim, n_candidates=200, seed=None,
+                   processes=None, max_overlap=config.maxListOverlap):
+    """
+    Tops up the stim and nonstim session files of a pool folder (port of makeAllLists.m).
+    The best candidates go to the stim lists, the next best to the nonstim lists. Nothing is written
+    unless every new session can be made within max_overlap
+    :param pool_dir: e.g. pools_EN
+    :param similarity: SimilarityStore of the pool's RAM_wordpool.txt
+    :param n_stim: number of stim sessions wanted
+    :param n_nonstim: number of nonstim sessions wanted
+    :param n_candidates: number of candidate pairs to choose from
+    :param max_overlap: most words a list of a new session may share with a list of another session
+    :return: paths of the files written
+    """
+    pool_words = read_pool_words(os.path.join(pool_dir, 'RAM_wordpool.txt'))
+    if not similarity.is_fresh(pool_words):
+        raise Exception('Similarity store %s was not made for the pool of %s' % (similarity.path, pool_dir))
+    wanted = (('stim_lists', n_stim), ('nonstim_lists', n_nonstim))
+    if all(n_sessions <= _n_sessions(os.path.join(pool_dir, list_dir)) for (list_dir, n_sessions) in wanted):
+        return []
+    candidates = iter(make_candidates(similarity, percentile, n_candidates, seed, processes))
+    rng = np.random.RandomState(seed)
+    chosen = []
+    try:
+        for (list_dir, n_sessions) in wanted:
+            chosen.append((os.path.join(pool_dir, list_dir),
+                           choose_sessions(os.path.join(pool_dir, list_dir), candidates, n_sessions, pool_words,
+                                           rng, max_overlap)))
+    except StopIteration:
+        raise Exception('Not enough candidate sessions within an overlap of %d words; '
+                        'increase the number of candidates' % max_overlap)
+    written = []
+    for (list_dir, sessions) in chosen:
+        written += add_sessions(list_dir, sessions, pool_words)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make new session word lists')
+    parser.add_argument('--language', default='EN', help='EN or SP')
+    parser.add_argument('--stim', type=int, required=True, help='number of stim sessions wanted')
+    parser.add_argument('--nonstim', type=int, required=True, help='number of nonstim sessions wanted')
+    parser.add_argument('--similarity', default=config.similarityFile,
+                        help='similarity matrix (.csv or .mat, default: config.similarityFile)')
+    parser.add_argument('--percentile', type=float, default=90, help='similarity percentile for each pick')
+    parser.add_argument('--candidates', type=int, default=200, help='candidate session pairs to make')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--processes', type=int, help='size of the process pool (default: one per CPU)')
+    parser.add_argument('--max-overlap', type=int, default=config.maxListOverlap,
+                        help='most words a new list may share with a list of another session '
+                             '(default: config.maxListOverlap)')
+    args = parser.parse_args()
+
+    start = time.time()
+    pool_dir = 'pools_%s' % args.language
+    pool_words = read_pool_words(os.path.join(pool_dir, 'RAM_wordpool.txt'))
+    similarity = simstore.open_store(args.similarity, pool_words)
+    written = make_all_lists(pool_dir, similarity, args.percentile, args.stim, args.nonstim,
+                             args.candidates, args.seed, args.processes, args.max_overlap)
+    for path in written:
+        print 'Wrote %s' % path
+    print '%d sessions written in %.1f s' % (len(written), time.time() - start)
+    for list_dir in listbank.LIST_DIRS:
+        if any(os.path.dirname(path) == os.path.join(pool_dir, list_dir) for path in written):
+            print 'Compiled %s' % listbank.compile_list_bank(os.path.join(pool_dir, list_dir), pool_words)
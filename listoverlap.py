@@ -0,0 +1,154 @@
+"""
+Word overlap between the lists of different sessions.
+
+Port of wordpool_generation/check_uniqueness.m. Every list is encoded as a row
+of a sparse incidence matrix over the word pool (one bit per word), so the
+number of words every list shares with every other list is the product of
+the matrix with its transpose. The product is mostly nonzero, so the
+transpose is kept dense and each block of sparse rows is multiplied by it,
+which is faster than a sparse-sparse product; a block of rows at a time bounds
+memory. Lists of the same session are not compared, as a session uses each
+word once.
+
+Without scipy a dense numpy incidence matrix is used instead.
+
+    python listoverlap.py [<list folder> ...] [--max-overlap N]
+
+checks the given folders (default: every pools_*/*_lists folder) and exits
+with status 1 if any two lists of different sessions share more than
+max-overlap words.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+import listbank
+from wordpool import read_pool_words
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+# Most cells of the overlap matrix held in memory at once
+_BLOCK_CELLS = 1 << 24
+
+
+def incidence(sessions, n_words):
+    """
+    :param sessions: n_sessions x n_lists x list_len array of word pool indices
+    :param n_words: size of the word pool
+    :return: (n_sessions * n_lists) x n_words 0/1 matrix, scipy.sparse CSR (int8) if available
+    """
+    rows = np.asarray(sessions).reshape(-1, np.shape(sessions)[-1])
+    if scipy is None:
+        # float32 so the dense product goes through BLAS
+        matrix = np.zeros((len(rows), n_words), dtype=np.float32)
+        matrix[np.arange(len(rows))[:, np.newaxis], rows] = 1
+        return matrix
+    indptr = np.arange(0, rows.size + 1, rows.shape[1])
+    matrix = scipy.sparse.csr_matrix((np.ones(rows.size, dtype=np.int8), rows.ravel(), indptr),
+                                     shape=(len(rows), n_words))
+    # A word repeated within a list still counts once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def check_overlap(sessions, n_words, max_overlap=None):
+    """
+    :param sessions: n_sessions x n_lists x list_len array of word pool indices
+    :param n_words: size of the word pool
+    :param max_overlap: (optional) overlaps above this are reported as violations
+    :return: (n_sessions x n_lists array of the most words each list shares with a list of another session,
+              [((session, list), (session, list), overlap), ...] violations, 0-based, each pair once)
+    """
+    (n_sessions, n_lists, _) = np.shape(sessions)
+    n_rows = n_sessions * n_lists
+    matrix = incidence(sessions, n_words)
+    # The product of a sparse block with the dense transpose is dense, so it is built as such
+    transposed = np.ascontiguousarray(matrix.T.toarray() if scipy is not None else matrix.T)
+    max_shared = np.zeros(n_rows, dtype=np.int8)
+    violations = []
+    # Whole sessions per block, so a block's own sessions are one diagonal band
+    block = max(1, _BLOCK_CELLS // max(1, n_rows * n_lists)) * n_lists
+    for start in range(0, n_rows, block):
+        stop = min(start + block, n_rows)
+        shared = matrix[start:stop].dot(transposed).astype(np.int8)
+        for first in range(0, stop - start, n_lists):
+            shared[first:first + n_lists, start + first:start + first + n_lists] = 0
+        max_shared[start:stop] = shared.max(axis=1)
+        if max_overlap is not None and max_shared[start:stop].max() > max_overlap:
+            (rows, cols) = np.nonzero(shared > max_overlap)
+            rows += start
+            for (row, col) in zip(rows[cols > rows], cols[cols > rows]):
+                violations.append((divmod(row, n_lists), divmod(col, n_lists), int(shared[row - start, col])))
+    return max_shared.reshape(n_sessions, n_lists), violations
+
+
+def within_overlap(sessions, n_words, max_overlap, first_checked=0):
+    """
+    :param sessions: n_sessions x n_lists x list_len array of word pool indices
+    :param n_words: size of the word pool
+    :param max_overlap: most words two lists of different sessions may share
+    :param first_checked: (optional) sessions before this one are only checked against the later ones
+    :return: True if no list of the sessions from first_checked on shares more than max_overlap words
+             with a list of another session
+    """
+    (_, violations) = check_overlap(sessions, n_words, max_overlap)
+    return not any(session2 >= first_checked for (_, (session2, _), _) in violations)
+
+
+def load_sessions(list_dir, pool_words):
+    """
+    :return: n_sessions x n_lists x list_len array of the word pool indices of a list folder
+    """
+    bank = listbank.load_list_bank(list_dir, pool_words)
+    if bank is not None:
+        return np.asarray(bank.words)
+    index_by_word = {}
+    for (index, word) in enumerate(pool_words):
+        index_by_word.setdefault(word, index)
+    return np.array([listbank.read_list_file(filename, index_by_word)
+                     for (_, filename) in listbank.session_files(list_dir)])
+
+
+def default_list_dirs(root='.'):
+    """
+    :return: every list folder of every pools_* folder
+    """
+    return [os.path.join(root, 'pools_%s' % language, list_dir)
+            for language in listbank.LANGUAGES for list_dir in listbank.LIST_DIRS
+            if os.path.isdir(os.path.join(root, 'pools_%s' % language, list_dir))]
+
+
+def report(list_dir, max_overlap=None, max_printed=20):
+    """
+    Checks a list folder and prints the result
+    :return: number of violations
+    """
+    pool_words = read_pool_words(os.path.join(os.path.dirname(os.path.normpath(list_dir)), 'RAM_wordpool.txt'))
+    sessions = load_sessions(list_dir, pool_words)
+    (max_shared, violations) = check_overlap(sessions, len(pool_words), max_overlap)
+    counts = np.bincount(max_shared.ravel())
+    print '%s: %d sessions; lists share at most %d words with another session (%s)' % (
+        list_dir, len(sessions), max_shared.max() if max_shared.size else 0,
+        ', '.join('%d words: %d lists' % (shared, n) for (shared, n) in enumerate(counts) if n))
+    for ((session1, list1), (session2, list2), shared) in violations[:max_printed]:
+        print '  session %d list %d and session %d list %d share %d words' % (
+            session1 + 1, list1 + 1, session2 + 1, list2 + 1, shared)
+    if len(violations) > max_printed:
+        print '  ... %d more' % (len(violations) - max_printed)
+    return len(violations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check word overlap between the lists of different sessions')
+    parser.add_argument('list_dirs', nargs='*', help='list folders (default: every pools_*/*_lists folder)')
+    parser.add_argument('--max-overlap', type=int, help='report list pairs sharing more words than this')
+    args = parser.parse_args()
+    n_violations = sum(report(list_dir, args.max_overlap) for list_dir in args.list_dirs or default_list_dirs())
+    sys.exit(1 if n_violations else 0)
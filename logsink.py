@@ -0,0 +1,145 @@
+"""
+Buffered session and math logs.
+
+BufferedLog stands in for a PyEPL LogTrack (it has the same logMessage) but
+only queues the entry in memory; a background thread passes queued entries
+on to the real track when flush() is called, which FR does at phase
+boundaries (after the last word of a list, and as recall recording starts),
+so no log write happens during a word presentation. Timestamps given as a
+PresentationClock are resolved when the entry is queued, so the logged time
+is the same as with a direct write.
+
+Every entry is also written to a JSON-lines sidecar with its fields typed,
+e.g. {"mstime": ..., "type": "WORD", "item": "CAT", "serialpos": 0, ...}.
+The sidecar can be synced to disk after every flush ('phase'), only when the
+log is closed ('close') or never.
+"""
+
+import atexit
+import collections
+import json
+import os
+import threading
+import time
+
+FSYNC_POLICIES = ('never', 'phase', 'close')
+
+# Names of the fields of known entry types, after the type itself
+ENTRY_FIELDS = {
+    'WORD': ('kind', 'item', 'serialpos', 'stim'),
+    'PRACTICE_WORD': ('item', ),
+    'TRIAL': ('trial', 'list_type'),
+    'SESS_START': ('session', 'session_type', 'version'),
+    'INSTRUCT_VIDEO': ('state', ),
+    'PROB': ('problem', 'response', 'correct', 'rt'),
+}
+
+
+def _typed(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_entry(message, timestamp):
+    """
+    :param message: tab separated log message
+    :param timestamp: (time, latency)
+    :return: dict of the entry with typed fields
+    """
+    if isinstance(message, str):
+        message = message.decode('utf-8')
+    parts = message.split('\t')
+    entry = {'mstime': timestamp[0], 'latency': timestamp[1], 'type': parts[0]}
+    names = ENTRY_FIELDS.get(parts[0], ())
+    for (i, value) in enumerate(parts[1:]):
+        entry[names[i] if i < len(names) else 'field%d' % i] = _typed(value)
+    return entry
+
+
+class BufferedLog:
+
+    def __init__(self, track, sidecar_path=None, fsync='phase', now=None):
+        """
+        :param track: PyEPL LogTrack the entries are written to
+        :param sidecar_path: (optional) path of the JSON-lines copy of the log
+        :param fsync: when to sync the sidecar to disk, one of FSYNC_POLICIES
+        :param now: (optional) function giving the current time, for entries logged without a timestamp
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise Exception('Log fsync policy must be one of %s' % ', '.join(FSYNC_POLICIES))
+        self.track = track
+        self.fsync = fsync
+        self.now = now or (lambda: int(time.time() * 1000))
+        self._sidecar = open(sidecar_path, 'a') if sidecar_path else None
+        self._pending = collections.deque()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='BufferedLog')
+        self._thread.daemon = True
+        self._thread.start()
+        self.written = 0
+        atexit.register(self.close)
+
+    def logMessage(self, message, timestamp=None):
+        """
+        Queues an entry, as LogTrack.logMessage
+        :param timestamp: (time, latency), a time, a PresentationClock, or None for now
+        """
+        if timestamp is None:
+            timestamp = (self.now(), 0)
+        elif hasattr(timestamp, 'get'):
+            timestamp = (timestamp.get(), 0)
+        elif not isinstance(timestamp, (tuple, list)):
+            timestamp = (timestamp, 0)
+        self._pending.append((message, timestamp))
+
+    def flush(self):
+        """
+        Has the background thread write the queued entries; doesn't wait for it
+        """
+        self._wakeup.set()
+
+    def _write_pending(self):
+        with self._lock:
+            if not self._pending:
+                return
+            while self._pending:
+                (message, timestamp) = self._pending.popleft()
+                self.track.logMessage(message, timestamp)
+                if self._sidecar:
+                    self._sidecar.write(json.dumps(parse_entry(message, timestamp), sort_keys=True) + '\n')
+                self.written += 1
+            if self._sidecar:
+                self._sidecar.flush()
+                if self.fsync == 'phase':
+                    os.fsync(self._sidecar.fileno())
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self._write_pending()
+            except Exception as e:
+                print 'WARNING: could not write log: %s' % e
+
+    def close(self):
+        """
+        Writes everything still queued and stops the background thread
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        self._thread.join(5.0)
+        self._write_pending()
+        if self._sidecar:
+            if self.fsync != 'never':
+                os.fsync(self._sidecar.fileno())
+            self._sidecar.close()
+            self._sidecar = None
@@ -0,0 +1,191 @@
+"""
+Pre-serialized Control PC messages.
+
+STATE messages come from the fixed vocabulary in config.state_list and are
+sent several times per word, so each (state, value) message is serialized
+once per session with placeholder values in the fields that change. Sending
+then only copies the template's parts and drops the encoded timestamp (and
+word) into their slots, instead of building and serializing a new message.
+
+Prepared messages are sent with ram_control.send like any other message,
+which serializes them through jsonize(). A template is only used if
+serializing the message twice gives the same text with each placeholder
+appearing exactly once; otherwise the message is built the usual way.
+
+To compare the cost of building messages with and without templates:
+    python messagetemplates.py [n_messages]
+"""
+
+import json
+import sys
+import time
+
+# Placeholders, chosen so they cannot collide with real field values
+_TIMESTAMP_PLACEHOLDER = 918273645546372.5
+_WORD_PLACEHOLDER = u'\x00WORD\x00'
+
+
+def _encode_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def _encode_string(value):
+    return json.dumps(value)
+
+
+class PreparedMessage:
+
+    def __init__(self, parts):
+        """
+        A message whose serialized form is already known
+        :param parts: the serialized message, as a list of strings
+        """
+        self._parts = parts
+
+    def jsonize(self):
+        return ''.join(self._parts)
+
+
+class MessageTemplate:
+
+    def __init__(self, text, slots):
+        """
+        :param text: serialized message containing each placeholder once
+        :param slots: [(field, placeholder, encoder), ...] to substitute
+        """
+        self.encoders = dict((field, encoder) for (field, _, encoder) in slots)
+        positions = sorted((text.index(encoder(placeholder)), len(encoder(placeholder)), field)
+                           for (field, placeholder, encoder) in slots)
+        # Alternate fixed text and slots: [text, slot, text, slot, ..., text]
+        self.parts = []
+        self.slot_index = {}
+        last_end = 0
+        for (start, length, field) in positions:
+            self.parts.append(text[last_end:start])
+            self.slot_index[field] = len(self.parts)
+            self.parts.append(None)
+            last_end = start + length
+        self.parts.append(text[last_end:])
+
+    def fill(self, **values):
+        """
+        :param values: value for each slot of the template
+        :return: PreparedMessage with the values in place
+        """
+        parts = self.parts[:]
+        for (field, value) in values.items():
+            parts[self.slot_index[field]] = self.encoders[field](value)
+        return PreparedMessage(parts)
+
+
+def _make_template(build, slots):
+    """
+    :param build: function building the message from the placeholder values
+    :param slots: [(field, placeholder, encoder), ...]
+    :return: MessageTemplate, or None if the message cannot be templated
+    """
+    placeholders = dict((field, placeholder) for (field, placeholder, _) in slots)
+    try:
+        texts = [build(**placeholders).jsonize() for _ in range(2)]
+    except Exception:
+        return None
+    if texts[0] != texts[1]:
+        # Something other than the placeholders (e.g. a message id) changes per message
+        return None
+    for (_, placeholder, encoder) in slots:
+        if texts[0].count(encoder(placeholder)) != 1:
+            return None
+    return MessageTemplate(texts[0], slots)
+
+
+class MessageTemplateCache:
+
+    def __init__(self, ram_control, word_message_class=None):
+        """
+        :param ram_control: RAMControl instance used to build the template messages
+        :param word_message_class: (optional) class of WORD messages, e.g. ramcontrol.messages.WordMessage
+        """
+        self.ram_control = ram_control
+        self.word_message_class = word_message_class
+        self._state_templates = {}
+        self._word_template = None
+        self._word_template_made = False
+
+    def clear(self):
+        self._state_templates.clear()
+        self._word_template = None
+        self._word_template_made = False
+
+    def prepare(self, state_list):
+        """
+        Builds the templates for every state message of a session
+        :param state_list: the states that can be sent (config.state_list)
+        """
+        self.clear()
+        for state in state_list:
+            for value in (True, False):
+                self._state_template(state, value)
+        self._get_word_template()
+
+    def _state_template(self, state, value):
+        key = (state, value)
+        if key not in self._state_templates:
+            self._state_templates[key] = _make_template(
+                lambda timestamp: self.ram_control.build_message('STATE', state=state, value=value,
+                                                                 meta=None, timestamp=timestamp),
+                [('timestamp', _TIMESTAMP_PLACEHOLDER, _encode_number)])
+        return self._state_templates[key]
+
+    def _get_word_template(self):
+        if not self._word_template_made and self.word_message_class:
+            self._word_template = _make_template(
+                lambda word, timestamp: self.word_message_class(word, timestamp=timestamp),
+                [('word', _WORD_PLACEHOLDER, _encode_string),
+                 ('timestamp', _TIMESTAMP_PLACEHOLDER, _encode_number)])
+            self._word_template_made = True
+        return self._word_template
+
+    def state_message(self, state, value, timestamp):
+        """
+        :return: PreparedMessage for a STATE message, or None if it can't be templated
+        """
+        template = self._state_template(state, bool(value))
+        return template.fill(timestamp=timestamp) if template else None
+
+    def word_message(self, word, timestamp):
+        """
+        :return: PreparedMessage for a WORD message, or None if it can't be templated
+        """
+        template = self._get_word_template()
+        return template.fill(word=word, timestamp=timestamp) if template else None
+
+
+def benchmark(ram_control, n_messages=10000):
+    """
+    Times building STATE messages with and without templates
+    :return: (microseconds per message built, microseconds per message from a template)
+    """
+    cache = MessageTemplateCache(ram_control)
+    cache.prepare(['WORD'])
+    if cache.state_message('WORD', True, 0) is None:
+        raise Exception('STATE messages from this RAMControl cannot be templated')
+
+    start = time.time()
+    for i in range(n_messages):
+        ram_control.build_message('STATE', state='WORD', value=True, meta=None, timestamp=i).jsonize()
+    built = (time.time() - start) / n_messages * 1e6
+
+    start = time.time()
+    for i in range(n_messages):
+        cache.state_message('WORD', True, i).jsonize()
+    templated = (time.time() - start) / n_messages * 1e6
+    return built, templated
+
+
+if __name__ == '__main__':
+    from ramcontrol.RAMControl import RAMControl
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print 'build_message: %.1f us/message\ntemplate:      %.1f us/message' % benchmark(RAMControl.instance(), n)
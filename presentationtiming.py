@@ -0,0 +1,91 @@
+"""
+Scheduled vs. actual presentation times.
+
+Every timed event of a session (orient cross, words, recall marker, beeps,
+recording start) is recorded with the time the PresentationClock scheduled it
+for and the timestamps PyEPL reported for it. At the end of the session the
+full table and per-phase summaries of onset lateness and duration error are
+written to the session folder.
+"""
+
+import numpy as np
+
+TIMING_FILE = 'timing.tsv'
+SUMMARY_FILE = 'timing_summary.tsv'
+
+_COLUMNS = ('phase', 'trial', 'index', 'scheduled_on', 'actual_on', 'scheduled_duration', 'actual_off')
+
+
+def timestamp_time(timestamp):
+    """
+    :param timestamp: PyEPL timestamp, a (time, latency) tuple, or a plain time
+    :return: the time in ms, or None
+    """
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, tuple):
+        return timestamp[0]
+    return timestamp
+
+
+def _stats(values):
+    if len(values) == 0:
+        return (float('nan'),) * 4
+    return (np.mean(values), np.percentile(values, 95), np.percentile(values, 99), np.max(values))
+
+
+class PresentationTimer:
+
+    def __init__(self):
+        self.rows = []
+
+    def record(self, phase, scheduled_on, timestamp_on, scheduled_duration=None, timestamp_off=None,
+               trial=-1, index=-1):
+        """
+        Records one presentation. Only appends; all computation is left for the end of the session
+        :param phase: 'WORD', 'ORIENT', ...
+        :param scheduled_on: time the clock scheduled the onset for (clock.get() before presenting)
+        :param timestamp_on: onset timestamp returned by PyEPL
+        :param scheduled_duration: (optional) intended duration in ms
+        :param timestamp_off: (optional) offset timestamp returned by PyEPL
+        :param trial: (optional) list number, -1 for practice
+        :param index: (optional) serial position within the list
+        """
+        self.rows.append((phase, trial, index, scheduled_on, timestamp_time(timestamp_on),
+                          scheduled_duration, timestamp_time(timestamp_off)))
+
+    def summary(self):
+        """
+        :return: {phase: {'n':, 'lateness': (mean, p95, p99, max), 'duration_error': (mean, p95, p99, max)}}
+        """
+        summary = {}
+        for phase in sorted(set(row[0] for row in self.rows)):
+            rows = [row for row in self.rows if row[0] == phase]
+            lateness = np.array([on - scheduled for (_, _, _, scheduled, on, _, _) in rows
+                                 if scheduled is not None and on is not None], dtype=float)
+            duration_error = np.array([(off - on) - duration for (_, _, _, _, on, duration, off) in rows
+                                       if None not in (on, duration, off)], dtype=float)
+            summary[phase] = {'n': len(rows),
+                              'lateness': _stats(lateness),
+                              'duration_error': _stats(duration_error)}
+        return summary
+
+    def write(self, session):
+        """
+        Writes the timing table and its summary
+        :param session: PyEPL session to create the files in (exp.session)
+        """
+        table = session.createFile(TIMING_FILE)
+        table.write('\t'.join(_COLUMNS) + '\n')
+        for row in self.rows:
+            table.write('\t'.join('' if value is None else str(value) for value in row) + '\n')
+        table.close()
+
+        summary_file = session.createFile(SUMMARY_FILE)
+        summary_file.write('phase\tn\tlateness_mean\tlateness_p95\tlateness_p99\tlateness_max\t'
+                           'duration_error_mean\tduration_error_p95\tduration_error_p99\tduration_error_max\n')
+        for (phase, stats) in sorted(self.summary().items()):
+            summary_file.write('%s\t%d\t%s\n' % (phase, stats['n'],
+                                                 '\t'.join('%.2f' % value for value in
+                                                           stats['lateness'] + stats['duration_error'])))
+        summary_file.close()
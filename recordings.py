@@ -0,0 +1,192 @@
+"""
+Background processing of finished recall recordings.
+
+PyEPL writes each recall recording to <label>.wav when record() returns.
+RecordingWorker takes the finished files on a background thread, runs any
+analysis stages on them (e.g. vocalization onsets, see vad.py) and compresses
+them losslessly (gzip, to <label>.wav.gz), reading and writing in fixed-size
+chunks so memory use doesn't grow with the recording length. The original
+.wav is only removed once the compressed copy has been read back and its
+checksum matches.
+
+Compression holds the interpreter lock while each chunk is compressed, so the
+worker can be held while words are on the screen (hold() / release()) and
+chunks are kept small.
+"""
+
+import collections
+import gzip
+import os
+import threading
+import time
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+COMPRESSED_SUFFIX = '.gz'
+
+
+def _crc(chunks):
+    crc = 0
+    size = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+    return crc & 0xffffffff, size
+
+
+def _read_chunks(f, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def compress_file(path, chunk_size=CHUNK_SIZE, wait=None):
+    """
+    Compresses a file to path + '.gz' and removes the original
+    :param path: file to compress
+    :param chunk_size: bytes read and compressed at a time
+    :param wait: (optional) function called before each chunk, to pause between chunks
+    :return: (original size, compressed size)
+    """
+    out_path = path + COMPRESSED_SUFFIX
+    tmp_path = out_path + '.tmp'
+    with open(path, 'rb') as original:
+        compressed = gzip.open(tmp_path, 'wb')
+        try:
+            for chunk in _read_chunks(original, chunk_size):
+                if wait:
+                    wait()
+                compressed.write(chunk)
+        finally:
+            compressed.close()
+
+    # Only delete the recording once the compressed copy reads back the same
+    with open(path, 'rb') as original:
+        expected = _crc(_read_chunks(original, chunk_size))
+    compressed = gzip.open(tmp_path, 'rb')
+    try:
+        actual = _crc(_read_chunks(compressed, chunk_size))
+    finally:
+        compressed.close()
+    if actual != expected:
+        os.remove(tmp_path)
+        raise Exception('Compressed copy of %s does not match the original' % path)
+
+    os.rename(tmp_path, out_path)
+    os.remove(path)
+    return expected[1], os.path.getsize(out_path)
+
+
+class RecordingWorker:
+
+    def __init__(self, compress=True, file_timeout=5.0):
+        """
+        :param compress: compress recordings and remove the .wav files
+        :param file_timeout: seconds to wait for a submitted recording to appear on disk
+        """
+        self.compress = compress
+        self.file_timeout = file_timeout
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._allowed = threading.Event()
+        self._allowed.set()
+        self._thread = None
+        self._running = False
+        self._busy = False
+
+        # Counters
+        self.processed = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # Functions called with (path, *args) for each recording before it is compressed
+        self.stages = []
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='RecordingWorker')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def hold(self):
+        """
+        Pauses processing (between chunks) until release()
+        """
+        self._allowed.clear()
+
+    def release(self):
+        self._allowed.set()
+
+    def submit(self, path, *args):
+        """
+        Queues a finished recording
+        :param path: path of the .wav file
+        :param args: (optional) passed on to the stages
+        """
+        if self._thread is None:
+            self.start()
+        self._queue.append((path, args))
+        self._wakeup.set()
+
+    def _wait_for_file(self, path):
+        deadline = time.time() + self.file_timeout
+        while not os.path.exists(path) and time.time() < deadline:
+            time.sleep(.05)
+        return os.path.exists(path)
+
+    def _process(self, path, args):
+        if not self._wait_for_file(path):
+            raise Exception('Recording %s was not written' % path)
+        for stage in self.stages:
+            self._allowed.wait()
+            stage(path, *args)
+        if self.compress:
+            (size_in, size_out) = compress_file(path, wait=self._allowed.wait)
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+
+    def _run(self):
+        while self._running or self._queue:
+            self._wakeup.wait(.1)
+            self._wakeup.clear()
+            while self._queue:
+                self._busy = True
+                (path, args) = self._queue.popleft()
+                try:
+                    self._process(path, args)
+                    self.processed += 1
+                except Exception as e:
+                    self.errors += 1
+                    print 'WARNING: could not process recording %s: %s' % (path, e)
+                finally:
+                    self._busy = False
+
+    def flush(self, timeout=60.0):
+        """
+        Waits until every submitted recording has been processed
+        :return: True if the queue was drained
+        """
+        self.release()
+        deadline = time.time() + timeout
+        self._wakeup.set()
+        while (self._queue or self._busy) and time.time() < deadline:
+            time.sleep(.01)
+        return not (self._queue or self._busy)
+
+    def stop(self, timeout=60.0):
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._running = False
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        return {'processed': self.processed, 'errors': self.errors,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'pending': len(self._queue)}
@@ -0,0 +1,160 @@
+"""
+Vectorized construction of session plans.
+
+A plan decides, for every session of a subject, which source session file
+is used, the order of the lists within the session, the order of the words
+within each list and which lists are stimulated:
+
+* Words are shuffled within each list
+* nBaselineTrials non-stim lists are placed at the start of the session
+* The remaining lists are split into two halves, each containing half of the
+  stim lists and half of the remaining non-stim lists, shuffled within the half
+
+All the shuffles are drawn up front from a RandomState seeded by the subject
+code and applied with argsorts over whole arrays, so the same subject always
+gets the same plan and plans for many subjects can be built at once.
+
+To time plan generation for simulated subjects:
+    python sessionplan.py [n_subjects]
+"""
+
+import hashlib
+import sys
+import time
+
+import numpy as np
+
+# Position of each block within a session
+BASELINE_BLOCK, FIRST_HALF_BLOCK, SECOND_HALF_BLOCK = 0, 1, 2
+
+
+def subject_seed(subject):
+    """
+    :param subject: subject code
+    :return: 32 bit seed that is stable across runs and machines
+    """
+    return int(hashlib.md5(subject.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def subject_rng(subject):
+    """
+    :param subject: subject code
+    :return: RandomState seeded from the subject code
+    """
+    return np.random.RandomState(subject_seed(subject))
+
+
+def _take_last(a, indices):
+    """
+    Reorders the last axes of a by indices, independently for each leading index
+    :param a: array of shape (..., n, ...)
+    :param indices: integer array of the same leading shape as a, ending in n
+    :return: a reordered along axis indices.ndim - 1
+    """
+    grid = list(np.ogrid[tuple(slice(n) for n in indices.shape)])
+    grid[-1] = indices
+    return a[tuple(grid)]
+
+
+def _ranks(keys):
+    """
+    :param keys: array of sort keys
+    :return: rank of each key along the last axis
+    """
+    return np.argsort(np.argsort(keys, axis=-1), axis=-1)
+
+
+def _draw(rng, n_sessions, n_lists, list_len, paired):
+    """
+    Draws all of the random numbers needed for one subject's plan
+    :return: (session_order, word_keys, group_keys, order_keys)
+    """
+    if paired:
+        # Sessions are used in pairs (1, 2), (3, 4)... so stim positions stay counterbalanced.
+        # Shuffle the pairs, then the two sessions within each pair
+        pairs = np.arange(n_sessions).reshape(-1, 2)[rng.permutation(n_sessions // 2)]
+        flip = rng.randint(0, 2, len(pairs))
+        pairs[flip == 1] = pairs[flip == 1, ::-1]
+        session_order = pairs.ravel()
+    else:
+        session_order = rng.permutation(n_sessions)
+    word_keys = rng.random_sample((n_sessions, n_lists, list_len))
+    group_keys = rng.random_sample((n_sessions, n_lists))
+    order_keys = rng.random_sample((n_sessions, n_lists))
+    return session_order, word_keys, group_keys, order_keys
+
+
+def _plan(words, n_stim, n_baseline, word_keys, group_keys, order_keys):
+    """
+    Builds plans from pre-drawn random keys. All leading dimensions are batched.
+    :param words: word indices of size (..., nLists, listLen), stim lists first
+    :return: (plan_words, plan_is_stim)
+    """
+    n_lists = words.shape[-2]
+    n_nonstim = n_lists - n_stim
+    n_remaining = n_nonstim - n_baseline
+
+    # Shuffle within the lists
+    words = _take_last(words, np.argsort(word_keys, axis=-1))
+
+    # Random rank of each list within its type (stim lists sort before nonstim lists)
+    is_stim = np.arange(n_lists) < n_stim
+    rank = _ranks(group_keys + np.where(is_stim, 0, 2))
+    nonstim_rank = rank - n_stim - n_baseline
+
+    # Assign each list to a block
+    stim_block = np.where(rank < n_stim // 2, FIRST_HALF_BLOCK, SECOND_HALF_BLOCK)
+    nonstim_block = np.where(nonstim_rank < 0, BASELINE_BLOCK,
+                             np.where(nonstim_rank < n_remaining // 2, FIRST_HALF_BLOCK, SECOND_HALF_BLOCK))
+    block = np.where(is_stim, stim_block, nonstim_block)
+
+    # Order by block, shuffled within each block
+    order = np.argsort(block + order_keys, axis=-1)
+    plan_words = _take_last(words, order)
+    plan_is_stim = is_stim[order]
+    return plan_words, plan_is_stim
+
+
+def plan_sessions(words, n_stim, n_baseline, rng, paired=False):
+    """
+    Builds the plan for every session of one subject
+    :param words: word indices of size nSessions x nLists x listLen, one entry per source
+                  session file, with each session's stim lists first
+    :param n_stim: number of stim lists per session
+    :param n_baseline: number of nonstim lists to put at the start of each session
+    :param rng: RandomState to draw from (see subject_rng)
+    :param paired: whether source sessions are counterbalanced in pairs (stim experiments)
+    :return: (plan_words, plan_is_stim) of size nSessions x nLists x listLen and nSessions x nLists
+    """
+    words = np.asarray(words)
+    (session_order, word_keys, group_keys, order_keys) = _draw(rng, *(words.shape + (paired,)))
+    return _plan(words[session_order], n_stim, n_baseline, word_keys, group_keys, order_keys)
+
+
+def plan_subjects(words, subjects, n_stim, n_baseline, paired=False):
+    """
+    Builds the plans for many subjects at once. Each subject's plan is identical to
+    plan_sessions(words, n_stim, n_baseline, subject_rng(subject), paired)
+    :param words: word indices of size nSessions x nLists x listLen
+    :param subjects: list of subject codes
+    :return: (plan_words, plan_is_stim) with a leading nSubjects dimension
+    """
+    words = np.asarray(words)
+    draws = [_draw(subject_rng(subject), *(words.shape + (paired,))) for subject in subjects]
+    (session_orders, word_keys, group_keys, order_keys) = [np.array(d) for d in zip(*draws)]
+    return _plan(words[session_orders], n_stim, n_baseline, word_keys, group_keys, order_keys)
+
+
+if __name__ == '__main__':
+    import listbank
+    from wordpool import read_pool_words
+
+    n_subjects = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    pool_words = read_pool_words('pools_EN/RAM_wordpool.txt')
+    for (list_dir, n_stim, n_baseline, paired) in (('pools_EN/nonstim_lists', 0, 0, False),
+                                                   ('pools_EN/stim_lists', 11, 3, True)):
+        bank = listbank.load_list_bank(list_dir, pool_words) or \
+            listbank.ListBank(listbank.compile_list_bank(list_dir, pool_words))
+        start = time.time()
+        plan_subjects(bank.words, ['SIM%05d' % i for i in range(n_subjects)], n_stim, n_baseline, paired)
+        print '%s: %d subjects in %.2f s' % (list_dir, n_subjects, time.time() - start)
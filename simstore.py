@@ -0,0 +1,289 @@
+"""
+Binary store of the word pool's semantic similarity matrix.
+
+config.similarityFile names the matrix as a pool x pool CSV (optionally with
+the words as a header row and first column); the similarity matrices in
+wordpool_generation/RAM_FR_WORDS.mat can be converted as well. The matrix is
+converted once to float32 next to its source, in a file named by a checksum
+of the word pool it belongs to, e.g.
+
+    wordpool_generation/RAM_FR_LSA.<pool checksum>.sim
+
+and memory-mapped from then on, so single rows and submatrices are read
+without parsing or loading the whole matrix. A symmetric matrix can be stored
+packed (upper triangle only), halving its size. The file also holds, for
+every word, its mean similarity to the other words and the percentiles of
+those similarities (PERCENTILES), ignoring missing values.
+
+To convert:
+    python simstore.py [<similarity file>] [--pool pools_EN/RAM_wordpool.txt] [--packed]
+"""
+
+import argparse
+import codecs
+import os
+import struct
+import warnings
+
+import numpy as np
+
+import config
+from listbank import pool_checksum
+from wordpool import read_pool_words
+
+STORE_MAGIC = 'FRSM'
+STORE_VERSION = 1
+STORE_EXTENSION = '.sim'
+
+# Percentiles kept for every word
+PERCENTILES = np.arange(0, 101, 5)
+
+# magic, version, packed, n words, n percentiles, pool sha1
+_HEADER = struct.Struct('<4sHHII40s')
+_DTYPE = np.dtype('<f4')
+
+# Matrix used when the configured file isn't there
+MAT_FILE = os.path.join('wordpool_generation', 'RAM_FR_WORDS.mat')
+MAT_MEASURE = 'LSA'
+
+
+def store_path(source, pool_words):
+    """
+    :param source: similarity file (.csv or .mat)
+    :param pool_words: words of the pool in pool order
+    :return: path of the store for that source and pool
+    """
+    return '%s.%s%s' % (os.path.splitext(source)[0], pool_checksum(pool_words)[:12], STORE_EXTENSION)
+
+
+def _packed_offsets(n):
+    """
+    :return: offset of the start of each row's upper triangle (diagonal included) in the packed matrix
+    """
+    rows = np.arange(n, dtype=np.int64)
+    return rows * n - rows * (rows - 1) // 2
+
+
+def _read_csv_rows(path, pool_words):
+    """
+    Yields the rows of a CSV matrix one at a time, skipping a header row and a first column of words
+    """
+    lines = codecs.open(path, encoding='utf-8')
+    first_row = True
+    for line in lines:
+        fields = line.strip().split(',')
+        if not line.strip():
+            continue
+        if first_row:
+            first_row = False
+            try:
+                float(fields[-1])
+            except ValueError:
+                header = [field.strip().strip('"') for field in fields[-len(pool_words):]]
+                if header != pool_words:
+                    raise Exception('Words of %s do not match the word pool' % path)
+                continue
+        try:
+            float(fields[0])
+        except ValueError:
+            fields = fields[1:]
+        yield np.array([float(field) if field.strip() not in ('', 'NaN', 'nan') else np.nan
+                        for field in fields], dtype=_DTYPE)
+
+
+def _read_mat_rows(path, pool_words, measure=MAT_MEASURE):
+    """
+    Yields the rows of a matrix of a .mat file, whose RAM_FR_WORDS must be the words of the pool in pool order
+    """
+    import scipy.io
+    contents = scipy.io.loadmat(path)
+    # A cell array: each cell holds a 1-element array of the word
+    words = [unicode(cell.ravel()[0].ravel()[0]) if cell.ravel()[0].size else u''
+             for cell in contents['RAM_FR_WORDS']]
+    if words != list(pool_words):
+        raise Exception('Words of %s do not match the word pool' % path)
+    for row in contents['RAM_FR_WP_%s' % measure]:
+        yield row.astype(_DTYPE)
+
+
+def convert(source, pool_words, out_path=None, packed=False):
+    """
+    Converts a similarity matrix to a store
+    :param source: pool x pool .csv, or a .mat file with RAM_FR_WP_LSA
+    :param pool_words: words of the pool in pool order (the order of the matrix)
+    :param out_path: (optional) where to write the store. Defaults to store_path(source, pool_words)
+    :param packed: store only the upper triangle; the matrix must be symmetric
+    :return: the path of the written store
+    """
+    out_path = out_path or store_path(source, pool_words)
+    n = len(pool_words)
+    n_values = n * (n + 1) // 2 if packed else n * n
+    size = _HEADER.size + _DTYPE.itemsize * (n_values + n + n * len(PERCENTILES))
+    rows = _read_mat_rows(source, pool_words) if source.endswith('.mat') else _read_csv_rows(source, pool_words)
+
+    # Write to the side and move into place so a reader never sees a partial store
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as store_file:
+        store_file.write(_HEADER.pack(STORE_MAGIC, STORE_VERSION, int(packed), n, len(PERCENTILES),
+                                      pool_checksum(pool_words)))
+        store_file.truncate(size)
+    values = np.memmap(tmp_path, dtype=_DTYPE, mode='r+', offset=_HEADER.size, shape=(n_values, ))
+    offsets = _packed_offsets(n)
+    n_rows = 0
+    try:
+        for (i, row) in enumerate(rows):
+            if i >= n or len(row) != n:
+                raise Exception('%s is not a %d x %d matrix' % (source, n, n))
+            if packed:
+                # The lower triangle is not stored, so it must match what is
+                lower = values[offsets[:i] + i - np.arange(i)]
+                if not np.allclose(row[:i], lower, atol=1e-6, equal_nan=True):
+                    raise Exception('%s is not symmetric and cannot be packed' % source)
+                values[offsets[i]:offsets[i] + n - i] = row[i:]
+            else:
+                values[i * n:(i + 1) * n] = row
+            n_rows += 1
+        if n_rows != n:
+            raise Exception('%s is not a %d x %d matrix' % (source, n, n))
+    except Exception:
+        del values
+        os.remove(tmp_path)
+        raise
+    values.flush()
+    del values
+
+    store = SimilarityStore(tmp_path, mode='r+')
+    store._write_tables()
+    del store
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    os.rename(tmp_path, out_path)
+    return out_path
+
+
+class SimilarityStore:
+
+    def __init__(self, path, mode='r'):
+        """
+        Memory-maps a store
+        :param path: path of the store
+        """
+        self.path = path
+        with open(path, 'rb') as store_file:
+            header = store_file.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise Exception('Similarity store %s is truncated' % path)
+        (magic, version, packed, self.n, n_percentiles, self.pool_checksum) = _HEADER.unpack(header)
+        if magic != STORE_MAGIC or version != STORE_VERSION or n_percentiles != len(PERCENTILES):
+            raise Exception('%s is not a version %d similarity store' % (path, STORE_VERSION))
+        self.packed = bool(packed)
+        n_values = self.n * (self.n + 1) // 2 if self.packed else self.n * self.n
+        data = np.memmap(path, dtype=_DTYPE, mode=mode, offset=_HEADER.size,
+                         shape=(n_values + self.n + self.n * n_percentiles, ))
+        self._data = data
+        self.values = data[:n_values]
+        # Mean similarity of each word to the others
+        self.mean = data[n_values:n_values + self.n]
+        # PERCENTILES of each word's similarity to the others
+        self.percentiles = data[n_values + self.n:].reshape(self.n, n_percentiles)
+        self._offsets = _packed_offsets(self.n) if self.packed else None
+
+    def __len__(self):
+        return self.n
+
+    def is_fresh(self, pool_words):
+        """
+        :return: True if the store was made for this word pool
+        """
+        return self.pool_checksum == pool_checksum(pool_words)
+
+    def _indices(self, rows, cols):
+        """
+        :return: positions in self.values of the (row, col) pairs, broadcast together
+        """
+        (rows, cols) = np.broadcast_arrays(np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))
+        if not self.packed:
+            return rows * self.n + cols
+        (low, high) = (np.minimum(rows, cols), np.maximum(rows, cols))
+        return self._offsets[low] + high - low
+
+    def row(self, i):
+        """
+        :return: similarities of word i to every word
+        """
+        if not self.packed:
+            return self.values[i * self.n:(i + 1) * self.n]
+        return self.values[self._indices(i, np.arange(self.n))]
+
+    def submatrix(self, rows, cols):
+        """
+        :return: len(rows) x len(cols) array of similarities
+        """
+        return self.values[self._indices(np.asarray(rows)[:, np.newaxis], np.asarray(cols)[np.newaxis, :])]
+
+    def matrix(self):
+        """
+        :return: the whole n x n matrix (memory-mapped unless packed)
+        """
+        if not self.packed:
+            return self.values.reshape(self.n, self.n)
+        return self.submatrix(np.arange(self.n), np.arange(self.n))
+
+    @property
+    def no_values(self):
+        """
+        :return: boolean array, True for words without a similarity to any other word
+        """
+        return np.isnan(self.mean)
+
+    def percentile(self, i, q):
+        """
+        :return: the q-th percentile of word i's similarities to the other words, interpolated from the table
+        """
+        return np.interp(q, PERCENTILES, self.percentiles[i])
+
+    def _write_tables(self, block=1024):
+        with warnings.catch_warnings():
+            # Words without values give empty means
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for start in range(0, self.n, block):
+                stop = min(start + block, self.n)
+                rows = np.array(self.submatrix(np.arange(start, stop), np.arange(self.n)), dtype=np.float64)
+                rows[np.arange(stop - start), np.arange(start, stop)] = np.nan
+                self.mean[start:stop] = np.nanmean(rows, axis=1)
+                self.percentiles[start:stop] = np.nanpercentile(rows, PERCENTILES, axis=1).T
+        self._data.flush()
+
+
+def open_store(source, pool_words, packed=None):
+    """
+    Opens the store of a similarity file for a word pool, converting the file first if needed
+    :param source: similarity file (e.g. config.similarityFile); the .mat matrix is used if it doesn't exist
+    :param pool_words: words of the pool in pool order
+    :param packed: (optional) True or False to have the store packed or not, converting it again if it isn't.
+                   By default an existing store is used either way, and a new one is not packed
+    :return: SimilarityStore
+    """
+    if not os.path.exists(source) and os.path.exists(MAT_FILE):
+        source = MAT_FILE
+    path = store_path(source, pool_words)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        try:
+            store = SimilarityStore(path)
+            if store.is_fresh(pool_words) and packed in (None, store.packed):
+                return store
+        except Exception as e:
+            print 'WARNING: could not read similarity store %s (%s)' % (path, e)
+    return SimilarityStore(convert(source, pool_words, path, bool(packed)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a similarity matrix to a memory-mapped store')
+    parser.add_argument('source', nargs='?', default=config.similarityFile,
+                        help='pool x pool .csv (default: config.similarityFile) or .mat file')
+    parser.add_argument('--pool', default=os.path.join('pools_EN', 'RAM_wordpool.txt'), help='word pool file')
+    parser.add_argument('--packed', action='store_true', help='store only the upper triangle')
+    args = parser.parse_args()
+    store = open_store(args.source, read_pool_words(args.pool), args.packed or None)
+    print '%s: %d words%s, %d without values' % (store.path, store.n, ' (packed)' if store.packed else '',
+                                                 np.sum(store.no_values))
@@ -1,9 +1,12 @@
 #!/usr/bin/python
 from pyepl.locals import *
+from statejournal import StateJournal, journal_path
 def skip_session(exp):
     # create tracks
     state = exp.restoreState()
     exp.setSession(state.sessionNum)
+    journal = StateJournal(journal_path(exp))
+    journal.replay(state)
 
     video = VideoTrack("video")
     keyboard = KeyTrack("keyboard")
@@ -22,9 +25,7 @@ def skip_session(exp):
 
     if b==continueKey:
         print 'skipping session...'
-        state.sessionNum +=1 
-        state.trialNum = 0
-        exp.saveState(state)
+        journal.compact(exp, state, sessionNum=state.sessionNum + 1, trialNum=0)
         log.logMessage('SESSION_SKIPPED',PresentationClock().get())
 
     
@@ -0,0 +1,225 @@
+"""
+Append-only journal of session progress.
+
+Saving the PyEPL state re-pickles everything in it, including the word lists
+for every session. During a session only a handful of progress fields change,
+so those are appended to a small journal file instead, one fixed-size record
+per update, and folded back into the state snapshot (compacted) at the end of
+the session.
+
+Each record holds the snapshot epoch it applies to; compacting bumps the epoch
+in the snapshot before truncating the journal, so records left behind by a
+crash between the two steps are ignored rather than replayed onto the newer
+snapshot.
+
+StateManager puts the snapshot and the journal behind one object that loads
+the state from disk once per process and serves every later read from memory.
+The snapshot is written as an argparse.Namespace, so tools reading the state
+file (playIntro.py, skipSession.py) need nothing but the standard library.
+"""
+
+import argparse
+import os
+import struct
+import zlib
+
+JOURNAL_NAME = 'state.journal'
+
+# Fields of the state tracked by the journal, in record order
+JOURNAL_FIELDS = ('sessionNum', 'trialNum', 'practiceDone', 'session_started')
+
+# epoch, sessionNum, trialNum, practiceDone, session_started
+_RECORD = struct.Struct('<IiiBB')
+_CRC = struct.Struct('<I')
+RECORD_SIZE = _RECORD.size + _CRC.size
+
+
+def snapshot(state):
+    """
+    :param state: state object
+    :return: copy of the state's fields, as written to the state file
+    """
+    return argparse.Namespace(**vars(state))
+
+
+def journal_path(exp):
+    """
+    :param exp: Experiment object, with its session set
+    :return: path of the journal in the subject folder
+    """
+    return os.path.join(exp.session.fullPath(), '..', JOURNAL_NAME)
+
+
+class StateJournal:
+
+    def __init__(self, path):
+        """
+        :param path: path of the journal file
+        """
+        self.path = path
+        self._fd = None
+
+    def _open(self):
+        if self._fd is None:
+            # Drop any torn record left by a crash so new records stay aligned
+            intact_size = len(self._read_records()) * RECORD_SIZE
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if os.fstat(self._fd).st_size > intact_size:
+                os.ftruncate(self._fd, intact_size)
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def append(self, state):
+        """
+        Records the current progress fields of the state with one synced write
+        :param state: state object
+        """
+        record = _RECORD.pack(getattr(state, 'journalEpoch', 0),
+                              state.sessionNum,
+                              state.trialNum,
+                              bool(state.practiceDone),
+                              bool(state.session_started))
+        fd = self._open()
+        os.write(fd, record + _CRC.pack(zlib.crc32(record) & 0xffffffff))
+        os.fsync(fd)
+
+    def _read_records(self):
+        """
+        :return: list of (epoch, {field: value}) for every intact record in the journal
+        """
+        if not os.path.exists(self.path):
+            return []
+        data = open(self.path, 'rb').read()
+        records = []
+        for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            record = data[offset:offset + _RECORD.size]
+            (crc, ) = _CRC.unpack_from(data, offset + _RECORD.size)
+            if zlib.crc32(record) & 0xffffffff != crc:
+                # Torn write from a crash; nothing after it can be trusted
+                break
+            values = _RECORD.unpack(record)
+            fields = dict(zip(JOURNAL_FIELDS, values[1:]))
+            fields['practiceDone'] = bool(fields['practiceDone'])
+            fields['session_started'] = bool(fields['session_started'])
+            records.append((values[0], fields))
+        return records
+
+    def replay(self, state):
+        """
+        Applies the latest journal record for the state's snapshot to the state
+        :param state: state object restored from the snapshot
+        :return: the state
+        """
+        epoch = getattr(state, 'journalEpoch', 0)
+        latest = None
+        for (record_epoch, fields) in self._read_records():
+            if record_epoch == epoch:
+                latest = fields
+        if latest:
+            for (field, value) in latest.items():
+                setattr(state, field, value)
+        return state
+
+    def compact(self, exp, state, **fields):
+        """
+        Folds the journal into the state snapshot and empties the journal
+        :param exp: Experiment object
+        :param state: state object
+        :param fields: (optional) fields to update in the snapshot, as with exp.saveState
+        """
+        for (field, value) in fields.items():
+            setattr(state, field, value)
+        state.journalEpoch = getattr(state, 'journalEpoch', 0) + 1
+        exp.saveState(snapshot(state))
+        self.truncate()
+
+    def truncate(self):
+        """
+        Empties the journal
+        """
+        self.close()
+        open(self.path, 'wb').close()
+
+
+class ExperimentState:
+
+    def __init__(self, **fields):
+        """
+        State object held in memory by StateManager; the state file holds its snapshot()
+        """
+        self.__dict__.update(fields)
+
+
+class StateManager:
+
+    def __init__(self, exp, journal=None):
+        """
+        Caches the experiment state in memory, writing through to disk on every save
+        :param exp: Experiment object
+        :param journal: (optional) StateJournal. Defaults to the journal in the subject folder
+        """
+        self.exp = exp
+        self.journal = journal or StateJournal(journal_path(exp))
+        self._state = None
+        self._loaded = False
+
+        # Disk access counters
+        self.loads = 0
+        self.saves = 0
+        self.journal_appends = 0
+
+    def _load(self):
+        saved = self.exp.restoreState()
+        self.loads += 1
+        state = None
+        if saved:
+            state = self.journal.replay(ExperimentState(**vars(saved)))
+        self._state = state
+        self._loaded = True
+        return state
+
+    def get(self):
+        """
+        :return: the state object, read from disk only the first time; None if there is no state yet
+        """
+        if not self._loaded:
+            return self._load()
+        return self._state
+
+    def record_progress(self, **fields):
+        """
+        Changes progress fields of the state and writes them to the journal
+        :param fields: (optional) fields to change, from JOURNAL_FIELDS
+        """
+        for field in fields:
+            if field not in JOURNAL_FIELDS:
+                raise Exception('%s is not a progress field' % field)
+        for (field, value) in fields.items():
+            setattr(self.get(), field, value)
+        self.journal.append(self._state)
+        self.journal_appends += 1
+
+    def save(self, **fields):
+        """
+        Writes the whole state (with any given field changes) to the snapshot,
+        folding in and emptying the journal
+        """
+        if self.get() is None:
+            # Made here rather than by PyEPL so it is kept without reading it back
+            self._state = ExperimentState(journalEpoch=0, **fields)
+            self.exp.saveState(snapshot(self._state))
+            self.journal.truncate()
+        else:
+            self.journal.compact(self.exp, self._state, **fields)
+        self.saves += 1
+        return self._state
+
+    def stats(self):
+        """
+        :return: dict of disk access counters
+        """
+        return {'loads': self.loads, 'saves': self.saves, 'journal_appends': self.journal_appends}
@@ -0,0 +1,101 @@
+"""
+Building the stim form PDFs of a subject's sessions.
+
+Each session's form is a LaTeX document (written by
+FRExperiment.make_stim_forms) compiled with latex and dvipdf. The forms are
+built concurrently: the work happens in the latex and dvipdf processes, so a
+pool of threads, each running one form's commands, keeps several of them
+busy without forking the experiment itself. Each build runs in its own
+temporary folder inside the session folder, and only the PDF is moved out.
+
+Next to every PDF is <form>.pdf.sha1, a hash of the document it was built
+from. The document holds the subject, the words, which lists are stim and
+the template, so a form whose document hasn't changed is not built again.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+FORM_VERSION = 1
+HASH_SUFFIX = '.sha1'
+LOG_FILE = 'latexLog.txt'
+
+BUILT, UNCHANGED, FAILED = 'built', 'unchanged', 'failed'
+
+
+def form_hash(document):
+    """
+    :param document: LaTeX source of the form (str)
+    :return: sha1 hex digest of the form version and source
+    """
+    return hashlib.sha1('%d\n%s' % (FORM_VERSION, document)).hexdigest()
+
+
+def is_built(pdf_path, content_hash):
+    """
+    :return: True if the PDF exists and was built from a document with this hash
+    """
+    hash_path = pdf_path + HASH_SUFFIX
+    if not (os.path.exists(pdf_path) and os.path.exists(hash_path)):
+        return False
+    return open(hash_path).read().strip() == content_hash
+
+
+def build_form(job):
+    """
+    Compiles one form, unless it is already built from the same document
+    :param job: (folder of the form, form name without extension, LaTeX source)
+    :return: (form name, BUILT, UNCHANGED or FAILED, seconds, error message or None)
+    """
+    (form_dir, form_name, document) = job
+    pdf_path = os.path.join(form_dir, form_name + '.pdf')
+    content_hash = form_hash(document)
+    if is_built(pdf_path, content_hash):
+        return form_name, UNCHANGED, 0., None
+
+    start = time.time()
+    build_dir = tempfile.mkdtemp(prefix='.%s.' % form_name, dir=form_dir)
+    try:
+        with open(os.path.join(build_dir, form_name + '.tex'), 'w') as tex_file:
+            tex_file.write(document)
+        with open(os.path.join(form_dir, LOG_FILE), 'a') as log:
+            for command in (['latex', '-interaction=nonstopmode', '-halt-on-error', form_name + '.tex'],
+                            ['dvipdf', form_name + '.dvi', form_name + '.pdf']):
+                log.flush()
+                try:
+                    status = subprocess.call(command, cwd=build_dir, stdout=log, stderr=subprocess.STDOUT)
+                except OSError as e:
+                    raise Exception('could not run %s (%s)' % (command[0], e.strerror))
+                if status != 0:
+                    raise Exception('%s failed, see %s' % (command[0], os.path.join(form_dir, LOG_FILE)))
+        os.rename(os.path.join(build_dir, form_name + '.pdf'), pdf_path)
+        with open(pdf_path + HASH_SUFFIX, 'w') as hash_file:
+            hash_file.write(content_hash + '\n')
+        return form_name, BUILT, time.time() - start, None
+    except Exception as e:
+        return form_name, FAILED, time.time() - start, str(e)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def build_forms(jobs, threads=None):
+    """
+    Builds forms concurrently
+    :param jobs: [(folder of the form, form name, LaTeX source), ...]
+    :param threads: (optional) number of forms built at once, default one per CPU
+    :return: [(form name, status, seconds, error message or None), ...] in the order of the jobs
+    """
+    if not jobs:
+        return []
+    pool = ThreadPool(min(len(jobs), threads or multiprocessing.cpu_count()))
+    try:
+        return pool.map(build_form, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
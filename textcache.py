@@ -0,0 +1,69 @@
+"""
+Text stimuli rendered ahead of time.
+
+Creating a PyEPL Text renders nothing until it is loaded, which otherwise
+happens when it is first shown, inside the ISI before a timed presentation.
+TextCache renders the texts of the upcoming list while the countdown plays,
+keyed by (stimulus class, text, font, size), so presenting a word only draws
+an already rendered surface. Texts that are not needed for the next list are
+unloaded when the next list is prepared.
+"""
+
+
+def _load(stimulus):
+    if hasattr(stimulus, 'load'):
+        stimulus.load()
+
+
+def _unload(stimulus):
+    if hasattr(stimulus, 'unload'):
+        stimulus.unload()
+
+
+class TextCache:
+
+    def __init__(self, font=None):
+        """
+        :param font: font the texts are rendered in (config.defaultFont), part of the key
+        """
+        self.font = font
+        self._texts = {}
+        self.rendered = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text_class, text, size):
+        return text_class, text, self.font, size
+
+    def _render(self, text_class, text, size):
+        stimulus = text_class(text, size=size)
+        _load(stimulus)
+        self.rendered += 1
+        self._texts[self._key(text_class, text, size)] = stimulus
+        return stimulus
+
+    def prepare(self, texts):
+        """
+        Renders the texts that will be needed next, and unloads any others
+        :param texts: [(text_class, text, size), ...]
+        """
+        keep = set(self._key(*text) for text in texts)
+        for key in [key for key in self._texts if key not in keep]:
+            _unload(self._texts.pop(key))
+        for (text_class, text, size) in texts:
+            if self._key(text_class, text, size) not in self._texts:
+                self._render(text_class, text, size)
+
+    def get(self, text_class, text, size):
+        """
+        :return: the rendered stimulus, rendering it now if it was not prepared
+        """
+        stimulus = self._texts.get(self._key(text_class, text, size))
+        if stimulus is None:
+            self.misses += 1
+            return self._render(text_class, text, size)
+        self.hits += 1
+        return stimulus
+
+    def stats(self):
+        return {'texts': len(self._texts), 'rendered': self.rendered, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,114 @@
+"""
+Tones computed once and kept on disk.
+
+Each tone (frequency, duration, rise/fall time, sample rate) is synthesized
+with numpy the first time it is needed and saved as a .npy file named by a
+hash of its parameters. Later runs memory-map the file read-only instead of
+synthesizing it again, and within a run every clip made from a tone shares the
+same buffer.
+
+The waveform matches PyEPL's Beep: a sine at 80% of full scale with linear
+rise and fall ramps, as 16 bit stereo samples.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+DEFAULT_SAMPLE_RATE = 44100
+N_CHANNELS = 2
+_AMPLITUDE = .8 * 32767
+
+
+def tone_key(freq, duration, rise_fall, sample_rate=DEFAULT_SAMPLE_RATE):
+    """
+    :return: name of the cache file for the tone, a hash of its parameters
+    """
+    params = repr((float(freq), float(duration), float(rise_fall), int(sample_rate), N_CHANNELS))
+    return hashlib.sha1(params).hexdigest()[:16]
+
+
+def synthesize(freq, duration, rise_fall, sample_rate=DEFAULT_SAMPLE_RATE):
+    """
+    :param freq: frequency in Hz
+    :param duration: duration in ms
+    :param rise_fall: length of the rise and of the fall ramp in ms
+    :return: int16 array of n_samples x N_CHANNELS
+    """
+    n_samples = int(round(sample_rate * duration / 1000.))
+    tone = np.sin(2 * np.pi * freq * np.arange(n_samples) / float(sample_rate)) * _AMPLITUDE
+    n_ramp = min(int(round(sample_rate * rise_fall / 1000.)), n_samples / 2)
+    if n_ramp:
+        ramp = np.linspace(0, 1, n_ramp)
+        tone[:n_ramp] *= ramp
+        tone[-n_ramp:] *= ramp[::-1]
+    return np.repeat(tone.astype(np.int16)[:, np.newaxis], N_CHANNELS, axis=1)
+
+
+class ToneCache:
+
+    def __init__(self, cache_dir, sample_rate=DEFAULT_SAMPLE_RATE):
+        """
+        :param cache_dir: folder for the .npy files, created if needed
+        :param sample_rate: sample rate of the tones
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.sample_rate = sample_rate
+        self._waveforms = {}
+        self._clips = {}
+        self.synthesized = 0
+        self.loaded = 0
+
+    def waveform(self, freq, duration, rise_fall):
+        """
+        :return: read-only int16 array of the tone
+        """
+        key = tone_key(freq, duration, rise_fall, self.sample_rate)
+        if key in self._waveforms:
+            return self._waveforms[key]
+        path = os.path.join(self.cache_dir, key + '.npy')
+        try:
+            waveform = np.load(path, mmap_mode='r')
+            self.loaded += 1
+        except (IOError, ValueError):
+            waveform = synthesize(freq, duration, rise_fall, self.sample_rate)
+            self.synthesized += 1
+            waveform = self._save(path, waveform)
+        self._waveforms[key] = waveform
+        return waveform
+
+    def _save(self, path, waveform):
+        """
+        Writes the tone to the cache and maps it back, or keeps it in memory if that fails
+        """
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as tmp_file:
+                np.save(tmp_file, waveform)
+            os.rename(tmp_path, path)
+            return np.load(path, mmap_mode='r')
+        except (IOError, OSError) as e:
+            print 'WARNING: could not cache tone in %s: %s' % (self.cache_dir, e)
+            waveform.setflags(write=False)
+            return waveform
+
+    def clip(self, clip_class, freq, duration, rise_fall):
+        """
+        :param clip_class: class of the clip, called as clip_class(samples, nchannels, samplerate)
+        :return: clip of the tone, shared between calls, or None if one could not be made
+        """
+        key = (clip_class, tone_key(freq, duration, rise_fall, self.sample_rate))
+        if key not in self._clips:
+            try:
+                self._clips[key] = clip_class(buffer(self.waveform(freq, duration, rise_fall)),
+                                              N_CHANNELS, self.sample_rate)
+            except Exception as e:
+                print 'WARNING: could not make %d Hz tone from cache: %s' % (freq, e)
+                self._clips[key] = None
+        return self._clips[key]
+
+    def stats(self):
+        return {'synthesized': self.synthesized, 'loaded': self.loaded}
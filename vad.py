@@ -0,0 +1,164 @@
+"""
+Vocalization onset detection.
+
+OnsetDetector takes a recording in chunks as they become available and
+reports candidate vocalization onsets. Each chunk is split into overlapping
+frames at once with numpy, and every frame gets its short-time energy (dBFS)
+and zero-crossing rate. A frame counts as speech when its energy is a margin
+above the background level (estimated from the start of the recording and
+then from non-speech frames) and it is either voiced (low zero-crossing rate)
+or clearly loud. An onset is the first frame of min_speech ms of speech that
+follows at least min_silence ms without.
+
+Onsets are candidates for annotators, not scored responses.
+"""
+
+import wave
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+ONSETS_SUFFIX = '.onsets.tsv'
+
+_FULL_SCALE = 32768.
+_EPSILON = 1e-10
+
+
+def frame_features(samples, frame_len, hop):
+    """
+    :param samples: 1D array of 16 bit samples
+    :param frame_len: samples per frame
+    :param hop: samples between frame starts
+    :return: (energy in dBFS, zero-crossing rate) arrays, one value per complete frame
+    """
+    samples = np.ascontiguousarray(samples, dtype=np.float32) / _FULL_SCALE
+    n_frames = 1 + (len(samples) - frame_len) // hop if len(samples) >= frame_len else 0
+    if n_frames == 0:
+        return np.zeros(0), np.zeros(0)
+    stride = samples.strides[0]
+    frames = as_strided(samples, shape=(n_frames, frame_len), strides=(hop * stride, stride))
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + _EPSILON)
+    signs = np.signbit(frames)
+    zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+    return energy, zcr
+
+
+class OnsetDetector:
+
+    def __init__(self, sample_rate=44100, frame_ms=20, hop_ms=10, margin_db=12., loud_db=10.,
+                 max_zcr=.25, min_energy_db=-55., min_speech_ms=60, min_silence_ms=300, calibration_ms=200):
+        """
+        :param sample_rate: samples per second
+        :param frame_ms: length of each analysis frame
+        :param hop_ms: time between frames
+        :param margin_db: energy above the background level for a frame to count as speech
+        :param loud_db: further margin above which the zero-crossing rate is ignored
+        :param max_zcr: highest zero-crossing rate of a voiced frame
+        :param min_energy_db: frames below this are never speech
+        :param min_speech_ms: speech needed to report an onset
+        :param min_silence_ms: silence needed between onsets
+        :param calibration_ms: start of the recording used for the first background estimate
+        """
+        self.sample_rate = sample_rate
+        self.frame_len = int(sample_rate * frame_ms / 1000.)
+        self.hop = int(sample_rate * hop_ms / 1000.)
+        self.hop_ms = hop_ms
+        self.margin_db = margin_db
+        self.loud_db = loud_db
+        self.max_zcr = max_zcr
+        self.min_energy_db = min_energy_db
+        self.min_speech = max(1, int(round(min_speech_ms / float(hop_ms))))
+        self.min_silence = max(1, int(round(min_silence_ms / float(hop_ms))))
+        self.n_calibration = max(1, int(round(calibration_ms / float(hop_ms))))
+
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._n_frames = 0
+        self._calibration = []
+        self.background_db = None
+        self._speech_run = 0
+        self._silence_run = self.min_silence
+        self.onsets = []
+
+    def feed(self, samples):
+        """
+        Processes the next chunk of the recording
+        :param samples: 1D array of 16 bit mono samples
+        :return: onsets found in this chunk, in ms from the start of the recording
+        """
+        samples = np.concatenate((self._pending, np.asarray(samples, dtype=np.int16)))
+        (energy, zcr) = frame_features(samples, self.frame_len, self.hop)
+        # Keep the samples of frames that aren't complete yet
+        self._pending = samples[len(energy) * self.hop:]
+
+        found = []
+        for (frame_energy, frame_zcr) in zip(energy, zcr):
+            frame_i = self._n_frames
+            self._n_frames += 1
+            if self.background_db is None:
+                self._calibration.append(frame_energy)
+                if len(self._calibration) >= self.n_calibration:
+                    self.background_db = float(np.median(self._calibration))
+                continue
+
+            threshold = max(self.background_db + self.margin_db, self.min_energy_db)
+            is_speech = frame_energy > threshold and \
+                (frame_zcr <= self.max_zcr or frame_energy > threshold + self.loud_db)
+            if is_speech:
+                self._speech_run += 1
+                if self._speech_run == self.min_speech:
+                    if self._silence_run >= self.min_silence:
+                        found.append((frame_i - self.min_speech + 1) * self.hop_ms)
+                    self._silence_run = 0
+            else:
+                if self._speech_run < self.min_speech:
+                    # Too short to be speech; counts as silence
+                    self._silence_run += self._speech_run
+                self._speech_run = 0
+                self._silence_run += 1
+                # Follow slow changes in the background
+                self.background_db += .02 * (frame_energy - self.background_db)
+        self.onsets.extend(found)
+        return found
+
+
+def detect_file(path, chunk_ms=500, **kwargs):
+    """
+    Runs the detector over a 16 bit wav file, a chunk at a time
+    :param path: wav file
+    :param chunk_ms: length of each chunk
+    :param kwargs: (optional) OnsetDetector parameters
+    :return: onsets in ms from the start of the recording
+    """
+    recording = wave.open(path, 'rb')
+    try:
+        if recording.getsampwidth() != 2:
+            raise Exception('%s is not a 16 bit recording' % path)
+        n_channels = recording.getnchannels()
+        detector = OnsetDetector(sample_rate=recording.getframerate(), **kwargs)
+        chunk_frames = int(recording.getframerate() * chunk_ms / 1000.)
+        while True:
+            data = recording.readframes(chunk_frames)
+            if not data:
+                break
+            samples = np.frombuffer(data, dtype='<i2')
+            if n_channels > 1:
+                samples = samples.reshape(-1, n_channels)[:, 0]
+            detector.feed(samples)
+    finally:
+        recording.close()
+    return detector.onsets
+
+
+def write_onsets(path, onsets, rec_start):
+    """
+    Writes the onsets of a recording to <recording>.onsets.tsv
+    :param path: path of the recording
+    :param onsets: onsets in ms from the start of the recording
+    :param rec_start: time of REC_START, so onsets are also given on the session clock
+    """
+    base = path[:-len('.wav')] if path.endswith('.wav') else path
+    sidecar = open(base + ONSETS_SUFFIX, 'w')
+    sidecar.write('onset_ms\tmstime\n')
+    for onset in onsets:
+        sidecar.write('%d\t%d\n' % (onset, rec_start + onset))
+    sidecar.close()
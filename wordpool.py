@@ -0,0 +1,88 @@
+"""
+Lookup tables over the experiment word pool.
+
+The pool is a few hundred words and is read once per process; every session
+list is resolved against it, so the lookups are built up front instead of
+scanning the pool for each word. The forms each word is written in (without
+accents for logs and .lst files, utf-8, LaTeX) are made at the same time.
+"""
+
+import codecs
+import collections
+import unicodedata
+
+# A word as presented (name), without accents, utf-8 encoded and LaTeX-escaped (utf-8)
+WordForms = collections.namedtuple('WordForms', ('name', 'no_accents', 'utf8', 'latex'))
+
+_LATEX_SPECIAL = {u'&': u'\\&', u'%': u'\\%', u'$': u'\\$', u'#': u'\\#', u'_': u'\\_',
+                  u'{': u'\\{', u'}': u'\\}', u'~': u'\\textasciitilde{}', u'^': u'\\textasciicircum{}',
+                  u'\\': u'\\textbackslash{}'}
+
+
+def remove_accents(word):
+    """
+    :param word: unicode word
+    :return: the word with combining accents removed
+    """
+    nkfd_form = unicodedata.normalize('NFKD', word)
+    return u"".join([c for c in nkfd_form if not unicodedata.combining(c)])
+
+
+def latex_escape(word):
+    """
+    :return: the word with LaTeX special characters escaped
+    """
+    return u''.join(_LATEX_SPECIAL.get(c, c) for c in word)
+
+
+def word_forms(word):
+    """
+    :param word: unicode word
+    :return: WordForms of the word
+    """
+    return WordForms(word, remove_accents(word), word.encode('utf-8'), latex_escape(word).encode('utf-8'))
+
+
+def read_pool_words(pool_file):
+    """
+    Reads the words of a pool file in pool order, the way TextPool does
+    :param pool_file: utf-8 word pool, one word per line
+    :return: list of words
+    """
+    return [line.strip() for line in codecs.open(pool_file, encoding='utf-8').readlines()
+            if line.strip()]
+
+
+class WordPoolIndex:
+
+    def __init__(self, pool):
+        """
+        Builds the name -> index and index -> item tables for a word pool
+        :param pool: iterable of pool items (e.g. CustomTextPool), each with a .name
+        """
+        self.items = list(pool)
+        self.index_by_name = {}
+        for index, item in enumerate(self.items):
+            # Keep the first occurrence, as TextPool.findBy does
+            self.index_by_name.setdefault(item.name, index)
+        self.forms_by_name = dict((name, word_forms(name)) for name in self.index_by_name)
+
+    def __len__(self):
+        return len(self.items)
+
+    def names(self):
+        """
+        :return: the words of the pool, in pool order
+        """
+        return [item.name for item in self.items]
+
+    def forms(self, name):
+        """
+        :param name: the word
+        :return: WordForms of the word. Words outside the pool (e.g. practice words) are made once and kept
+        """
+        try:
+            return self.forms_by_name[name]
+        except KeyError:
+            forms = self.forms_by_name[name] = word_forms(name)
+            return forms